@@ -7,7 +7,7 @@ from collections import defaultdict
 
 import numpy as np
 
-from quantos.backtest.gateway import PortfolioManager
+from quantos.backtest.gateway import ArrayPortfolioManager
 from quantos.data.basic.order import *
 from quantos.data.basic.position import GoalPosition
 from quantos.util.sequence import SequenceGenerator
@@ -25,7 +25,7 @@ class Strategy(with_metaclass(abc.ABCMeta)):
         Whether the strategy is under back-testing or live trading.
     trade_date : int
         current trading date (may be inconsistent with calendar date).
-    pm : backtest.PortfolioManger
+    pm : backtest.ArrayPortfolioManager
         Responsible for managing orders, trades and positions.
 
     Methods
@@ -37,7 +37,7 @@ class Strategy(with_metaclass(abc.ABCMeta)):
         self.context = None
         self.run_mode = common.RUN_MODE.BACKTEST
         
-        self.pm = PortfolioManager(self)
+        self.pm = ArrayPortfolioManager(self)
 
         self.task_id_map = defaultdict(list)
         self.seq_gen = SequenceGenerator()
@@ -213,21 +213,22 @@ class Strategy(with_metaclass(abc.ABCMeta)):
         """
         assert len(goals) == len(self.context.universe)
         
+        symbols = [goal.symbol for goal in goals]
+        goal_sizes = np.array([goal.size for goal in goals], dtype=float)
+        diff_sizes = goal_sizes - self.pm.get_sizes(symbols)
+        
         orders = []
-        for goal in goals:
-            sec, goal_size = goal.symbol, goal.size
-            if sec in self.pm.holding_securities:
-                curr_size = self.pm.get_position(sec, self.trade_date).curr_size
-            else:
-                curr_size = 0
-            diff_size = goal_size - curr_size
-            if diff_size != 0:
-                action = common.ORDER_ACTION.BUY if diff_size > 0 else common.ORDER_ACTION.SELL
-                
-                order = FixedPriceTypeOrder.new_order(sec, action, 0.0, abs(diff_size), self.trade_date, 0)
-                order.price_target = 'vwap'  # TODO
-                
-                orders.append(order)
+        for i in np.flatnonzero(diff_sizes != 0):
+            sec, diff_size = symbols[i], diff_sizes[i]
+            action = common.ORDER_ACTION.BUY if diff_size > 0 else common.ORDER_ACTION.SELL
+            # sizes are kept as float by pm, orders of whole lots have int size as before
+            size = abs(diff_size)
+            size = int(size) if size.is_integer() else float(size)
+            
+            order = FixedPriceTypeOrder.new_order(sec, action, 0.0, size, self.trade_date, 0)
+            order.price_target = 'vwap'  # TODO
+            
+            orders.append(order)
         self.place_batch_order(orders)
     
     def query_order(self, task_id):
@@ -361,7 +362,12 @@ class AlphaStrategy(Strategy):
 
         """
         self.pm.on_trade_ind(ind)
-        # print str(ind)
+        # cash is changed by fills, sizes are in lots
+        value = ind.fill_size * ind.fill_price * self.pm.LOT_SIZE
+        if ind.entrust_action in self.pm.BUY_ACTIONS:
+            self.cash -= value
+        elif ind.entrust_action in self.pm.SELL_ACTIONS:
+            self.cash += value
         
     def register_pc_method(self, name, func, options=None):
         if options is None:
@@ -495,7 +501,7 @@ class AlphaStrategy(Strategy):
         if len(suspensions) == len(self.context.universe):
             raise ValueError("All suspended")  # TODO custom error
         
-        weights = {sec: w if w not in suspensions else 0.0 for sec, w in self.weights.viewitems()}
+        weights = {sec: w if sec not in suspensions else 0.0 for sec, w in self.weights.viewitems()}
         weights_sum = np.sum(np.abs(weights.values()))
         if weights_sum > 0.0:
             weights = {sec: w / weights_sum for sec, w in weights.viewitems()}
@@ -569,31 +575,12 @@ class AlphaStrategy(Strategy):
         cash_available = self.cash + market_value
     
         cash_use = cash_available * self.position_ratio
-        cash_unuse = cash_available - cash_use
     
         # position of those suspended will remain the same (will not be traded)
-        goals, cash_remain = self.generate_weights_order(self.weights, cash_use, prices,
-                                                         algo='close', suspensions=suspensions)
+        # cash is not changed until orders of goals are filled, see on_trade_ind
+        goals, _ = self.generate_weights_order(self.weights, cash_use, prices,
+                                               algo='close', suspensions=suspensions)
         self.goal_positions = goals
-        self.cash = cash_remain + cash_unuse
-        # self.liquidate_all()
-        # self.place_batch_order(orders)
-        # ----------------------------------------
-        #  DEBUG validation
-        import pandas as pd
-        ret1 = self.context.dataview.data_d.loc[:, pd.IndexSlice[:, 'ret20']]
-        ret1.columns = ret1.columns.droplevel(level=1)
-        td = self.trade_date
-        ret1 = ret1.loc[td, :]
-        ret1 = ret1.sort_values().dropna()
-        
-        ser_weights = pd.Series(self.weights).sort_values()
-        rank_ret = set(ret1.index.values[-50:])
-        rank_weights = set(ser_weights.index.values[-50:])
-        print len(set(rank_ret) - set(rank_weights)) / 50.
-        # assert rank_dv == rank_weights
-        #  DEBUG validation
-        # ----------------------------------------
     
         self.on_after_rebalance(cash_available)
         
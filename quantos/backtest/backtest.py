@@ -1,12 +1,17 @@
 # encoding: utf-8
 
+import numpy as np
+import pandas as pd
+
 from quantos.data.calendar import Calendar
 from quantos.backtest import common
+from quantos.backtest import vectorized
+from quantos.backtest.prefetch import Prefetcher
 from quantos.backtest.analyze.pnlreport import PnlManager
 from quantos.backtest.event.eventEngine import Event
 from quantos.backtest.event.eventType import EVENT
 from quantos.backtest.pubsub import Subscriber
-from quantos.data.basic.marketdata import Bar
+from quantos.data.basic.marketdata import BarBatch
 from quantos.data.basic.trade import Trade
 from quantos.util import dtutil
 from quantos.util import fileio
@@ -122,8 +127,11 @@ class AlphaBacktestInstance(BacktestInstance):
     
     def on_new_day(self, date):
         self.ctx.trade_date = date
+        # orders of the last day not filled are cancelled, before the strategy leaves that day
+        cancelled = self.ctx.gateway.on_new_day(date)
+        for ind in cancelled or []:
+            self.strategy.on_order_status(ind)
         self.strategy.on_new_day(date)
-        self.ctx.gateway.on_new_day(date)
     
     def save_results(self, folder='../output/'):
         import pandas as pd
@@ -229,28 +237,36 @@ class AlphaBacktestInstance_dv(AlphaBacktestInstance):
                 # do re-balance on new day
                 self.on_new_day(self.current_date)
                 
-                univ_price_dic = self.get_univ_prices(field_name="close,vwap,open,high,low")  # access data
+                df_snapshot = self.get_univ_snapshot(field_name="close,vwap,open,high,low")  # access data
                 suspensions = self.get_suspensions()
-                self.strategy.re_balance_plan_after_open(univ_price_dic, suspensions)
+                self.strategy.re_balance_plan_after_open(self._snapshot_to_dict(df_snapshot), suspensions)
                 self.strategy.send_bullets()
             else:
                 self.on_new_day(self.current_date)
-                univ_price_dic = self.get_univ_prices(field_name="close,vwap,open,high,low")  # access data
+                df_snapshot = self.get_univ_snapshot(field_name="close,vwap,open,high,low")  # access data
+                suspensions = self.get_suspensions()
             
             # return trade indications
-            trade_indications = gateway.match(univ_price_dic, self.current_date)
+            trade_indications = gateway.match(df_snapshot, self.current_date, suspensions=suspensions)
             for trade_ind in trade_indications:
                 self.strategy.on_trade_ind(trade_ind)
         
         print "Backtest done. {:d} days, {:.2e} trades in total.".format(len(self.ctx.dataview.dates),
                                                                          len(self.strategy.pm.trades))
         
-    def get_univ_prices(self, field_name='close'):
+    def get_univ_snapshot(self, field_name='close'):
+        """DataFrame of symbol index and field columns on current date."""
         dv = self.ctx.dataview
-        df = dv.get_snapshot(self.current_date, fields=field_name)
+        return dv.get_snapshot(self.current_date, fields=field_name)
+    
+    @staticmethod
+    def _snapshot_to_dict(df):
         gp = df.groupby(by='symbol')
         return {sec: df for sec, df in gp}
     
+    def get_univ_prices(self, field_name='close'):
+        return self._snapshot_to_dict(self.get_univ_snapshot(field_name))
+    
     def _is_trade_date(self, start, end, date, data_server):
         return date in self.ctx.dataview.dates
     
@@ -260,6 +276,31 @@ class AlphaBacktestInstance_dv(AlphaBacktestInstance):
         mask_sus = trade_status != u'交易'.encode('utf-8')
         return list(trade_status.loc[mask_sus].index.values)
     
+    def run_alpha_vectorized(self, weights, price='vwap', commission_rate=0.0):
+        """
+        Backtest target weights with the same re-balance rules as run_alpha, without strategy callbacks
+        and order matching. See vectorized.run_dataview.
+
+        Parameters
+        ----------
+        weights : pd.DataFrame or str
+            Index is date, column is symbol. Or name of a field of DataView.
+        price : str
+            Field of fill price.
+        commission_rate : float
+
+        Returns
+        -------
+        positions : pd.DataFrame
+        daily : pd.DataFrame
+
+        """
+        return vectorized.run_dataview(self.ctx.dataview, weights, self.start_date, self.end_date,
+                                       period=self.props['period'], days_delay=self.props['days_delay'],
+                                       price=price, init_balance=self.props['init_balance'],
+                                       position_ratio=self.props['position_ratio'],
+                                       commission_rate=commission_rate)
+    
 
 class EventBacktestInstance(BacktestInstance):
     def __init__(self):
@@ -267,6 +308,8 @@ class EventBacktestInstance(BacktestInstance):
         
         self.pnlmgr = None
         self.bar_type = 1
+        # number of days of bars fetched ahead in background, 0 to fetch each day when it begins
+        self.prefetch_days = 2
 
     def init_from_config(self, props, strategy, context=None):
         self.props = props
@@ -280,6 +323,7 @@ class EventBacktestInstance(BacktestInstance):
         self.start_date = self.props.get("start_date")
         self.end_date = self.props.get("end_date")
         self.bar_type = props.get("bar_type")
+        self.prefetch_days = props.get("prefetch_days", self.prefetch_days)
 
         self.ctx = context
         self.strategy = strategy
@@ -311,6 +355,8 @@ class EventBacktestInstance(BacktestInstance):
             return lambda event: func(event.data, **event.kwargs)
         
         ee = self.strategy.eventEngine  # TODO event-driven way of lopping, is it proper?
+        # single-threaded replay: handlers are called directly by put, without queue
+        ee.sync = True
         ee.register(EVENT.CALENDAR_NEW_TRADE_DATE, __extract(self.strategy.on_new_day))
         ee.register(EVENT.MD_QUOTE, __extract(self.process_quote))
         ee.register(EVENT.MARKET_CLOSE, __extract(self.close_day))
@@ -322,7 +368,6 @@ class EventBacktestInstance(BacktestInstance):
                 e_newday = Event(EVENT.CALENDAR_NEW_TRADE_DATE)
                 e_newday.data = self.current_date
                 ee.put(e_newday)
-                ee.process_once()  # this line should be done on another thread
                 
                 # self.strategy.onNewday(self.current_date)
                 self.strategy.pm.on_new_day(self.current_date, self.last_date)
@@ -333,14 +378,12 @@ class EventBacktestInstance(BacktestInstance):
                     e_quote = Event(EVENT.MD_QUOTE)
                     e_quote.data = quote
                     ee.put(e_quote)
-                    ee.process_once()
                 
                 # self.strategy.onMarketClose()
                 # self.closeDay(self.current_date)
                 e_close = Event(EVENT.MARKET_CLOSE)
                 e_close.data = self.current_date
                 ee.put(e_close)
-                ee.process_once()
                 # self.strategy.onSettle()
                 
                 self.last_date = self.current_date
@@ -357,26 +400,55 @@ class EventBacktestInstance(BacktestInstance):
         self.strategy.on_new_day(self.current_date)
         print 'on_new_day in backtest {}'.format(self.current_date)
 
+    def get_trade_dates(self):
+        """
+        Trade dates visited by run, as calling go_next_trade_date from start_date while current_date <= end_date:
+        trade dates after start_date to end_date, and the first trade date after end_date.
+        
+        Returns
+        -------
+        list of int
+
+        """
+        if self.start_date > self.end_date:
+            return []
+        dt_end = dtutil.convert_int_to_datetime(self.end_date) + pd.Timedelta(weeks=2)
+        dates = self.ctx.calendar.get_trade_date_range(self.start_date, dtutil.convert_datetime_to_int(dt_end))
+        dates = dates[dates > self.start_date]
+        n = np.searchsorted(dates, self.end_date, side='right') + 1
+        return [int(date) for date in dates[:n]]
+
+    def fetch_bars(self, trade_date):
+        """
+        Bars of universe on trade_date sorted by time.
+        
+        Returns
+        -------
+        quotes : BarBatch or None
+        msg : str
+
+        """
+        df_quotes, msg = self.ctx.data_api.bar(symbol=self.ctx.universe, start_time=200000, end_time=160000,
+                                               trade_date=trade_date, freq=self.bar_type)
+        if df_quotes is None:
+            return None, msg
+        
+        return BarBatch.create_from_df(df_quotes).sort_by('time'), msg
+
     def run(self):
-        self.current_date = self.start_date
-    
-        while self.current_date <= self.end_date:  # each loop is a new trading day
-            self.go_next_trade_date()
-            self.on_new_day()
-            
-            df_quotes, msg = self.ctx.data_api.bar(symbol=self.ctx.universe, start_time=200000, end_time=160000,
-                                                   trade_date=self.current_date, freq=self.bar_type)
-            if df_quotes is None:
-                print msg
-                continue
+        # bars of the next prefetch_days days are fetched in background while a day is simulated
+        with Prefetcher(self.fetch_bars, self.get_trade_dates(), n_ahead=self.prefetch_days) as prefetcher:
+            for trade_date, (quotes_list, msg) in prefetcher:
+                self.last_date = self.current_date
+                self.current_date = trade_date
+                self.on_new_day()
                 
-            df_quotes = df_quotes.sort_values(by='time')
-            quotes_list = Bar.create_from_df(df_quotes)
-            
-            # for idx in df_quotes.index:
-            #     df_row = df_quotes.loc[[idx], :]
-            for quote in quotes_list:
-                self.process_quote(quote)
+                if quotes_list is None:
+                    print msg
+                    continue
+                
+                for quote in quotes_list:
+                    self.process_quote(quote)
         
         print "Backtest done."
         
@@ -3,4 +3,4 @@
 Our backtest is powered by this event engine that register, generate and process
 events in an efficient way.
 """
-from eventEngine import EventEngine, Event
+from eventEngine import EventEngine, LiveEventEngine, Event
@@ -2,8 +2,9 @@
 
 # 系统模块
 from Queue import Queue, Empty
-from collections import defaultdict
-from threading import Thread
+from collections import defaultdict, deque
+from threading import Condition, Thread, Event as ThreadEvent
+import time
 
 # 自己开发的模块
 from eventType import *
@@ -45,7 +46,7 @@ class EventEngine(object):
     stop：公共方法，停止引擎
     register：公共方法，向引擎中注册监听函数
     unregister：公共方法，向引擎中注销监听函数
-    put：公共方法，向事件队列中存入新的事件
+    put：公共方法，向事件队列中存入新的事件（同步模式下直接调用处理函数）
     
     事件监听函数必须定义为输入参数仅为一个event对象，即：
     
@@ -60,8 +61,14 @@ class EventEngine(object):
     """
     
     # ----------------------------------------------------------------------
-    def __init__(self):
-        """初始化事件引擎"""
+    def __init__(self, sync=False):
+        """
+        初始化事件引擎
+        sync：同步模式，put直接调用处理函数，不经过队列和线程（用于单线程回测）；
+              处理函数中put的事件在put返回前处理
+        """
+        self.sync = sync
+        
         # 事件队列
         self.__queue = Queue()
         
@@ -80,6 +87,10 @@ class EventEngine(object):
         
         # __generalHandlers是一个列表，用来保存通用回调函数（所有事件均调用）
         self.__generalHandlers = []
+        
+        # 每个事件类型的处理函数元组（含通用处理函数），注册和注销时预先计算，分发时不再创建列表
+        self.__dispatch = {}
+        self.__general = ()
     
     # ----------------------------------------------------------------------
     def __run(self):
@@ -92,6 +103,9 @@ class EventEngine(object):
                 pass
     
     def process_once(self):
+        if self.sync:
+            # 同步模式下事件在put中已处理
+            return False
         try:
             event = self.__queue.get(block=True, timeout=1)
             self.__process(event)
@@ -102,18 +116,16 @@ class EventEngine(object):
     # ----------------------------------------------------------------------
     def __process(self, event):
         """处理事件"""
-        # 检查是否存在对该事件进行监听的处理函数
-        if event.type_ in self.__handlers:
-            # 若存在，则按顺序将事件传递给处理函数执行
-            [handler(event) for handler in self.__handlers[event.type_]]
-            
-            # 以上语句为Python列表解析方式的写法，对应的常规循环写法为：
-            # for handler in self.__handlers[event.type_]:
-            # handler(event)
-        
-        # 调用通用处理函数进行处理
-        if self.__generalHandlers:
-            [handler(event) for handler in self.__generalHandlers]
+        # 按顺序调用该事件类型的处理函数，然后调用通用处理函数
+        for handler in self.__dispatch.get(event.type_, self.__general):
+            handler(event)
+    
+    # ----------------------------------------------------------------------
+    def __update_dispatch(self):
+        """重新计算每个事件类型的处理函数元组"""
+        self.__general = tuple(self.__generalHandlers)
+        self.__dispatch = {type_: tuple(handlers) + self.__general
+                           for type_, handlers in self.__handlers.items()}
     
     # ----------------------------------------------------------------------
     def __onTimer(self):
@@ -148,7 +160,8 @@ class EventEngine(object):
         self.__active = False
         
         # 停止计时器
-        self.__timer.stop()
+        if self.__timer is not None:
+            self.__timer.stop()
         
         # 等待事件处理线程退出
         self.__thread.join()
@@ -162,6 +175,7 @@ class EventEngine(object):
         # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
         if handler not in handlerList:
             handlerList.append(handler)
+        self.__update_dispatch()
     
     # ----------------------------------------------------------------------
     def unregister(self, type_, handler):
@@ -176,11 +190,236 @@ class EventEngine(object):
         # 如果函数列表为空，则从引擎中移除该事件类型
         if not handlerList:
             del self.__handlers[type_]
+        self.__update_dispatch()
     
     # ----------------------------------------------------------------------
     def put(self, event):
-        """向事件队列中存入事件"""
-        self.__queue.put(event)
+        """向事件队列中存入事件，同步模式下直接处理"""
+        if self.sync:
+            self.__process(event)
+        else:
+            self.__queue.put(event)
+    
+    # ----------------------------------------------------------------------
+    def registerGeneralHandler(self, handler):
+        """注册通用事件处理函数监听"""
+        if handler not in self.__generalHandlers:
+            self.__generalHandlers.append(handler)
+        self.__update_dispatch()
+    
+    # ----------------------------------------------------------------------
+    def unregisterGeneralHandler(self, handler):
+        """注销通用事件处理函数监听"""
+        if handler in self.__generalHandlers:
+            self.__generalHandlers.remove(handler)
+        self.__update_dispatch()
+
+
+########################################################################
+class LiveEventEngine(object):
+    """
+    实盘事件引擎：按事件类型分优先级通道，批量处理
+    
+    - 每种事件类型属于一个通道（lanes），数字越小优先级越高，默认委托和成交回报为0，行情为2，其他为1；
+      处理线程每次从优先级最高的非空通道取出最多max_batch个事件，所以行情突发时委托和成交回报
+      最多等待一批行情的处理时间
+    - coalesce中的事件类型（默认行情）按合约合并：未处理的同一合约行情被新行情替换，只处理最新的
+    - 注册时batch=True的处理函数一次收到同一类型连续事件的列表，否则逐个收到事件
+    - metrics返回每个通道的队列长度、处理数量、合并数量和延迟（从put到开始处理的秒数）
+    
+    put可以在任意线程中调用，处理函数都在同一个处理线程中调用。
+    """
+    
+    DEFAULT_LANE = 1
+    LANES = {EVENT_TRADE_IND: 0, EVENT_ORDERSTATUS_IND: 0, EVENT.ORDER_REP: 0,
+             EVENT_MD_QUOTE: 2, EVENT.MD_QUOTE: 2}
+    COALESCE = (EVENT_MD_QUOTE, EVENT.MD_QUOTE)
+    
+    # ----------------------------------------------------------------------
+    def __init__(self, lanes=None, coalesce=None, max_batch=100):
+        """
+        lanes：{事件类型: 通道}，更新默认的LANES
+        coalesce：按合约合并的事件类型，默认COALESCE
+        max_batch：每批最多处理的事件数
+        """
+        self.lanes = dict(self.LANES)
+        if lanes is not None:
+            self.lanes.update(lanes)
+        self.coalesce = set(self.COALESCE if coalesce is None else coalesce)
+        self.max_batch = max_batch
+        
+        self.__cond = Condition()
+        self.__active = False
+        self.__thread = None
+        self.__timer = None
+        
+        # 每个通道的事件队列，元素为[put时间, 事件]；__pending保存可合并的未处理事件
+        self.__queues = {}
+        self.__pending = {}
+        self.__metrics = {}
+        
+        # {事件类型: [(处理函数, 是否批量)]}
+        self.__handlers = defaultdict(list)
+        self.__generalHandlers = []
+    
+    # ----------------------------------------------------------------------
+    def __lane(self, lane):
+        """创建通道"""
+        if lane not in self.__queues:
+            self.__queues[lane] = deque()
+            self.__pending[lane] = {}
+            self.__metrics[lane] = {'depth': 0, 'max_depth': 0, 'processed': 0, 'coalesced': 0,
+                                    'latency_sum': 0.0, 'latency_max': 0.0}
+        return self.__queues[lane]
+    
+    @staticmethod
+    def coalesce_key(event):
+        """合并行情的键：合约代码，没有合约代码的事件不合并"""
+        data = event.data
+        if isinstance(data, dict):
+            return data.get('symbol')
+        return getattr(data, 'symbol', None)
+    
+    # ----------------------------------------------------------------------
+    def put(self, event):
+        """向事件所属通道存入事件"""
+        lane = self.lanes.get(event.type_, self.DEFAULT_LANE)
+        key = self.coalesce_key(event) if event.type_ in self.coalesce else None
+        with self.__cond:
+            queue = self.__lane(lane)
+            metrics = self.__metrics[lane]
+            if key is not None:
+                key = (event.type_, key)
+                entry = self.__pending[lane].get(key)
+                if entry is not None:
+                    # 替换未处理的旧行情，保留其位置和put时间
+                    entry[1] = event
+                    metrics['coalesced'] += 1
+                    return
+            
+            entry = [time.time(), event]
+            queue.append(entry)
+            if key is not None:
+                self.__pending[lane][key] = entry
+            metrics['max_depth'] = max(metrics['max_depth'], len(queue))
+            self.__cond.notify()
+    
+    # ----------------------------------------------------------------------
+    def __next_batch(self):
+        """从优先级最高的非空通道取出一批事件，没有事件时返回None"""
+        for lane in sorted(self.__queues):
+            queue = self.__queues[lane]
+            if not queue:
+                continue
+            
+            pending = self.__pending[lane]
+            metrics = self.__metrics[lane]
+            now = time.time()
+            batch = []
+            while queue and len(batch) < self.max_batch:
+                t_put, event = queue.popleft()
+                if pending:
+                    key = self.coalesce_key(event) if event.type_ in self.coalesce else None
+                    pending.pop((event.type_, key), None)
+                latency = now - t_put
+                metrics['latency_sum'] += latency
+                metrics['latency_max'] = max(metrics['latency_max'], latency)
+                batch.append(event)
+            metrics['processed'] += len(batch)
+            return batch
+        return None
+    
+    # ----------------------------------------------------------------------
+    def __run(self):
+        """引擎运行"""
+        while True:
+            with self.__cond:
+                batch = None
+                while self.__active:
+                    batch = self.__next_batch()
+                    if batch is not None:
+                        break
+                    self.__cond.wait(1)
+                if batch is None:
+                    return
+            self.process_batch(batch)
+    
+    # ----------------------------------------------------------------------
+    def process_batch(self, events):
+        """处理事件列表：同一类型的连续事件一起交给处理函数，然后逐个交给通用处理函数"""
+        start = 0
+        while start < len(events):
+            type_ = events[start].type_
+            end = start + 1
+            while end < len(events) and events[end].type_ == type_:
+                end += 1
+            run = events[start:end]
+            
+            for handler, batch in self.__handlers.get(type_, ()):
+                if batch:
+                    handler(run)
+                else:
+                    for event in run:
+                        handler(event)
+            for handler in self.__generalHandlers:
+                for event in run:
+                    handler(event)
+            start = end
+    
+    # ----------------------------------------------------------------------
+    def __onTimer(self, stopped):
+        """每隔1秒存入计时器事件，直到stopped被设置（stop会将self.__timer置为None，故不读取它）"""
+        while not stopped.wait(1):
+            self.put(Event(type_=EVENT_TIMER))
+    
+    # ----------------------------------------------------------------------
+    def start(self, timer=True):
+        """
+        引擎启动
+        timer：是否要启动计时器
+        """
+        self.__active = True
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        
+        if timer:
+            self.__timer = ThreadEvent()
+            timer_thread = Thread(target=self.__onTimer, args=(self.__timer,))
+            timer_thread.daemon = True
+            timer_thread.start()
+    
+    # ----------------------------------------------------------------------
+    def stop(self):
+        """停止引擎，未处理的事件被丢弃"""
+        with self.__cond:
+            self.__active = False
+            self.__cond.notify()
+        if self.__timer is not None:
+            self.__timer.set()
+            self.__timer = None
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+    
+    # ----------------------------------------------------------------------
+    def register(self, type_, handler, batch=False):
+        """
+        注册事件处理函数监听
+        batch：处理函数是否接受事件列表
+        """
+        handlerList = self.__handlers[type_]
+        if handler not in [h for h, _ in handlerList]:
+            handlerList.append((handler, batch))
+    
+    # ----------------------------------------------------------------------
+    def unregister(self, type_, handler):
+        """注销事件处理函数监听"""
+        handlerList = [(h, batch) for h, batch in self.__handlers.get(type_, []) if h != handler]
+        if handlerList:
+            self.__handlers[type_] = handlerList
+        else:
+            self.__handlers.pop(type_, None)
     
     # ----------------------------------------------------------------------
     def registerGeneralHandler(self, handler):
@@ -193,3 +432,61 @@ class EventEngine(object):
         """注销通用事件处理函数监听"""
         if handler in self.__generalHandlers:
             self.__generalHandlers.remove(handler)
+    
+    # ----------------------------------------------------------------------
+    def metrics(self):
+        """
+        每个通道的统计：{通道: {depth, max_depth, processed, coalesced, latency_mean, latency_max}}
+        depth是当前队列长度，延迟单位为秒
+        """
+        res = {}
+        with self.__cond:
+            for lane, metrics in self.__metrics.items():
+                dic = dict(metrics)
+                dic['depth'] = len(self.__queues[lane])
+                latency_sum = dic.pop('latency_sum')
+                dic['latency_mean'] = latency_sum / dic['processed'] if dic['processed'] else 0.0
+                res[lane] = dic
+        return res
+
+
+def benchmark(n_events=100000):
+    """
+    Events per second dispatched to one handler: synchronous mode, put followed by
+    process_once (as the backtest loop did), and the threaded mode.
+
+    Returns
+    -------
+    dict
+
+    """
+    res = {}
+    
+    def run(mode):
+        engine = EventEngine(sync=(mode == 'sync'))
+        done = ThreadEvent()
+        count = [0]
+        
+        def handler(event):
+            count[0] += 1
+            if count[0] == n_events:
+                done.set()
+        
+        engine.register(EVENT_MD_QUOTE, handler)
+        events = [Event(EVENT_MD_QUOTE) for _ in range(n_events)]
+        if mode == 'thread':
+            engine.start(timer=False)
+        t0 = time.time()
+        for event in events:
+            engine.put(event)
+            if mode == 'process_once':
+                engine.process_once()
+        done.wait()
+        seconds = time.time() - t0
+        if mode == 'thread':
+            engine.stop()
+        return n_events / seconds
+    
+    for mode in ['sync', 'process_once', 'thread']:
+        res[mode] = run(mode)
+    return res
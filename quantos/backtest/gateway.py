@@ -2,9 +2,11 @@
 
 from abc import abstractmethod
 import abc
+import bisect
 from six import with_metaclass
 
 import numpy as np
+import pandas as pd
 
 from quantos.data.basic.order import *
 from quantos.data.basic.position import Position
@@ -495,6 +497,345 @@ class PortfolioManager(TradeCallback):
         
         return market_value
 
+
+class ArrayPortfolioManager(TradeCallback):
+    """
+    Portfolio manager keeping positions and trade statistics of all symbols in arrays.
+
+    Each symbol gets an integer id (its position in self.symbols) when first seen. Sizes of
+    symbol i are element i of the size arrays, so market value, weights and differences to
+    target positions of the whole universe are a few numpy operations against a price vector.
+    It has the same TradeCallback interface and accessors (get_position, holding_securities,
+    market_value) as PortfolioManager.
+
+    Attributes
+    ----------
+    orders : dict of {(entrust_no, trade_date): quantos.data.basic.Order}
+    trades : list of quantos.data.basic.Trade objects
+    strategy : Strategy
+    symbols : list of str
+        Symbol of each id.
+    curr_size : np.ndarray
+        Current position of each symbol.
+    init_size : np.ndarray
+        Position at the start of the day.
+    frozen_size : np.ndarray
+        Positions to be closed by pending orders.
+    want_size : np.ndarray
+        Positions to be opened by pending orders.
+    buy_filled_size, sell_filled_size : np.ndarray
+        Total filled sizes.
+
+    """
+    SIZE_FIELDS = ('curr_size', 'init_size', 'frozen_size', 'want_size', 'buy_filled_size', 'sell_filled_size')
+    BUY_ACTIONS = (common.ORDER_ACTION.BUY, common.ORDER_ACTION.COVER,
+                   common.ORDER_ACTION.COVERYESTERDAY, common.ORDER_ACTION.COVERTODAY)
+    SELL_ACTIONS = (common.ORDER_ACTION.SELL, common.ORDER_ACTION.SELLTODAY,
+                    common.ORDER_ACTION.SELLYESTERDAY, common.ORDER_ACTION.SHORT)
+    # positions are in lots of 100 shares
+    LOT_SIZE = 100
+
+    def __init__(self, strategy=None, symbols=None):
+        self.orders = {}
+        self.trades = []
+        self.strategy = strategy
+
+        self.symbols = []
+        self._index = pd.Index([], dtype=object)
+        for field in self.SIZE_FIELDS:
+            # float, because positions adjusted for dividends may be fractional
+            setattr(self, field, np.zeros(0))
+        if symbols is not None:
+            self.get_ids(symbols)
+
+    @property
+    def _trade_date(self):
+        return self.strategy.trade_date if self.strategy is not None else 0
+
+    # -----------------------------------------------------
+    # symbol ids
+    def get_ids(self, symbols):
+        """
+        Ids of symbols, new symbols are added.
+
+        Parameters
+        ----------
+        symbols : list of str
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+        ids = self._index.get_indexer(symbols)
+        if (ids < 0).any():
+            new = pd.unique(np.asarray(symbols, dtype=object)[ids < 0])
+            self.symbols.extend(new)
+            self._index = pd.Index(self.symbols, dtype=object)
+            for field in self.SIZE_FIELDS:
+                setattr(self, field, np.append(getattr(self, field), np.zeros(len(new))))
+            ids = self._index.get_indexer(symbols)
+        return ids
+
+    def get_id(self, symbol):
+        return self.get_ids([symbol])[0]
+
+    def price_vector(self, prices):
+        """
+        Prices of all symbols in the order of ids.
+
+        Parameters
+        ----------
+        prices : dict of {symbol: price} or pd.Series indexed by symbol or np.ndarray by id
+
+        Returns
+        -------
+        np.ndarray
+            NaN for symbols without price.
+
+        """
+        if isinstance(prices, np.ndarray):
+            if len(prices) != len(self.symbols):
+                raise ValueError("price vector has {:d} elements, {:d} symbols".format(len(prices),
+                                                                                    len(self.symbols)))
+            return prices.astype(float)
+        if isinstance(prices, dict):
+            prices = pd.Series(prices)
+        return prices.reindex(self._index).values.astype(float)
+
+    # -----------------------------------------------------
+    # accessors
+    @property
+    def holding_ids(self):
+        return np.flatnonzero(self.curr_size != 0)
+
+    @property
+    def holding_securities(self):
+        return set(self._index[self.holding_ids])
+
+    def get_position(self, symbol, date=0):
+        """Position of symbol, a snapshot built from the arrays. None if the symbol has never been traded."""
+        i = self._index.get_indexer([symbol])[0]
+        if i < 0:
+            return None
+        position = Position()
+        position.symbol = symbol
+        position.trade_date = self._trade_date
+        position.curr_size = self.curr_size[i]
+        position.init_size = position.pre_size = self.init_size[i]
+        position.today_size = self.curr_size[i] - self.init_size[i]
+        position.frozen_size = self.frozen_size[i]
+        position.want_size = self.want_size[i]
+        position.enable_size = self.init_size[i] - self.frozen_size[i]
+        return position
+
+    def get_tradestat(self, symbol):
+        i = self.get_id(symbol)
+        tradestat = TradeStat()
+        tradestat.symbol = symbol
+        tradestat.buy_filled_size = self.buy_filled_size[i]
+        tradestat.buy_want_size = self.want_size[i]
+        tradestat.sell_filled_size = self.sell_filled_size[i]
+        tradestat.sell_want_size = self.frozen_size[i]
+        return tradestat
+
+    def get_sizes(self, symbols):
+        """Current positions of symbols."""
+        # new symbols extend the arrays, get ids before indexing
+        ids = self.get_ids(symbols)
+        return self.curr_size[ids]
+
+    # -----------------------------------------------------
+    # TradeCallback
+    def on_order_rsp(self, order, result, msg):
+        if result:
+            self.add_order(order)
+
+    def on_new_day(self, date, pre_date):
+        """Day orders of last day are finished: reset start of day positions and pending sizes."""
+        self.init_size = self.curr_size.copy()
+        self.frozen_size[:] = 0
+        self.want_size[:] = 0
+
+    def add_order(self, order):
+        """
+        Add order to orders, count its size as wanted (buy) or frozen (sell).
+
+        Parameters
+        ----------
+        order : Order
+
+        """
+        key = (order.entrust_no, self._trade_date)
+        if key in self.orders:
+            print 'duplicate entrust_no {}'.format(order.entrust_no)
+            return False
+
+        new_order = Order()
+        new_order.copy(order)
+        self.orders[key] = new_order
+
+        i = self.get_id(order.symbol)
+        if order.entrust_action in self.BUY_ACTIONS:
+            self.want_size[i] += order.entrust_size
+        else:
+            self.frozen_size[i] += order.entrust_size
+        return True
+
+    def on_order_status(self, ind):
+        if ind.order_status is None:
+            return
+
+        if ind.order_status == common.ORDER_STATUS.CANCELLED or ind.order_status == common.ORDER_STATUS.REJECTED:
+            order = self.orders.get((ind.entrust_no, self._trade_date), None)
+            if order is None:
+                raise ValueError("order {} does not exist".format(ind.entrust_no))
+            order.order_status = ind.order_status
+
+            i = self.get_id(ind.symbol)
+            release_size = ind.entrust_size - ind.fill_size
+            if ind.entrust_action in self.BUY_ACTIONS:
+                self.want_size[i] -= release_size
+            else:
+                self.frozen_size[i] -= release_size
+
+    def set_position(self, symbol, date, ratio=1):
+        """Modify latest position by a ratio."""
+        i = self.get_id(symbol)
+        self.curr_size[i] *= ratio
+        self.init_size[i] *= ratio
+
+    def on_trade_ind(self, ind):
+        self.trades.append(ind)
+
+        if ind.entrust_no != 101010:  # trades generated by system have no order
+            order = self.orders.get((ind.entrust_no, self._trade_date), None)
+            if order is None:
+                print 'cannot find order for entrust_no' + ind.entrust_no
+                return
+
+            order.fill_size += ind.fill_size
+            if order.fill_size == order.entrust_size:
+                order.order_status = common.ORDER_STATUS.FILLED
+            else:
+                order.order_status = common.ORDER_STATUS.ACCEPTED
+
+        if ind.entrust_action in self.BUY_ACTIONS:
+            is_buy = True
+        elif ind.entrust_action in self.SELL_ACTIONS:
+            is_buy = False
+        else:
+            return
+        self.apply_fills([self.get_id(ind.symbol)], [ind.fill_size], [is_buy])
+
+    def apply_fills(self, ids, sizes, is_buy):
+        """
+        Update positions and trade statistics by a batch of fills.
+
+        Parameters
+        ----------
+        ids : array-like of int
+            Symbol id of each fill, may repeat.
+        sizes : array-like of float
+            Fill sizes, positive.
+        is_buy : array-like of bool
+            Whether each fill increases position.
+
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        sizes = np.asarray(sizes, dtype=float)
+        is_buy = np.asarray(is_buy, dtype=bool)
+        n = len(self.symbols)
+        buy = np.bincount(ids, weights=np.where(is_buy, sizes, 0.0), minlength=n)
+        sell = np.bincount(ids, weights=np.where(is_buy, 0.0, sizes), minlength=n)
+
+        self.buy_filled_size += buy
+        self.want_size -= buy
+        self.sell_filled_size += sell
+        self.frozen_size -= sell
+        self.curr_size += buy - sell
+
+    # -----------------------------------------------------
+    # vectorized valuation
+    def market_values(self, ref_prices, suspensions=None):
+        """
+        Market value of position of each symbol, in the order of ids.
+
+        Parameters
+        ----------
+        ref_prices : dict of {symbol: price} or pd.Series or np.ndarray
+        suspensions : list of str
+            Securities that are suspended, their values are 0.
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+        prices = self.price_vector(ref_prices)
+        held = self.curr_size != 0
+        if suspensions:
+            held[self._index.isin(suspensions)] = False
+        res = np.zeros(len(self.symbols))
+        res[held] = prices[held] * self.curr_size[held] * self.LOT_SIZE
+        return res
+
+    def market_value(self, ref_date, ref_prices, suspensions=None):
+        """
+        Calculate total market value according to all current positions.
+        NOTE for now this func only support stocks.
+
+        Parameters
+        ----------
+        ref_date : int
+            Not used, positions are the latest.
+        ref_prices : dict of {symbol: price} or pd.Series or np.ndarray
+        suspensions : list of securities
+            Securities that are suspended.
+
+        Returns
+        -------
+        market_value : float
+
+        """
+        return float(self.market_values(ref_prices, suspensions).sum())
+
+    def weights(self, ref_prices, suspensions=None):
+        """Weight of each symbol in total market value (sum of absolute values is 1), in the order of ids."""
+        values = self.market_values(ref_prices, suspensions)
+        total = np.abs(values).sum()
+        return values / total if total > 0 else values
+
+    def goal_sizes(self, weights, turnover, ref_prices):
+        """
+        Positions (integer lots) of all symbols holding weights of turnover.
+
+        Parameters
+        ----------
+        weights : np.ndarray
+            Weight of each symbol in the order of ids.
+        turnover : float
+        ref_prices : dict of {symbol: price} or pd.Series or np.ndarray
+
+        Returns
+        -------
+        np.ndarray
+            0 where price or weight is missing.
+
+        """
+        prices = self.price_vector(ref_prices)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lots = np.round(weights * turnover / prices / self.LOT_SIZE)
+        lots[~np.isfinite(lots)] = 0.0
+        return lots
+
+    def diff_to_goal(self, goal_sizes):
+        """Ids and sizes to trade (positive to buy) to reach goal positions of all symbols in the order of ids."""
+        diff = np.asarray(goal_sizes, dtype=float) - self.curr_size
+        ids = np.flatnonzero(diff != 0)
+        return ids, diff[ids]
+
+
 class BaseGateway(object):
     """
     Strategy communicates with Gateway using APIs defined by ourselves;
@@ -613,7 +954,8 @@ class DailyStockSimGateway(BaseGateway):
         pass
     
     def on_new_day(self, trade_date):
-        self.simulator.on_new_day(trade_date)
+        """Orders not filled on the last day are cancelled, return their OrderStatusInd."""
+        return self.simulator.on_new_day(trade_date)
     
     def place_order(self, order):
         err_msg = self.simulator.add_order(order)
@@ -629,56 +971,146 @@ class DailyStockSimGateway(BaseGateway):
         return self.simulator.match_finished
     
     @abstractmethod
-    def match(self, price_dict, date=19700101, time=0):
+    def match(self, price_dict, date=19700101, time=0, suspensions=None):
         """
         Match un-fill orders in simulator. Return trade indications.
 
         Parameters
         ----------
-        price_dict : dict
+        price_dict : dict or pd.DataFrame
+        suspensions : list of str, optional
 
         Returns
         -------
         list
 
         """
-        return self.simulator.match(price_dict, date, time)
+        return self.simulator.match(price_dict, date, time, suspensions)
+    
+    def match_batch(self, prices, date=19700101, time=0, suspensions=None):
+        """Match un-fill orders in simulator. Return FillBatch."""
+        return self.simulator.match_batch(prices, date, time, suspensions)
+
+
+class FillBatch(object):
+    """
+    Fills of one match, in columns.
+
+    Attributes
+    ----------
+    task_id, entrust_no, symbol, entrust_action : np.ndarray of object
+    fill_price, fill_size : np.ndarray of float
+    fill_no : np.ndarray of int
+    fill_date, fill_time : int
+
+    """
+    COLUMNS = ['task_id', 'entrust_no', 'symbol', 'entrust_action', 'fill_price', 'fill_size', 'fill_no']
+    
+    def __init__(self, task_id, entrust_no, symbol, entrust_action, fill_price, fill_size, fill_no,
+                 fill_date=0, fill_time=0):
+        self.task_id = task_id
+        self.entrust_no = entrust_no
+        self.symbol = symbol
+        self.entrust_action = entrust_action
+        self.fill_price = fill_price
+        self.fill_size = fill_size
+        self.fill_no = fill_no
+        self.fill_date = fill_date
+        self.fill_time = fill_time
+    
+    def __len__(self):
+        return len(self.entrust_no)
+    
+    def to_frame(self):
+        df = pd.DataFrame({c: getattr(self, c) for c in self.COLUMNS}, columns=self.COLUMNS)
+        df['fill_date'] = self.fill_date
+        df['fill_time'] = self.fill_time
+        return df
+    
+    def to_trades(self):
+        """Fills as list of Trade, one per fill."""
+        trades = []
+        for i in range(len(self)):
+            trade = Trade()
+            trade.task_id = self.task_id[i]
+            trade.entrust_no = self.entrust_no[i]
+            trade.symbol = self.symbol[i]
+            trade.entrust_action = self.entrust_action[i]
+            size = self.fill_size[i]
+            trade.send_fill_info(self.fill_price[i], int(size) if size.is_integer() else size,
+                                 self.fill_date, self.fill_time, str(self.fill_no[i]))
+            trades.append(trade)
+        return trades
 
 
 class StockSimulatorDaily(object):
     """This is not event driven!
+    
+    Pending orders are kept in column arrays (symbol, side, remaining size, price field to be
+    filled at), so one match of all orders is a gather from a (symbol x field) price matrix
+    and a few masks:
+    
+    - orders whose symbol has no price (or NaN price), zero volume or is in suspensions are not filled;
+    - if prices have a 'preclose' column, buy orders are not filled when the stock stays at
+      limit-up all day (low >= limit-up price), and sell orders when it stays at limit-down.
+    
+    Orders not filled remain pending for next match of the same day. They are day orders:
+    on_new_day cancels orders still pending from the last day.
 
     Attributes
     ----------
-    __orders : list of Order
-        Store orders that have not been filled.
-    __order_id : int
-        Current order id
+    limit_ratio : float
+        Daily price limit relative to pre-close.
 
     """
+    ORDER_COLUMNS = ('_order', '_entrust_no', '_symbol', '_is_buy', '_field', '_remaining')
     
     def __init__(self):
-        # TODO heap is better for insertion and deletion. We only need implement search of heapq module.
-        self.__orders = dict()
+        self._new_orders = []
+        self._entrust_nos = set()
+        for col in self.ORDER_COLUMNS:
+            setattr(self, col, np.empty(0, dtype=object if col in ('_order', '_entrust_no', '_symbol', '_field')
+                                        else float))
+        self._is_buy = self._is_buy.astype(bool)
         self.seq_gen = SequenceGenerator()
+        self.limit_ratio = 0.1
         
         self.date = 0
         self.time = 0
     
     def on_new_day(self, trade_date):
+        """
+        Start a new trade date, cancel orders not filled on the last day.
+
+        Returns
+        -------
+        list of OrderStatusInd
+            Cancelled orders.
+
+        """
         self.date = trade_date
         self.time = 150000
-        # self._refresh_orders() #TODO sometimes we do not want to refresh (multi-days match)
+        return self._refresh_orders()
     
     def _refresh_orders(self):
-        self.__orders.clear()
+        """Cancel all pending orders, return their OrderStatusInd."""
+        self._flush()
+        res = []
+        for order in self._order:
+            order_status_ind = OrderStatusInd()
+            order_status_ind.init_from_order(order)
+            order_status_ind.order_status = common.ORDER_STATUS.CANCELLED
+            res.append(order_status_ind)
+        self._entrust_nos.clear()
+        self._keep(np.zeros(len(self._order), dtype=bool))
+        return res
     
     def _next_fill_no(self):
         return str(np.int64(self.date) * 10000 + self.seq_gen.get_next('fill_no'))
     
     @property
     def match_finished(self):
-        return len(self.__orders) == 0
+        return len(self._entrust_nos) == 0
     
     @staticmethod
     def _validate_order(order):
@@ -690,6 +1122,21 @@ class StockSimulatorDaily(object):
         # TODO to be enhanced
         assert price_dic is not None
     
+    @staticmethod
+    def _price_field(order):
+        """Price field an order is filled at."""
+        if isinstance(order, FixedPriceTypeOrder):
+            return order.price_target
+        elif isinstance(order, VwapOrder):
+            if order.start != -1:
+                raise NotImplementedError("Vwap of a certain time range")
+            return 'vwap'
+        elif isinstance(order, Order):
+            # TODO
+            return 'close'
+        else:
+            raise NotImplementedError("order class {} not support!".format(order.__class__))
+    
     def add_order(self, order):
         """
         Add one order to the simulator.
@@ -706,11 +1153,38 @@ class StockSimulatorDaily(object):
         """
         self._validate_order(order)
         
-        if order.entrust_no in self.__orders:
-            err_msg = "order with entrust_no {} already exists in simulator".format(order.entrust_no)
-        self.__orders[order.entrust_no] = order
-        err_msg = ""
-        return err_msg
+        if order.entrust_no in self._entrust_nos:
+            return "order with entrust_no {} already exists in simulator".format(order.entrust_no)
+        if order.entrust_size - order.fill_size <= 0:
+            return "order with entrust_no {} has nothing to fill".format(order.entrust_no)
+        self._price_field(order)
+        self._entrust_nos.add(order.entrust_no)
+        self._new_orders.append(order)
+        return ""
+    
+    def _flush(self):
+        """Append columns of orders added since last flush."""
+        if not self._new_orders:
+            return
+        orders = self._new_orders
+        self._new_orders = []
+        
+        new = {'_order': orders,
+               '_entrust_no': [o.entrust_no for o in orders],
+               '_symbol': [o.symbol for o in orders],
+               '_is_buy': [o.entrust_action in ArrayPortfolioManager.BUY_ACTIONS for o in orders],
+               '_field': [self._price_field(o) for o in orders],
+               '_remaining': [o.entrust_size - o.fill_size for o in orders]}
+        for col in self.ORDER_COLUMNS:
+            old = getattr(self, col)
+            arr = np.empty(len(orders), dtype=old.dtype)
+            arr[:] = new[col]
+            setattr(self, col, np.concatenate([old, arr]))
+    
+    def _keep(self, mask):
+        """Keep orders of mask only."""
+        for col in self.ORDER_COLUMNS:
+            setattr(self, col, getattr(self, col)[mask])
     
     def cancel_order(self, entrust_no):
         """
@@ -726,73 +1200,191 @@ class StockSimulatorDaily(object):
             default ""
 
         """
-        popped = self.__orders.pop(entrust_no, None)
-        if popped is None:
+        self._flush()
+        rows = np.flatnonzero(self._entrust_no == entrust_no)
+        if not len(rows):
             err_msg = "No order with entrust_no {} in simulator.".format(entrust_no)
             order_status_ind = None
         else:
             err_msg = ""
+            popped = self._order[rows[0]]
             order_status_ind = OrderStatusInd()
             order_status_ind.init_from_order(popped)
             order_status_ind.order_status = common.ORDER_STATUS.CANCELLED
+            
+            self._entrust_nos.discard(entrust_no)
+            self._keep(self._entrust_no != entrust_no)
         return order_status_ind, err_msg
     
-    def match(self, price_dic, date=19700101, time=150000):
-        self._validate_price(price_dic)
+    @staticmethod
+    def _price_frame(price_dic):
+        """{symbol: DataFrame of one row} to DataFrame of symbol index and field columns."""
+        return pd.DataFrame({sec: df.iloc[0] for sec, df in price_dic.viewitems()}).T
+    
+    def match_batch(self, prices, date=19700101, time=150000, suspensions=None):
+        """
+        Match all pending orders at once.
+
+        Parameters
+        ----------
+        prices : pd.DataFrame or dict
+            DataFrame of symbol index and field columns (e.g. DataView.get_snapshot),
+            or {symbol: DataFrame of one row}.
+        date : int
+        time : int
+        suspensions : list of str, optional
+
+        Returns
+        -------
+        FillBatch
+
+        """
+        self._validate_price(prices)
+        if isinstance(prices, dict):
+            prices = self._price_frame(prices)
+        self._flush()
         
-        results = []
-        for order in self.__orders.values():  # TODO viewvalues()
-            symbol = order.symbol
-            df = price_dic[symbol]
-            if 'vwap' not in df.columns:
-                # df.loc[:, 'vwap'] = df.loc[:, 'turnover'] / df.loc[:, 'volume']
-                pass
-            
-            # get fill price
-            if isinstance(order, FixedPriceTypeOrder):
-                price_target = order.price_target
-                fill_price = df.loc[:, price_target].values[0]
-            elif isinstance(order, VwapOrder):
-                if order.start != -1:
-                    raise NotImplementedError("Vwap of a certain time range")
-                fill_price = df.loc[:, 'vwap'].values[0]
-            elif isinstance(order, Order):
-                # TODO
-                fill_price = df.loc[:, 'close'].values[0]
-            else:
-                raise NotImplementedError("order class {} not support!".format(order.__class__))
-            
-            # get fill size
-            fill_size = order.entrust_size - order.fill_size
-            
-            # create trade indication
-            trade_ind = Trade()
-            trade_ind.init_from_order(order)
-            trade_ind.send_fill_info(fill_price, fill_size,
-                                     date, time,
-                                     self._next_fill_no())
-            results.append(trade_ind)
-            
-            # update order status
-            order.fill_price = (order.fill_price * order.fill_size
-                                + fill_price * fill_size) / (order.fill_size + fill_size)
-            order.fill_size += fill_size
-            if order.fill_size == order.entrust_size:
-                order.order_status = common.ORDER_STATUS.FILLED
+        rows = prices.index.get_indexer(self._symbol)
+        has_price = rows >= 0
+        rows = np.where(has_price, rows, 0)
         
-        self.__orders = {k: v for k, v in self.__orders.viewitems() if not v.is_finished}
-        # self.cancel_order(order.entrust_no)  # TODO DEBUG
+        def gather(field):
+            """Value of field of symbol of each order, NaN if missing."""
+            res = np.full(len(rows), np.nan)
+            if field in prices.columns:
+                res[has_price] = prices[field].values.astype(float)[rows[has_price]]
+            return res
         
-        return results
+        # fill price of each order from a (symbol x field) matrix
+        fields = list(pd.unique(self._field))
+        matrix = prices.reindex(columns=fields).values.astype(float)
+        cols = pd.Index(fields).get_indexer(self._field)
+        fill_price = np.full(len(rows), np.nan)
+        if matrix.size:
+            fill_price[has_price] = matrix[rows[has_price], cols[has_price]]
+        
+        can_fill = ~np.isnan(fill_price) & (self._remaining > 0)
+        can_fill &= ~(gather('volume') == 0)
+        if suspensions:
+            can_fill &= ~pd.Series(self._symbol).isin(suspensions).values
+        
+        preclose = gather('preclose')
+        if not np.isnan(preclose).all():
+            up = np.round(preclose * (1 + self.limit_ratio), 2)
+            down = np.round(preclose * (1 - self.limit_ratio), 2)
+            low, high = gather('low'), gather('high')
+            low = np.where(np.isnan(low), fill_price, low)
+            high = np.where(np.isnan(high), fill_price, high)
+            with np.errstate(invalid='ignore'):
+                blocked = np.where(self._is_buy, low >= up - 1e-6, high <= down + 1e-6)
+            can_fill &= ~blocked
+        
+        idx = np.flatnonzero(can_fill)
+        fill_size = self._remaining[idx]
+        fill_price = fill_price[idx]
+        first = self.seq_gen.get_next_n('fill_no', len(idx))
+        fill_no = np.int64(self.date) * 10000 + first + np.arange(len(idx), dtype=np.int64)
+        orders = self._order[idx]
+        fills = FillBatch(np.array([o.task_id for o in orders], dtype=object), self._entrust_no[idx],
+                          self._symbol[idx], np.array([o.entrust_action for o in orders], dtype=object),
+                          fill_price, fill_size, fill_no, fill_date=date, fill_time=time)
+        
+        # update order status: orders are filled all at once and leave the simulator
+        for order, price, size in zip(orders, fill_price, fill_size):
+            order.fill_price = (order.fill_price * order.fill_size + price * size) / (order.fill_size + size)
+            order.fill_size = order.entrust_size
+            order.order_status = common.ORDER_STATUS.FILLED
+        self._remaining[idx] = 0.0
+        self._entrust_nos.difference_update(fills.entrust_no)
+        self._keep(self._remaining > 0)
+        return fills
+    
+    def match(self, price_dic, date=19700101, time=150000, suspensions=None):
+        """Match all pending orders, return list of Trade. See match_batch."""
+        return self.match_batch(price_dic, date, time, suspensions).to_trades()
 
 
-class OrderBook(object):
-    def __init__(self):
+class _PriceQueue(object):
+    """
+    Resting orders of one symbol, side and order type, in priority order.
+
+    Keys are (sign * price, seq): sign is -1 for orders triggered when price falls to them
+    (buy limit, sell stop) so that in all queues triggered orders are a prefix, best price first
+    then first in first out.
+
+    """
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = []
         self.orders = []
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def key(self, order, seq):
+        return self.sign * order.entrust_price, seq
+    
+    def push(self, key, order):
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.orders.insert(i, order)
+    
+    def remove(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+            del self.orders[i]
+    
+    def n_triggered(self, price):
+        """Number of orders triggered by price (low for sign -1, high for sign 1)."""
+        return bisect.bisect_right(self.keys, (self.sign * price, float('inf')))
+    
+    def pop_front(self, n):
+        del self.keys[:n]
+        del self.orders[:n]
+
+
+class OrderBook(object):
+    """
+    Resting orders of a bar simulator, indexed by symbol.
+    
+    Each symbol has one price-sorted queue for each of buy limit, sell limit, buy stop and sell stop
+    orders, so a bar only visits orders of its symbol that it triggers:
+    
+    - buy limit / sell stop: entrust_price >= bar low;
+    - sell limit / buy stop: entrust_price <= bar high.
+    
+    Orders are filled at entrust_price. Finished orders are removed from the book.
+
+    Attributes
+    ----------
+    orders : dict of {entrust_no: Order}
+        Orders not finished.
+    volume_ratio : float or None
+        If not None, at most volume_ratio * bar volume is filled on each side of a bar, in priority:
+        limit orders before stop orders of the same side, then price then time in each queue.
+        Orders can be partially filled. If None, triggered orders are filled fully.
+
+    """
+    # ((action, order_type), sign of price queue, which of bar low/high triggers it), in fill priority
+    QUEUES = (((common.ORDER_ACTION.BUY, common.ORDER_TYPE.LIMIT), -1, 'low'),
+              ((common.ORDER_ACTION.SELL, common.ORDER_TYPE.LIMIT), 1, 'high'),
+              ((common.ORDER_ACTION.BUY, common.ORDER_TYPE.STOP), 1, 'high'),
+              ((common.ORDER_ACTION.SELL, common.ORDER_TYPE.STOP), -1, 'low'))
+    _SIGNS = dict((queue_type, sign) for queue_type, sign, _ in QUEUES)
+    
+    def __init__(self, volume_ratio=None):
+        self.orders = {}
+        self.volume_ratio = volume_ratio
         self.trade_id = 0
         self.order_id = 0
         
         self.seq_gen = SequenceGenerator()
+        
+        # symbol -> {(action, order_type): _PriceQueue}
+        self._queues = {}
+        # entrust_no -> (queue, key)
+        self._keys = {}
     
     def next_trade_id(self):
         return self.seq_gen.get_next('trade_id')
@@ -805,7 +1397,26 @@ class OrderBook(object):
         # to do
         order.entrust_no = self.next_order_id()
         neworder.copy(order)
-        self.orders.append(neworder)
+        self.orders[neworder.entrust_no] = neworder
+        
+        # orders of other types or actions are never matched
+        queue_type = (neworder.entrust_action, neworder.order_type)
+        if queue_type not in self._SIGNS:
+            return
+        queues = self._queues.get(neworder.symbol)
+        if queues is None:
+            queues = self._queues[neworder.symbol] = {k: _PriceQueue(sign) for k, sign in self._SIGNS.items()}
+        queue = queues[queue_type]
+        key = queue.key(neworder, self.seq_gen.get_next('seq'))
+        queue.push(key, neworder)
+        self._keys[neworder.entrust_no] = (queue, key)
+    
+    def _remove(self, order):
+        self.orders.pop(order.entrust_no, None)
+        queue_key = self._keys.pop(order.entrust_no, None)
+        if queue_key is not None:
+            queue, key = queue_key
+            queue.remove(key)
     
     def make_trade(self, quote, freq='1m'):
         
@@ -824,146 +1435,102 @@ class OrderBook(object):
             # TODO
             return self.makeDaiylTrade(quote)
     
+    def _fill(self, order, size, quote_time):
+        trade = Trade()
+        trade.fill_no = self.next_trade_id()
+        trade.entrust_no = order.entrust_no
+        trade.symbol = order.symbol
+        trade.entrust_action = order.entrust_action
+        trade.fill_size = size
+        trade.fill_price = order.entrust_price
+        trade.fill_date = order.entrust_date
+        trade.fill_time = quote_time
+        
+        order.fill_price = ((order.fill_price * order.fill_size + trade.fill_price * size)
+                            / (order.fill_size + size))
+        order.fill_size += size
+        if order.fill_size == order.entrust_size:
+            order.order_status = common.ORDER_STATUS.FILLED
+        else:
+            order.order_status = common.ORDER_STATUS.ACCEPTED
+        
+        orderstatusInd = OrderStatusInd()
+        orderstatusInd.init_from_order(order)
+        return trade, orderstatusInd
+    
     def make_trade_bar(self, quote):
-        # low = quote.loc[:, 'low'].values[0]
-        # high = quote.loc[:, 'high'].values[0]
-        # quote_time = quote.loc[:, 'time'].values[0]
-        # quote_symbol = quote.loc[:, 'symbol'].values[0]
-        low = quote.low
-        high = quote.high
+        queues = self._queues.get(quote.symbol)
+        if queues is None:
+            return []
+        bounds = {'low': quote.low, 'high': quote.high}
         quote_time = quote.time
-        quote_symbol = quote.symbol
+        if self.volume_ratio is None:
+            available = {common.ORDER_ACTION.BUY: None, common.ORDER_ACTION.SELL: None}
+        else:
+            volume = self.volume_ratio * quote.volume
+            available = {common.ORDER_ACTION.BUY: volume, common.ORDER_ACTION.SELL: volume}
         
         result = []
-        # to be optimized
-        for i in xrange(len(self.orders)):
-            order = self.orders[i]
-            if quote_symbol != order.symbol:
-                continue
-            if order.is_finished:
+        for queue_type, _, bound in self.QUEUES:
+            queue = queues[queue_type]
+            if not len(queue):
                 continue
+            n = queue.n_triggered(bounds[bound])
+            action = queue_type[0]
+            n_finished = 0
+            for order in queue.orders[:n]:
+                size = order.entrust_size - order.fill_size
+                left = available[action]
+                if left is not None:
+                    size = min(size, int(left))
+                    available[action] = left - size
+                if size <= 0:
+                    break
+                result.append(self._fill(order, size, quote_time))
+                if not order.is_finished:
+                    break
+                n_finished += 1
             
-            if order.order_type == common.ORDER_TYPE.LIMIT:
-                if order.entrust_action == common.ORDER_ACTION.BUY and order.entrust_price >= low:
-                    trade = Trade()
-                    trade.fill_no = self.next_trade_id()
-                    trade.entrust_no = order.entrust_no
-                    trade.symbol = order.symbol
-                    trade.entrust_action = order.entrust_action
-                    trade.fill_size = order.entrust_size
-                    trade.fill_price = order.entrust_price
-                    trade.fill_date = order.entrust_date
-                    trade.fill_time = quote_time
-                    
-                    order.order_status = common.ORDER_STATUS.FILLED
-                    order.fill_size = trade.fill_size
-                    order.fill_price = trade.fill_price
-                    
-                    orderstatusInd = OrderStatusInd()
-                    orderstatusInd.init_from_order(order)
-                    result.append((trade, orderstatusInd))
-                
-                if order.entrust_action == common.ORDER_ACTION.SELL and order.entrust_price <= high:
-                    trade = Trade()
-                    trade.fill_no = self.next_trade_id()
-                    trade.entrust_no = order.entrust_no
-                    trade.symbol = order.symbol
-                    trade.entrust_action = order.entrust_action
-                    trade.fill_size = order.entrust_size
-                    trade.fill_price = order.entrust_price
-                    trade.fill_date = order.entrust_date
-                    trade.fill_time = quote_time
-                    
-                    order.order_status = common.ORDER_STATUS.FILLED
-                    order.fill_size = trade.fill_size
-                    order.fill_price = trade.fill_price
-                    
-                    orderstatusInd = OrderStatusInd()
-                    orderstatusInd.init_from_order(order)
-                    result.append((trade, orderstatusInd))
-            
-            if order.order_type == common.ORDER_TYPE.STOP:
-                if order.entrust_action == common.ORDER_ACTION.BUY and order.entrust_price <= high:
-                    trade = Trade()
-                    trade.fill_no = self.next_trade_id()
-                    trade.entrust_no = order.entrust_no
-                    trade.symbol = order.symbol
-                    trade.entrust_action = order.entrust_action
-                    trade.fill_size = order.entrust_size
-                    trade.fill_price = order.entrust_price
-                    trade.fill_date = order.entrust_date
-                    trade.fill_time = quote_time
-                    
-                    order.order_status = common.ORDER_STATUS.FILLED
-                    order.fill_size = trade.fill_size
-                    order.fill_price = trade.fill_price
-                    orderstatusInd = OrderStatusInd()
-                    orderstatusInd.init_from_order(order)
-                    result.append((trade, orderstatusInd))
-                
-                if order.entrust_action == common.ORDER_ACTION.SELL and order.entrust_price >= low:
-                    trade = Trade()
-                    trade.fill_no = self.next_trade_id()
-                    trade.entrust_no = order.entrust_no
-                    trade.symbol = order.symbol
-                    trade.entrust_action = order.entrust_action
-                    trade.fill_size = order.entrust_size
-                    trade.fill_price = order.entrust_price
-                    trade.fill_date = order.entrust_date
-                    trade.fill_time = quote_time
-                    
-                    order.order_status = common.ORDER_STATUS.FILLED
-                    order.fill_size = trade.fill_size
-                    order.fill_price = trade.fill_price
-                    orderstatusInd = OrderStatusInd()
-                    orderstatusInd.init_from_order(order)
-                    result.append((trade, orderstatusInd))
+            # filled orders are at the front of the queue
+            for order in queue.orders[:n_finished]:
+                self.orders.pop(order.entrust_no, None)
+                self._keys.pop(order.entrust_no, None)
+            queue.pop_front(n_finished)
         
         return result
     
     def cancel_order(self, entrust_no):
-        for i in xrange(len(self.orders)):
-            order = self.orders[i]
-            
-            if (order.is_finished):
-                continue
-            
-            if (order.entrust_no == entrust_no):
-                order.cancel_size = order.entrust_size - order.fill_size
-                order.order_status = common.ORDER_STATUS.CANCELLED
-            
-            # todo
-            orderstatus = OrderStatusInd()
-            orderstatus.init_from_order(order)
-            
-            return orderstatus
+        order = self.orders.get(entrust_no)
+        if order is None:
+            return None
+        
+        order.cancel_size = order.entrust_size - order.fill_size
+        order.order_status = common.ORDER_STATUS.CANCELLED
+        self._remove(order)
+        
+        orderstatus = OrderStatusInd()
+        orderstatus.init_from_order(order)
+        return orderstatus
     
     def cancel_all(self):
         result = []
-        for order in self.orders:
-            if order.is_finished:
-                continue
-            order.cancel_size = order.entrust_size - order.fill_size
-            order.order_status = common.ORDER_STATUS.CANCELLED
-            
-            # todo
-            orderstatus = OrderStatusInd()
-            orderstatus.init_from_order(order)
-            result.append(orderstatus)
-        
+        for entrust_no in list(self.orders.keys()):
+            result.append(self.cancel_order(entrust_no))
         return result
 
 
 class BarSimulatorGateway(BaseGateway):
     def __init__(self):
         super(BarSimulatorGateway, self).__init__()
+        self.volume_ratio = None
         self.orderbook = OrderBook()
     
     def init_from_config(self, props):
-        pass
+        self.volume_ratio = props.get('volume_ratio', None)
+        self.orderbook = OrderBook(self.volume_ratio)
     
     def on_new_day(self, trade_date):
-        self.orderbook = OrderBook()
+        self.orderbook = OrderBook(self.volume_ratio)
     
     def send_order(self, order, algo, param):
         self.orderbook.add_order(order)
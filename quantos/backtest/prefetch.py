@@ -0,0 +1,101 @@
+# encoding: utf-8
+"""
+Prefetch data of the next days in a background thread while the current day is processed.
+
+Fetching bars of a day is mostly waiting for the data server, so a thread is enough to overlap it
+with the simulation of the previous day: while the consumer processes item N, the worker fetches
+and decodes items N+1 ... N+n_ahead. Results are delivered in the order of items, and at most
+n_ahead results are buffered, which bounds memory for long backtests.
+
+"""
+import threading
+from Queue import Queue, Full
+
+
+_END = object()
+
+
+class Prefetcher(object):
+    """
+    Iterate (item, func(item)) over items, calling func ahead of the consumer.
+
+    Exceptions raised by func are raised again by the iteration, at the item that failed.
+
+    Attributes
+    ----------
+    func : callable
+    items : iterable
+    n_ahead : int
+        Maximum number of results fetched ahead of the consumer. If 0, func is called
+        by the consumer, without a thread.
+
+    Examples
+    --------
+    >>> with Prefetcher(fetch_bars, dates, n_ahead=2) as prefetcher:
+    ...     for date, bars in prefetcher:
+    ...         simulate(bars)
+
+    """
+    def __init__(self, func, items, n_ahead=2):
+        self.func = func
+        self.items = items
+        self.n_ahead = n_ahead
+
+        self._queue = Queue(maxsize=max(n_ahead, 1))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _put(self, obj):
+        """Put obj into the queue unless stopped. Returns False if stopped."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(obj, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for item in self.items:
+                if not self._put((item, self.func(item), None)):
+                    return
+        except Exception as e:
+            self._put((None, None, e))
+        self._put(_END)
+
+    def start(self):
+        if self.n_ahead > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """Stop the worker and drop results not consumed."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __iter__(self):
+        if self.n_ahead <= 0:
+            for item in self.items:
+                yield item, self.func(item)
+            return
+
+        self.start()
+        while True:
+            obj = self._queue.get()
+            if obj is _END:
+                break
+            item, res, error = obj
+            if error is not None:
+                raise error
+            yield item, res
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,322 @@
+# encoding: utf-8
+"""
+Parameter sweep of alpha backtests in a process pool.
+
+Each combination of parameters is one task, identified by a hash of its parameters.
+Workers save the results of each task to the output folder as soon as it finishes
+(daily values and trades first, then a JSON file of parameters and metrics, which marks the
+task as done), so an interrupted sweep is resumed by running it again: finished tasks are skipped.
+
+Workers are forked after the DataView is set as the task of this module, so they read data from
+the memory of the parent process (shared copy-on-write pages) instead of receiving pickled copies.
+This needs os.fork (not on Windows). A dataview published with quantos.data.shared.publish
+is attached by each worker instead: all workers map the same files, also without fork.
+
+"""
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest import vectorized
+from quantos.data.shared import SharedDataView
+from quantos.util import fileio
+
+
+DEFAULT_PARAMS = {'signal': None,
+                  'pc_method': 'factor_value_weight',
+                  'period': 'month',
+                  'days_delay': 0,
+                  'position_ratio': 1.0,
+                  'init_balance': 1e7,
+                  'price': 'vwap',
+                  'commission_rate': 0.0}
+
+
+def expand_grid(grid):
+    """
+    All combinations of parameters.
+
+    Parameters
+    ----------
+    grid : dict or list of dict
+        {parameter name: list of values}, all combinations are used; or a list of {parameter name: value}.
+
+    Returns
+    -------
+    list of dict
+
+    """
+    if isinstance(grid, dict):
+        names = list(grid.keys()) if isinstance(grid, OrderedDict) else sorted(grid.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[list(grid[name]) for name in names])]
+    return [dict(dic) for dic in grid]
+
+
+def task_key(params):
+    """Identifier of a task: hash of its parameters."""
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def signal_weights(signal, method='factor_value_weight'):
+    """
+    Target weights from a signal, as portfolio construction methods of AlphaStrategy.
+
+    Parameters
+    ----------
+    signal : pd.DataFrame
+        Index is date, column is symbol.
+    method : {'factor_value_weight', 'equal_weight'}
+        factor_value_weight: signal shifted to be positive (by twice the absolute minimum of each date);
+        equal_weight: equal weights of symbols with signal.
+
+    Returns
+    -------
+    pd.DataFrame
+        Weights of each date sum to 1 in absolute value.
+
+    """
+    values = signal.values.astype(float)
+    valid = ~np.isnan(values)
+    if method == 'factor_value_weight':
+        w_min = np.min(np.where(valid, values, np.inf), axis=1)
+        w_min[np.isinf(w_min)] = 0.0
+        weights = np.where(valid, values + 2 * np.abs(w_min)[:, np.newaxis], 0.0)
+    elif method == 'equal_weight':
+        weights = valid.astype(float)
+    else:
+        raise NotImplementedError("portfolio construction method {}".format(method))
+
+    w_sum = np.abs(weights).sum(axis=1)
+    nonzero = w_sum > 1e-8
+    weights[nonzero] /= w_sum[nonzero, np.newaxis]
+    return pd.DataFrame(weights, index=signal.index, columns=signal.columns)
+
+
+def calc_metrics(daily, init_balance):
+    """
+    Performance metrics of daily values returned by vectorized.run_weights.
+
+    Returns
+    -------
+    dict
+
+    """
+    value = daily['total_value'].values
+    ret = np.diff(np.concatenate([[init_balance], value])) / np.concatenate([[init_balance], value[:-1]])
+    drawdown = 1.0 - value / np.maximum.accumulate(np.maximum(value, init_balance))
+    std = ret.std()
+    return {'total_return': value[-1] / init_balance - 1.0,
+            'annual_return': (value[-1] / init_balance) ** (242.0 / len(value)) - 1.0,
+            'volatility': std * np.sqrt(242.0),
+            'sharpe': ret.mean() / std * np.sqrt(242.0) if std > 0 else np.nan,
+            'max_drawdown': drawdown.max(),
+            'turnover': daily['turnover'].sum() / value.mean(),
+            'commission': daily['commission'].sum(),
+            'n_rebalance': int((daily['turnover'] > 0).sum())}
+
+
+def run_alpha(dv, params):
+    """
+    Default task of a sweep: vectorized backtest of weights from a signal, see vectorized.run_dataview.
+
+    Parameters
+    ----------
+    dv : DataView
+    params : dict
+        Parameters in DEFAULT_PARAMS. signal is a field of dv or a formula;
+        pc_method is a method of signal_weights.
+
+    Returns
+    -------
+    dict
+        metrics : dict
+        daily : pd.DataFrame
+        trades : pd.DataFrame
+            Columns are trade_date, symbol and size (in lots, negative to sell).
+
+    """
+    p = dict(DEFAULT_PARAMS)
+    p.update(params)
+    signal = p['signal']
+    if signal is None:
+        signal = pd.DataFrame(1.0, index=dv.dates, columns=dv.symbol)
+    elif signal in dv.fields:
+        signal = dv.get_ts(signal)
+    else:
+        signal = dv.eval_formula(signal)
+    weights = signal_weights(signal, p['pc_method'])
+
+    positions, daily = vectorized.run_dataview(dv, weights, period=p['period'], days_delay=p['days_delay'],
+                                               price=p['price'], init_balance=p['init_balance'],
+                                               position_ratio=p['position_ratio'],
+                                               commission_rate=p['commission_rate'])
+
+    diff = positions.diff()
+    diff.iloc[0] = positions.iloc[0]
+    trades = diff.stack()
+    trades = trades.loc[trades != 0]
+    trades.index.names = ['trade_date', 'symbol']
+    trades = trades.rename('size').reset_index()
+    return {'metrics': calc_metrics(daily, p['init_balance']), 'daily': daily, 'trades': trades}
+
+
+# task of _run_task, set by the parent process before forking workers
+_sweep_task = None
+# DataView of each SharedDataView folder attached by this process
+_attached = {}
+
+
+def _get_dataview(dataview):
+    if isinstance(dataview, SharedDataView):
+        if dataview.folder not in _attached:
+            _attached[dataview.folder] = dataview.attach()
+        return _attached[dataview.folder]
+    return dataview
+
+
+def _run_task(item):
+    """Run and save one task of _sweep_task."""
+    key, params = item
+    sweep = _sweep_task
+    res = sweep.func(_get_dataview(sweep.dataview), params)
+    sweep._save(key, params, res)
+    return key
+
+
+class ParameterSweep(object):
+    """
+    Run a task for every combination of parameters and collect results into a table.
+
+    Attributes
+    ----------
+    dataview : DataView or SharedDataView
+        Read-only data of all tasks.
+    folder : str
+        Output folder: for task key, key_daily.csv, key_trades.csv and key.json.
+    func : callable
+        Task function, takes dataview and a dict of parameters, returns a dict of metrics (dict),
+        and optionally daily and trades (pd.DataFrame). Must be a module-level function.
+
+    Examples
+    --------
+    >>> sweep = ParameterSweep(dv, 'output/sweep')
+    >>> df = sweep.run({'signal': ['Rank(roe)', 'Rank(roe) + Rank(-pb)'], 'period': ['week', 'month'],
+    ...                 'position_ratio': [0.7, 1.0]}, n_jobs=8)
+
+    """
+    def __init__(self, dataview, folder, func=run_alpha):
+        self.dataview = dataview
+        self.folder = os.path.abspath(folder)
+        self.func = func
+
+    def _path(self, key, suffix):
+        return os.path.join(self.folder, key + suffix)
+
+    def is_done(self, key):
+        return os.path.exists(self._path(key, '.json'))
+
+    def _save(self, key, params, res):
+        """Save results of a task. JSON file is saved last and atomically: it marks the task done."""
+        for name in ['daily', 'trades']:
+            df = res.get(name)
+            if df is not None:
+                fn = self._path(key, '_{}.csv'.format(name))
+                df.to_csv(fn + '.tmp')
+                os.rename(fn + '.tmp', fn)
+        metrics = {k: float(v) if isinstance(v, (float, np.floating)) else v
+                   for k, v in res['metrics'].items()}
+        fn = self._path(key, '.json')
+        fileio.save_json({'key': key, 'params': params, 'metrics': metrics}, fn + '.tmp')
+        os.rename(fn + '.tmp', fn)
+
+    def run(self, grid, n_jobs=1):
+        """
+        Run tasks of grid not done yet in a process pool, and return results of all tasks of grid.
+
+        Parameters
+        ----------
+        grid : dict or list of dict
+            See expand_grid.
+        n_jobs : int
+            Number of worker processes. If 1, tasks are run in this process.
+
+        Returns
+        -------
+        pd.DataFrame
+            See results.
+
+        """
+        tasks = expand_grid(grid)
+        keys = [task_key(params) for params in tasks]
+        todo = [(key, params) for key, params in zip(keys, tasks) if not self.is_done(key)]
+        fileio.create_dir(self._path('x', ''))
+
+        global _sweep_task
+        _sweep_task = self
+        try:
+            if n_jobs > 1 and len(todo) > 1:
+                pool = multiprocessing.Pool(min(n_jobs, len(todo)))
+                try:
+                    for _ in pool.imap_unordered(_run_task, todo):
+                        pass
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for item in todo:
+                    _run_task(item)
+        finally:
+            _sweep_task = None
+        return self.results(keys)
+
+    def results(self, keys=None):
+        """
+        Table of parameters and metrics of finished tasks.
+
+        Parameters
+        ----------
+        keys : list of str, optional
+            Default all tasks in folder.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is task key, columns are parameters and metrics.
+
+        """
+        if keys is None:
+            keys = sorted(fn[:-len('.json')] for fn in os.listdir(self.folder) if fn.endswith('.json'))
+        rows = []
+        for key in keys:
+            content = fileio.read_json(self._path(key, '.json'))
+            if content is None:
+                continue
+            row = dict(content['params'])
+            row.update(content['metrics'])
+            row['key'] = key
+            rows.append(row)
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame(rows).set_index('key')
+
+    def load(self, key, name='daily'):
+        """
+        Saved DataFrame of a task.
+
+        Parameters
+        ----------
+        key : str
+        name : {'daily', 'trades'}
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        return pd.read_csv(self._path(key, '_{}.csv'.format(name)), index_col=0)
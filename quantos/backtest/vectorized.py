@@ -0,0 +1,235 @@
+# encoding: utf-8
+"""
+Vectorized alpha backtest over (date x symbol) weight matrices.
+
+Follows the re-balance rules of AlphaBacktestInstance_dv and AlphaStrategy:
+
+- re-balance dates: the trade date after the n'th business day of each next period;
+- suspended securities keep their positions, their weights are removed and the
+  others re-normalized; market value to re-balance does not include them;
+- goal position of each security is its weight of (cash + market value) * position_ratio
+  at close price, rounded to lots (100 shares);
+- positions are in lots, the unit of ArrayPortfolioManager and of orders of AlphaStrategy;
+- positions are adjusted by the ratio of adjust_factor (bonus shares, dividends re-invested).
+
+Instead of strategy callbacks, orders and trade indications on each day, the loop is over
+re-balance dates only, and each step is a few array operations on all securities.
+Positions between re-balance dates only change by adjust_factor, which is a cumulative product.
+
+"""
+import numpy as np
+import pandas as pd
+
+from quantos.util import dtutil
+
+
+def rebalance_dates(trade_dates, start_date, end_date, period, days_delay):
+    """
+    Re-balance dates of AlphaBacktestInstance from start_date to end_date.
+
+    Parameters
+    ----------
+    trade_dates : array-like of int
+        Sorted trade dates.
+    start_date : int
+    end_date : int
+    period : str
+        {'day', 'week', 'month'}
+    days_delay : int
+
+    Returns
+    -------
+    np.ndarray of int
+
+    """
+    trade_dates = np.asarray(trade_dates, dtype=np.int64)
+    res = []
+    current = start_date
+    while True:
+        next_period_day = dtutil.get_next_period_day(int(current), period, days_delay)
+        idx = np.searchsorted(trade_dates, next_period_day, side='right')
+        if idx >= len(trade_dates) or trade_dates[idx] > end_date:
+            break
+        current = trade_dates[idx]
+        res.append(current)
+    return np.array(res, dtype=np.int64)
+
+
+def _round_lots(shares, lot_size):
+    """Round to lots half away from zero, as round() of python 2."""
+    lots = shares / lot_size
+    return np.sign(lots) * np.floor(np.abs(lots) + 0.5) * lot_size
+
+
+def _values(df, index, columns, fill=np.nan):
+    if df is None:
+        return np.full((len(index), len(columns)), fill)
+    return df.reindex(index=index, columns=columns).values.astype(float)
+
+
+def run_weights(weights, close, fill_price=None, adjust_factor=None, suspended=None, rebalance=None,
+                init_balance=1e7, position_ratio=1.0, lot_size=100, commission_rate=0.0):
+    """
+    Backtest target weights with array operations.
+
+    On each re-balance date, weights of that date are used (shift them if they are known only after close).
+    Securities that are suspended, or have no close or fill price on that date, are not traded.
+    Cash is changed by fills at fill_price and commissions.
+
+    Parameters
+    ----------
+    weights : pd.DataFrame
+        Target weights. Index is date, column is symbol. NaN means 0.
+    close : pd.DataFrame
+        Close prices used to calculate market value and goal positions.
+    fill_price : pd.DataFrame, optional
+        Prices orders are filled at, e.g. vwap. Default close.
+    adjust_factor : pd.DataFrame, optional
+        Positions are multiplied by its increase ratio. Default no adjustment.
+    suspended : pd.DataFrame of bool, optional
+    rebalance : array-like of int, optional
+        Re-balance dates. Default all dates of weights.
+    init_balance : float
+    position_ratio : float
+        Ratio of total value to be invested on each re-balance.
+    lot_size : int
+    commission_rate : float
+        Commission as ratio of turnover.
+
+    Returns
+    -------
+    positions : pd.DataFrame
+        Positions after close of each date, in lots of lot_size shares as ArrayPortfolioManager.
+        Index is date, column is symbol.
+    daily : pd.DataFrame
+        Index is date, columns are cash, market_value, total_value, pnl, turnover and commission.
+
+    """
+    dates = close.index
+    symbols = weights.columns
+    n_dates, n_symbols = len(dates), len(symbols)
+
+    px_close = _values(close, dates, symbols)
+    px_fill = px_close if fill_price is None else _values(fill_price, dates, symbols)
+    mat_weights = np.nan_to_num(_values(weights, dates, symbols, fill=0.0))
+    mat_suspended = _values(suspended, dates, symbols, fill=0.0) > 0
+
+    ratio = np.ones((n_dates, n_symbols))
+    if adjust_factor is not None:
+        factor = _values(adjust_factor, dates, symbols)
+        ratio[1:] = factor[1:] / factor[:-1]
+        # decreasing or missing adjust factor is ignored, as in position_adjust
+        ratio[~(ratio > 1.0)] = 1.0
+    growth = np.cumprod(ratio, axis=0)
+
+    if rebalance is None:
+        rebalance = dates.values
+    reb_idx = np.flatnonzero(np.in1d(dates.values, rebalance))
+
+    # position after close of each re-balance date relative to cumulative growth: between re-balance dates
+    # position[t] = base * growth[t]
+    base = np.zeros(n_symbols)
+    bases = np.zeros((len(reb_idx), n_symbols))
+    cash_after = np.empty(len(reb_idx))
+    turnover = np.zeros(n_dates)
+    commission = np.zeros(n_dates)
+    cash = init_balance
+    for k, t in enumerate(reb_idx):
+        pos = base * growth[t]
+        price = px_close[t]
+        tradable = ~mat_suspended[t] & ~np.isnan(price) & ~np.isnan(px_fill[t])
+
+        w = np.where(tradable, mat_weights[t], 0.0)
+        w_sum = np.abs(w).sum()
+        if w_sum > 0.0:
+            w = w / w_sum
+
+        market_value = np.dot(pos[tradable], price[tradable])
+        cash_use = (cash + market_value) * position_ratio
+        goal = pos.copy()
+        goal[tradable] = _round_lots(w[tradable] * cash_use / price[tradable], lot_size)
+
+        diff = goal - pos
+        traded = diff != 0
+        value = np.abs(diff[traded]) * px_fill[t][traded]
+        turnover[t] = value.sum()
+        commission[t] = turnover[t] * commission_rate
+        cash = cash - np.dot(diff[traded], px_fill[t][traded]) - commission[t]
+
+        base = goal / growth[t]
+        bases[k] = base
+        cash_after[k] = cash
+
+    # expand to all dates: last re-balance on or before each date
+    seg = np.searchsorted(reb_idx, np.arange(n_dates), side='right') - 1
+    has_reb = seg >= 0
+    mat_pos = np.zeros((n_dates, n_symbols))
+    mat_pos[has_reb] = bases[seg[has_reb]] * growth[has_reb]
+    ser_cash = np.full(n_dates, float(init_balance))
+    ser_cash[has_reb] = cash_after[seg[has_reb]]
+
+    # value with last available close
+    px_value = pd.DataFrame(px_close).fillna(method='ffill').values
+    holding = mat_pos != 0
+    market_value = np.where(holding, mat_pos * np.nan_to_num(px_value), 0.0).sum(axis=1)
+
+    positions = pd.DataFrame(mat_pos / lot_size, index=dates, columns=symbols)
+    daily = pd.DataFrame({'cash': ser_cash, 'market_value': market_value}, index=dates)
+    daily['total_value'] = daily['cash'] + daily['market_value']
+    daily['pnl'] = daily['total_value'].diff()
+    daily.iloc[0, daily.columns.get_loc('pnl')] = daily['total_value'].iloc[0] - init_balance
+    daily['turnover'] = turnover
+    daily['commission'] = commission
+    daily = daily.loc[:, ['cash', 'market_value', 'total_value', 'pnl', 'turnover', 'commission']]
+    return positions, daily
+
+
+def run_dataview(dv, weights, start_date=0, end_date=0, period='month', days_delay=0, price='vwap',
+                 init_balance=1e7, position_ratio=1.0, commission_rate=0.0):
+    """
+    Backtest target weights on data of a DataView with the re-balance dates of AlphaBacktestInstance_dv.
+
+    Weights are planned before open, so weights of the trade date before each re-balance date are used.
+    Securities are suspended if trade_status is not trading. Positions are adjusted by adjust_factor
+    if it is a field of the DataView.
+
+    Parameters
+    ----------
+    dv : DataView
+    weights : pd.DataFrame or str
+        Index is date, column is symbol. Or name of a field of DataView.
+    start_date : int, optional
+        Default 0 (dv.start_date).
+    end_date : int, optional
+        Default 0 (dv.end_date).
+    period : str
+    days_delay : int
+    price : str
+        Field of fill price.
+    init_balance : float
+    position_ratio : float
+    commission_rate : float
+
+    Returns
+    -------
+    positions : pd.DataFrame
+    daily : pd.DataFrame
+        See run_weights.
+
+    """
+    start_date = start_date or dv.start_date
+    end_date = end_date or dv.end_date
+    if isinstance(weights, basestring):
+        weights = dv.get_ts(weights)
+    close = dv.get_ts('close')
+    weights = weights.reindex(index=close.index, columns=close.columns).shift(1)
+
+    suspended = None
+    if 'trade_status' in dv.fields:
+        suspended = dv.get_ts('trade_status') != u'交易'.encode('utf-8')
+    adjust_factor = dv.get_ts('adjust_factor') if 'adjust_factor' in dv.fields else None
+
+    dates = rebalance_dates(close.index.values, start_date, end_date, period, days_delay)
+    return run_weights(weights, close, fill_price=dv.get_ts(price), adjust_factor=adjust_factor,
+                       suspended=suspended, rebalance=dates, init_balance=init_balance,
+                       position_ratio=position_ratio, commission_rate=commission_rate)
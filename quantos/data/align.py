@@ -64,7 +64,17 @@ def align(df_value, df_ann, date_arr):
     
     date_arr = np.asarray(date_arr, dtype=int)
     
-    res = np.apply_along_axis(lambda date: get_neareast(df_ann.values, df_value.values, date), 1, date_arr.reshape(-1, 1))
+    ann = df_ann.values
+    value = df_value.values
+    # for each date, we need the last row whose ann_date <= date.
+    # suffix minimum of ann_date is sorted, and the last row whose suffix minimum <= date is exactly that row,
+    # so it can be found by binary search of all dates at once.
+    suffix_min = np.minimum.accumulate(ann[::-1], axis=0)[::-1]
+    res = np.empty((len(date_arr), value.shape[1]), dtype=value.dtype)
+    for i in range(value.shape[1]):
+        idx = np.searchsorted(suffix_min[:, i], date_arr, side='right') - 1
+        res[:, i] = value[idx, i]
+        res[idx < 0, i] = np.nan
 
     df_res = pd.DataFrame(index=date_arr, columns=df_value.columns, data=res)
     return df_res
@@ -1,5 +1,7 @@
 # encoding: utf-8
 
+import numpy as np
+
 
 class Bar(object):
     def __init__(self):
@@ -22,3 +24,104 @@ class Bar(object):
             
             bar_list.append(bar)
         return bar_list
+
+
+# fields of Bar that have a value even if they are not columns of a batch
+BAR_DEFAULTS = Bar().__dict__
+
+
+class BarView(object):
+    """
+    Read-only row of a BarBatch, used as a Bar: quote.symbol, quote.close...
+
+    Only a reference to the columns and the row number are stored.
+
+    """
+    __slots__ = ('_columns', '_i')
+
+    def __init__(self, columns, i):
+        self._columns = columns
+        self._i = i
+
+    def __getattr__(self, name):
+        # slots not set yet, e.g. on a copy being made
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._columns[name][self._i]
+        except KeyError:
+            if name in BAR_DEFAULTS:
+                return BAR_DEFAULTS[name]
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        # copies and pickles only keep the values of this row
+        return {name: [values[self._i]] for name, values in self._columns.items()}, 0
+
+    def __setstate__(self, state):
+        self._columns, self._i = state
+
+    def to_dict(self):
+        dic = dict(BAR_DEFAULTS)
+        dic.update({name: values[self._i] for name, values in self._columns.items()})
+        return dic
+
+    def __repr__(self):
+        return "BarView({})".format(self.to_dict())
+
+
+class BarBatch(object):
+    """
+    Bars stored by column, one array per field.
+
+    Iterating gives a BarView of each row, which can be passed where a Bar is expected,
+    without creating a dict and a Bar object for each bar.
+
+    Attributes
+    ----------
+    arrays : dict
+        {field: np.ndarray}, all of the same length.
+
+    Examples
+    --------
+    >>> batch = BarBatch.create_from_df(df_quotes)
+    >>> for quote in batch:
+    ...     gateway.process_quote(quote)
+
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self._columns = None
+
+    @classmethod
+    def create_from_df(cls, df):
+        return cls({name: df[name].values for name in df.columns})
+
+    @property
+    def columns(self):
+        """{field: list}, values of arrays as Python objects, which are faster to get one by one."""
+        if self._columns is None:
+            self._columns = {name: values.tolist() for name, values in self.arrays.items()}
+        return self._columns
+
+    def __len__(self):
+        if not self.arrays:
+            return 0
+        return len(next(iter(self.arrays.values())))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return BarView(self.columns, i)
+
+    def __iter__(self):
+        columns = self.columns
+        for i in range(len(self)):
+            yield BarView(columns, i)
+
+    def sort_by(self, field):
+        """New batch sorted by field, keeping the order of equal values."""
+        idx = np.argsort(self.arrays[field], kind='mergesort')
+        return BarBatch({name: values[idx] for name, values in self.arrays.items()})
@@ -0,0 +1,526 @@
+# encoding: utf-8
+"""
+Vectorized group-wise cross-section operators.
+
+Values are (date x symbol) DataFrames. Groups (e.g. industry classification)
+can vary over time: every (date, group) pair is an independent group, encoded
+as one integer key per element, so each operator is a few passes of
+np.bincount / np.argsort over the whole panel instead of a loop over dates.
+
+Missing values and elements without group (NaN in group) do not take part in
+any group, and results at those elements are NaN. The same holds for elements
+outside an optional universe mask (e.g. index_member), so statistics of a
+cross-section are computed on the universe only.
+
+Without group, sorting is done row by row on the 2-D array, which is much
+faster than sorting the whole panel by key.
+
+"""
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri
+
+
+# -----------------------------------------------------
+# keys
+def _group_codes(df, group):
+    """
+    Integer code of group of each element of df, -1 if missing.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+        DataFrame of the same labels as df (time-varying), Series indexed by symbol (fixed),
+        or None (all symbols in one group).
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of df.shape.
+
+    """
+    shape = df.shape
+    if group is None:
+        return np.zeros(shape, dtype=np.int64)
+
+    if isinstance(group, pd.DataFrame) and group.shape[0] == 1:
+        group = group.iloc[0]
+    if isinstance(group, pd.DataFrame):
+        group = group.reindex(index=df.index, columns=df.columns)
+        codes, _ = pd.factorize(group.values.ravel())
+        return codes.reshape(shape).astype(np.int64)
+    elif isinstance(group, pd.Series):
+        group = group.reindex(index=df.columns)
+        codes, _ = pd.factorize(group.values)
+        return np.tile(codes.astype(np.int64), (shape[0], 1))
+    else:
+        raise NotImplementedError("type of group {}".format(type(group)))
+
+
+def _universe_mask(df, mask):
+    """
+    Whether each element of df is in universe, None if no mask.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    mask : pd.DataFrame or pd.Series or None
+        Non-zero (e.g. index_member == 1 or True) means in universe, missing means not.
+        DataFrame of the same labels as df (time-varying) or Series indexed by symbol (fixed).
+
+    Returns
+    -------
+    np.ndarray or None
+        bool array of df.shape.
+
+    """
+    if mask is None:
+        return None
+    if isinstance(mask, pd.DataFrame):
+        arr = mask.reindex(index=df.index, columns=df.columns).values
+    elif isinstance(mask, pd.Series):
+        arr = np.tile(mask.reindex(index=df.columns).values, (df.shape[0], 1))
+    else:
+        raise NotImplementedError("type of mask {}".format(type(mask)))
+    arr = np.asarray(arr, dtype=float)
+    return (arr != 0) & ~np.isnan(arr)
+
+
+class _Groups(object):
+    """
+    Valid elements of a panel and their (date, group) keys.
+
+    Attributes
+    ----------
+    shape : tuple
+    idx : np.ndarray
+        Flat positions of valid elements.
+    keys : np.ndarray
+        Dense key of each valid element, 0 <= key < n_keys.
+    values : np.ndarray
+        Float values of valid elements.
+    n_keys : int
+    by_row : bool
+        Whether groups are rows (no group), then keys are in the order of rows.
+
+    """
+    def __init__(self, df, group=None, mask=None):
+        arr = np.asarray(df.values, dtype=float)
+        self.shape = arr.shape
+        self.by_row = group is None
+
+        flat_values = arr.ravel()
+        valid = ~np.isnan(flat_values)
+        universe = _universe_mask(df, mask)
+        if universe is not None:
+            valid &= universe.ravel()
+        self._count = None
+
+        if self.by_row:
+            # valid elements are in the order of rows, keys are dense row numbers
+            n_valid = valid.reshape(self.shape).sum(axis=1)
+            is_used = n_valid > 0
+            self.idx = np.flatnonzero(valid)
+            self.keys = np.repeat(np.cumsum(is_used) - 1, n_valid)
+            self.n_keys = int(is_used.sum())
+            self.values = flat_values[self.idx]
+            self._n_valid = n_valid
+            self._count = n_valid[is_used].astype(float)
+            return
+
+        codes = _group_codes(df, group)
+        n_groups = max(codes.max() + 1, 1) if codes.size else 1
+        flat_codes = codes.ravel()
+        valid &= flat_codes >= 0
+
+        self.idx = np.flatnonzero(valid)
+        rows = self.idx // self.shape[1]
+        keys = rows * n_groups + flat_codes[self.idx]
+        # dense keys keep bincount small when few groups are used on each date
+        is_used = np.bincount(keys, minlength=self.shape[0] * n_groups) > 0
+        dense = np.cumsum(is_used) - 1
+        self.keys = dense[keys]
+        self.n_keys = int(is_used.sum())
+        self.values = flat_values[self.idx]
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = np.bincount(self.keys, minlength=self.n_keys).astype(float)
+        return self._count
+
+    def sum(self, values=None):
+        if values is None:
+            values = self.values
+        if self.by_row and self.n_keys:
+            # valid elements of each row are contiguous
+            count = self.count.astype(np.int64)
+            return np.add.reduceat(values, np.cumsum(count) - count)
+        return np.bincount(self.keys, weights=values, minlength=self.n_keys)
+
+    def broadcast(self, stats):
+        """Statistic of each group to each valid element."""
+        if self.by_row:
+            return np.repeat(stats, self.count.astype(np.int64))
+        return stats[self.keys]
+
+    def mean(self):
+        return self.sum() / self.count
+
+    def std(self, ddof=1):
+        """Standard deviation of each group, two-pass for accuracy."""
+        diff = self.values - self.broadcast(self.mean())
+        var = self.sum(diff * diff) / (self.count - ddof)
+        var[self.count <= ddof] = np.nan
+        return np.sqrt(var)
+
+    def _to_rows(self, values):
+        """Valid values put back on the 2-D array, NaN elsewhere."""
+        arr = np.full(self.shape[0] * self.shape[1], np.nan)
+        arr[self.idx] = values
+        return arr.reshape(self.shape)
+
+    def _is_sorted_valid(self):
+        """Elements of rows sorted with NaN last which are valid values, in the order of self.values."""
+        return np.arange(self.shape[1]) < self._n_valid[:, np.newaxis]
+
+    def sort(self, values):
+        """Order of valid elements sorted by key, then by values; and start position of the group of each sorted element."""
+        # stable sort by keys after sorting by values, much faster than np.lexsort
+        order = np.argsort(values)
+        order = order[np.argsort(self.keys[order], kind='mergesort')]
+        # sorted keys are 0, ..., n_keys - 1 in turn, each repeated count times
+        count = self.count.astype(np.int64)
+        group_start = np.cumsum(count) - count
+        is_first = np.zeros(len(order), dtype=bool)
+        is_first[group_start] = True
+        return order, np.repeat(group_start, count), is_first
+
+    def sorted_values(self, values=None):
+        """Values of valid elements sorted by key, then by values."""
+        if values is None:
+            values = self.values
+        if self.by_row:
+            # sorting values is much faster than sorting their order
+            return np.sort(self._to_rows(values), axis=1)[self._is_sorted_valid()]
+        order, _, _ = self.sort(values)
+        return values[order]
+
+    def quantile(self, q, values=None):
+        """Quantile of each group, linear interpolation between sorted values as pandas."""
+        sorted_values = self.sorted_values(values)
+        count = self.count.astype(np.int64)
+        group_start = np.cumsum(count) - count
+        pos = q * (count - 1)
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.minimum(lower + 1, count - 1)
+        frac = pos - lower
+        return (sorted_values[group_start + lower] * (1.0 - frac)
+                + sorted_values[group_start + upper] * frac)
+
+    def median(self, values=None):
+        """Median of each group."""
+        return self.quantile(0.5, values)
+
+    def to_frame(self, values, df):
+        """Put values of valid elements back to a DataFrame like df, NaN elsewhere."""
+        res = np.full(self.shape[0] * self.shape[1], np.nan)
+        res[self.idx] = values
+        return pd.DataFrame(res.reshape(self.shape), index=df.index, columns=df.columns)
+
+
+# -----------------------------------------------------
+# operators
+def _average_position(sorted_values, is_first, start):
+    """Position (starting from 1) of sorted values in their group, equal values share their average position."""
+    is_tie_first = is_first.copy()
+    is_tie_first[1:] |= sorted_values[1:] != sorted_values[:-1]
+    tie_start = np.flatnonzero(is_tie_first)
+    tie_end = np.append(tie_start[1:], len(sorted_values))
+    avg = (tie_start + tie_end + 1) / 2.0 - start[tie_start]
+    return np.repeat(avg, tie_end - tie_start)
+
+
+def _average_rank(g):
+    """Rank of valid elements (starting from 1, ties get average rank) within their group."""
+    if g.by_row:
+        # rank on the 2-D array, NaN are sorted last in each row and their ranks dropped
+        n_rows, n_cols = g.shape
+        arr = g._to_rows(g.values)
+        flat = (np.argsort(arr, axis=1) + (np.arange(n_rows) * n_cols)[:, np.newaxis]).ravel()
+        is_first = np.arange(len(flat)) % n_cols == 0
+        start = np.repeat(np.arange(n_rows) * n_cols, n_cols)
+        res = np.empty(len(flat))
+        res[flat] = _average_position(arr.ravel()[flat], is_first, start)
+        return res[g.idx]
+
+    order, start, is_first = g.sort(g.values)
+    res = np.empty(len(order))
+    res[order] = _average_position(g.values[order], is_first, start)
+    return res
+
+
+def group_rank(df, group=None, mask=None):
+    """
+    Rank (starting from 1, ties get average rank) within each group on each date.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+    mask : pd.DataFrame or pd.Series or None
+        Universe, see _universe_mask.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    g = _Groups(df, group, mask)
+    return g.to_frame(_average_rank(g), df)
+
+
+def group_mean(df, group=None):
+    """Mean of each group on each date, broadcast to its members."""
+    g = _Groups(df, group)
+    return g.to_frame(g.broadcast(g.mean()), df)
+
+
+def group_std(df, group=None, ddof=1):
+    """Standard deviation of each group on each date, broadcast to its members."""
+    g = _Groups(df, group)
+    return g.to_frame(g.broadcast(g.std(ddof=ddof)), df)
+
+
+def group_neutralize(df, group=None):
+    """Subtract mean of each group on each date."""
+    g = _Groups(df, group)
+    return g.to_frame(g.values - g.broadcast(g.mean()), df)
+
+
+def group_standardize(df, group=None):
+    """Z-score within each group on each date: (x - mean) / std, std with ddof=1."""
+    return zscore(df, group)
+
+
+def group_cutoff(df, group=None, z_score=3.0):
+    """Clip values to median +- z_score * MAD within each group on each date, see winsorize_mad."""
+    return winsorize_mad(df, group, z_score)
+
+
+# -----------------------------------------------------
+# preprocessing of factor values on each cross-section
+def zscore(df, group=None, mask=None):
+    """
+    (x - mean) / std within each group on each date, std with ddof=1.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+    mask : pd.DataFrame or pd.Series or None
+        Universe, e.g. index_member. Elements outside are NaN and not in mean / std.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    g = _Groups(df, group, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = (g.values - g.broadcast(g.mean())) / g.broadcast(g.std())
+    return g.to_frame(res, df)
+
+
+def winsorize_mad(df, group=None, z_score=3.0, mask=None):
+    """
+    Clip values to median +- z_score * MAD (median absolute deviation) within each group on each date.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+    z_score : float
+    mask : pd.DataFrame or pd.Series or None
+        Universe, e.g. index_member. Elements outside are NaN and not in medians.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    g = _Groups(df, group, mask)
+    median = g.broadcast(g.median())
+    diff = g.values - median
+    mad = g.broadcast(g.median(np.abs(diff)))
+    bound = z_score * mad
+    res = np.where(np.abs(diff) > bound, median + bound * np.sign(diff), g.values)
+    return g.to_frame(res, df)
+
+
+def quantile_clip(df, group=None, lower=0.01, upper=0.99, mask=None):
+    """
+    Clip values to [lower quantile, upper quantile] within each group on each date.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+    lower, upper : float
+        Quantiles in [0, 1], linear interpolation between values as pandas.
+    mask : pd.DataFrame or pd.Series or None
+        Universe, e.g. index_member. Elements outside are NaN and not in quantiles.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    g = _Groups(df, group, mask)
+    res = np.clip(g.values, g.broadcast(g.quantile(lower)), g.broadcast(g.quantile(upper)))
+    return g.to_frame(res, df)
+
+
+def rank_gauss(df, group=None, mask=None):
+    """
+    Map ranks within each group on each date to quantiles of standard normal distribution:
+    norm.ppf((rank - 0.5) / count). Ties get the average rank.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    group : pd.DataFrame or pd.Series or None
+    mask : pd.DataFrame or pd.Series or None
+        Universe, e.g. index_member. Elements outside are NaN and not ranked.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    g = _Groups(df, group, mask)
+    res = ndtri((_average_rank(g) - 0.5) / g.broadcast(g.count))
+    return g.to_frame(res, df)
+
+
+def neutralize(df, exposures=(), group=None):
+    """
+    Residual of cross-section regression of df on group dummies and exposures, on each date.
+
+    With exposures = (), same as group_neutralize. Otherwise (Frisch-Waugh) df and
+    exposures are demeaned within each (date, group), then all dates are solved at once
+    as a batch of k x k normal equations, k = number of exposures.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    exposures : list of pd.DataFrame
+        e.g. logarithm of market value. Elements where any exposure is missing are excluded.
+    group : pd.DataFrame or pd.Series or None
+        e.g. industry. If None, only the market mean (intercept) is removed.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    exposures = [x.reindex(index=df.index, columns=df.columns) for x in exposures]
+    arr = np.asarray(df.values, dtype=float)
+    for x in exposures:
+        arr = np.where(np.isnan(np.asarray(x.values, dtype=float)), np.nan, arr)
+    g = _Groups(pd.DataFrame(arr, index=df.index, columns=df.columns), group)
+
+    def demean(values):
+        return values - g.broadcast(g.sum(values) / g.count)
+
+    y = demean(g.values)
+    if not exposures:
+        return g.to_frame(y, df)
+
+    k = len(exposures)
+    xs = [demean(np.asarray(x.values, dtype=float).ravel()[g.idx]) for x in exposures]
+    rows = g.idx // g.shape[1]
+    n_dates = g.shape[0]
+
+    # normal equations of each date: xtx[date] * beta[date] = xty[date]
+    xtx = np.empty((n_dates, k, k))
+    xty = np.empty((n_dates, k))
+    for i in range(k):
+        xty[:, i] = np.bincount(rows, weights=xs[i] * y, minlength=n_dates)
+        for j in range(i, k):
+            xtx[:, i, j] = xtx[:, j, i] = np.bincount(rows, weights=xs[i] * xs[j], minlength=n_dates)
+
+    beta = np.full((n_dates, k), np.nan)
+    # dates with too few elements or collinear exposures have no solution
+    diag = xtx[:, np.arange(k), np.arange(k)]
+    solvable = (diag > 0).all(axis=1)
+    if solvable.any():
+        # determinant of the correlation matrix of exposures
+        solvable[solvable] = np.linalg.det(xtx[solvable]) / diag[solvable].prod(axis=1) > 1e-10
+    if solvable.any():
+        beta[solvable] = np.linalg.solve(xtx[solvable], xty[solvable][:, :, np.newaxis])[:, :, 0]
+
+    res = y - sum(beta[rows, i] * xs[i] for i in range(k))
+    return g.to_frame(res, df)
+
+
+def benchmark(n_dates=250, n_symbols=3000, nan_ratio=0.05, n_repeat=3, seed=0):
+    """
+    Compare preprocessing kernels with NaN-aware pandas equivalents on (n_dates x n_symbols) cross-sections.
+
+    Returns
+    -------
+    pd.DataFrame
+        Best seconds of n_repeat runs of pandas and kernel, and speedup of each operator.
+
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.standard_t(3, size=(n_dates, n_symbols))
+    data[rs.rand(n_dates, n_symbols) < nan_ratio] = np.nan
+    df = pd.DataFrame(data)
+
+    def pandas_mad(x, z_score=3.0):
+        median = x.median(axis=1)
+        diff = x.sub(median, axis=0)
+        bound = diff.abs().median(axis=1) * z_score
+        return x.clip(lower=median - bound, upper=median + bound, axis=0)
+
+    def pandas_zscore(x):
+        return x.sub(x.mean(axis=1), axis=0).div(x.std(axis=1), axis=0)
+
+    def pandas_quantile_clip(x, lower=0.01, upper=0.99):
+        return x.clip(lower=x.quantile(lower, axis=1), upper=x.quantile(upper, axis=1), axis=0)
+
+    def pandas_rank_gauss(x):
+        return pd.DataFrame(ndtri((x.rank(axis=1) - 0.5).div(x.count(axis=1), axis=0).values),
+                            index=x.index, columns=x.columns)
+
+    cases = [('Cutoff', pandas_mad, winsorize_mad),
+             ('Standardize', pandas_zscore, zscore),
+             ('QuantileClip', pandas_quantile_clip, quantile_clip),
+             ('RankGauss', pandas_rank_gauss, rank_gauss)]
+
+    def best_time(func):
+        times = []
+        for _ in range(n_repeat):
+            t0 = time.time()
+            res = func(df)
+            times.append(time.time() - t0)
+        return min(times), res
+
+    rows = []
+    for name, func_pandas, func_kernel in cases:
+        t_pandas, expected = best_time(func_pandas)
+        t_kernel, res = best_time(func_kernel)
+        assert np.allclose(res.values, expected.values, equal_nan=True)
+        rows.append((name, t_pandas, t_kernel))
+    res = pd.DataFrame(rows, columns=['operator', 'pandas', 'kernel']).set_index('operator')
+    res['speedup'] = res['pandas'] / res['kernel']
+    return res
+
+
+if __name__ == "__main__":
+    print(benchmark())
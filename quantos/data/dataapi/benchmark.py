@@ -0,0 +1,180 @@
+# encoding: utf-8
+"""
+Load and latency benchmark of DataApi against a local MockDataServer.
+
+Usage:
+    python -m quantos.data.dataapi.benchmark
+
+"""
+import time
+
+import numpy as np
+
+from data_api import DataApi
+from mock_server import MockDataServer
+
+
+def _summary(name, latencies, elapsed, n_bytes):
+    """Format one line of calls/sec, p50/p99 latency (ms) and MB/s."""
+    lat = np.asarray(latencies) * 1000.0
+    n = len(lat)
+    return {'name': name,
+            'calls': n,
+            'calls_per_sec': n / elapsed if elapsed > 0 else np.nan,
+            'p50_ms': np.percentile(lat, 50) if n else np.nan,
+            'p99_ms': np.percentile(lat, 99) if n else np.nan,
+            'mb_per_sec': n_bytes / 1024.0 / 1024.0 / elapsed if elapsed > 0 else np.nan}
+
+
+def bench_calls(api, server, name, func, n_calls):
+    """
+    Call func(api) n_calls times sequentially and measure it.
+
+    Parameters
+    ----------
+    api : DataApi
+    server : MockDataServer
+        Used to count bytes sent over the wire.
+    name : str
+    func : callable
+        func(api) -> (result, msg)
+    n_calls : int
+
+    Returns
+    -------
+    dict
+
+    """
+    latencies = []
+    bytes_start = server.stats['bytes_out']
+    t_start = time.time()
+    for _ in range(n_calls):
+        t0 = time.time()
+        res, msg = func(api)
+        latencies.append(time.time() - t0)
+        if msg != '0,':
+            raise RuntimeError("{:s} failed: {}".format(name, msg))
+    elapsed = time.time() - t_start
+    return _summary(name, latencies, elapsed, server.stats['bytes_out'] - bytes_start)
+
+
+def bench_quote_push(api, server, symbols, duration=3.0):
+    """Subscribe symbols and measure the rate of received quote pushes."""
+    received = []
+
+    def on_callback(type_, data):
+        if type_ == 'quote':
+            received.append(time.time())
+
+    api.set_callback(on_callback)
+    bytes_start = server.stats['bytes_out']
+    api.subscribe(','.join(symbols))
+    t_start = time.time()
+    time.sleep(duration)
+    elapsed = time.time() - t_start
+    api.set_callback(None)
+    res = _summary('jsq.quote_ind push', [], elapsed, server.stats['bytes_out'] - bytes_start)
+    res['calls'] = len(received)
+    res['calls_per_sec'] = len(received) / elapsed
+    return res
+
+
+def bench_reconnect(api, server, timeout=20.0):
+    """
+    Restart the server and measure how long DataApi takes to log in again.
+
+    Returns
+    -------
+    float
+        Seconds from server restart to a successful call, NaN if timeout.
+
+    """
+    server.stop()
+    # wait for the client to notice heartbeat timeout
+    t0 = time.time()
+    while api._connected and time.time() - t0 < timeout:
+        time.sleep(0.05)
+
+    server.start()
+    t_start = time.time()
+    while time.time() - t_start < timeout:
+        res, msg = api.daily("600030.SH", 20170103, 20170110)
+        if msg == '0,':
+            return time.time() - t_start
+        time.sleep(0.05)
+    return np.nan
+
+
+def run_benchmark(addr="tcp://127.0.0.1:18910", n_calls=100, n_symbols=300, latency=0.0, quote_rate=10.0,
+                  reconnect=True):
+    """
+    Start a MockDataServer, run every scenario through DataApi and print the results.
+
+    Parameters
+    ----------
+    addr : str
+    n_calls : int
+        Number of calls in each request / response scenario.
+    n_symbols : int
+        Number of symbols in the large payload scenarios.
+    latency : float
+        Server side reply latency in seconds.
+    quote_rate : float
+        Quote pushes per second per symbol.
+    reconnect : bool
+        Whether to measure reconnection time, which restarts the server.
+
+    Returns
+    -------
+    list of dict
+
+    """
+    server = MockDataServer(addr, latency=latency, quote_rate=quote_rate)
+    server.start()
+
+    api = DataApi(addr)
+    api.set_timeout(60)
+    r, msg = api.login("bench", "bench")
+    if not r:
+        raise RuntimeError("login failed: {}".format(msg))
+
+    symbols = ['{:06d}.SZ'.format(i + 1) for i in range(n_symbols)]
+    symbols_str = ','.join(symbols)
+
+    scenarios = [('jsd.query 1 symbol 1 month',
+                  lambda a: a.daily("600030.SH", 20170103, 20170131), n_calls),
+                 ('jsd.query {:d} symbols 1 year'.format(n_symbols),
+                  lambda a: a.daily(symbols_str, 20170103, 20171229, fields="open,high,low,close,volume"),
+                  max(1, n_calls // 20)),
+                 ('jsi.query 1 symbol 1 day',
+                  lambda a: a.bar("600030.SH", trade_date=20170904), n_calls),
+                 ('jsi.query {:d} symbols 1 day'.format(n_symbols),
+                  lambda a: a.bar(symbols_str, trade_date=20170904), max(1, n_calls // 20)),
+                 ('jset.query {:d} symbols'.format(n_symbols),
+                  lambda a: a.query("lb.secDailyIndicator", fields="pb,pe,total_mv",
+                                    filter="symbol={:s}&start_date=20170103&end_date=20170131".format(symbols_str)),
+                  max(1, n_calls // 20)),
+                 ('jsq.query 1 symbol',
+                  lambda a: a.quote("600030.SH"), n_calls)]
+
+    results = []
+    try:
+        for name, func, n in scenarios:
+            results.append(bench_calls(api, server, name, func, n))
+        results.append(bench_quote_push(api, server, symbols[:10]))
+        if reconnect:
+            t = bench_reconnect(api, server)
+            print("reconnect and login: {:.2f} s".format(t))
+    finally:
+        api.close()
+        server.stop()
+
+    print("{:40s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format('scenario', 'calls', 'calls/s',
+                                                                  'p50 ms', 'p99 ms', 'MB/s'))
+    for r in results:
+        print("{name:40s} {calls:8d} {calls_per_sec:10.1f} {p50_ms:10.2f} {p99_ms:10.2f} {mb_per_sec:10.2f}".format(**r))
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -119,18 +119,18 @@ class DataApi:
         The original quote_ind contains field index instead of field name!
         """
         
-        if quote_ind != self._schema_id:
+        if quote_ind['schema_id'] != self._schema_id:
             return None
 
-        indicators = quote_ind.indicators
-        values     = quote_ind.values
+        indicators = quote_ind['indicators']
+        values     = quote_ind['values']
 
         max_index = len(self._schema)
 
         quote = {}
         for i in xrange(len(indicators)):
             if indicators[i] < max_index: 
-                quote[self._schema[indicators[i]].name] = values[i]
+                quote[self._schema[indicators[i]]['name']] = values[i]
             else:
                 quote[str(indicators[i])] =  values[i]
 
@@ -371,7 +371,7 @@ class DataApi:
                                **kwargs)
 
     def set_heartbeat(self, interval, timeout):
-        self._remote.set_hearbeat_options(interval, timeout)
+        self._remote.set_heartbeat_options(interval, timeout)
 
     def set_timeout(self, timeout):
         self._timeout = timeout
@@ -132,6 +132,13 @@ class JRpcClient :
             except Exception, e:
                 print("_recv_run:", e)
 
+        # release sockets so that the context can be terminated at exit
+        if remote_sock:
+            remote_sock.close()
+        self._pull_sock.close(linger=0)
+        self._push_sock.close(linger=0)
+        self._ctx.term()
+
     def _callback_run(self):
         while not self._should_close:
             try:
@@ -0,0 +1,519 @@
+# encoding: utf-8
+"""
+A local stand-in for the remote data server.
+
+MockDataServer speaks the same msgpack / snappy framed JSON-RPC protocol as the
+remote service (see jrpc_py._pack and jrpc_py._unpack), so DataApi and
+JRpcClient can be exercised offline: throughput, latency, reconnection and
+decoding of large payloads.
+
+Supported methods:
+    .sys.heartbeat, auth.login, auth.logout, jsd.query, jsi.query, jsi.bar_view,
+    jsq.query, jset.query, jsq.subscribe (followed by jsq.quote_ind pushes).
+
+Data is synthetic (deterministic for a given symbol and date) unless recorded
+results are registered with add_recorded, or a method is overridden by
+register_handler.
+
+"""
+import heapq
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+import zmq
+
+import jrpc_py
+
+
+class MockRpcError(Exception):
+    """Raise in a handler to reply with an error instead of a result."""
+    def __init__(self, code, message):
+        super(MockRpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _seed(*args):
+    """Stable seed (unlike hash, which is randomized for str in Python 3)."""
+    s = '|'.join([str(a) for a in args])
+    return zlib.crc32(s.encode('utf-8')) & 0xffffffff
+
+
+def _columnset(data):
+    """Convert a pd.DataFrame or a dict of arrays to the {column: list} layout used by the server."""
+    if isinstance(data, pd.DataFrame):
+        data = dict([(col, data[col].values) for col in data.columns])
+    return dict([(str(k), np.asarray(v).tolist()) for k, v in data.items()])
+
+
+def _concat(dics, columns):
+    """Concatenate dicts of arrays column-wise."""
+    if not dics:
+        return dict([(col, np.array([])) for col in columns])
+    return dict([(col, np.concatenate([dic[col] for dic in dics])) for col in columns])
+
+
+def _parse_filter(filter_str):
+    """Parse 'k1=v1&k2=v2' to a dict."""
+    res = dict()
+    for item in filter_str.split('&'):
+        if '=' in item:
+            k, v = item.split('=', 1)
+            res[k.strip()] = v.strip()
+    return res
+
+
+def _split(s):
+    return [x.strip() for x in str(s).split(',') if x.strip()]
+
+
+def _select_fields(dic, fields, default_fields):
+    """Keep requested fields (default_fields if empty) in requested order. Unknown fields are ignored."""
+    fields = _split(fields) if fields else default_fields
+    return dict([(f, dic[f]) for f in fields if f in dic])
+
+
+class MockDataServer(object):
+    """
+    ZeroMQ ROUTER server mimicking the remote data service.
+
+    Attributes
+    ----------
+    addr : str
+        Address to bind, e.g. "tcp://127.0.0.1:8910".
+    latency : float
+        Seconds added before each reply is sent. Replies are delayed without
+        blocking the server, so concurrent requests overlap like a real server.
+    quote_rate : float
+        Number of jsq.quote_ind pushes per second for each subscribed symbol.
+    users : dict or None
+        {username: password}. If None, any credentials are accepted.
+    stats : dict
+        Counters of requests, pushes and bytes received / sent.
+
+    """
+    # weekdays within this range are used as trade dates
+    START_DATE = 20000103
+    END_DATE = 20301231
+    DAILY_FIELDS = ['symbol', 'code', 'trade_date', 'open', 'high', 'low', 'close', 'volume', 'turnover', 'vwap',
+                    'oi', 'settle', 'trade_status']
+    BAR_FIELDS = ['symbol', 'code', 'date', 'time', 'trade_date', 'freq', 'open', 'high', 'low', 'close',
+                  'volume', 'turnover', 'vwap', 'oi', 'settle']
+    QUOTE_FIELDS = ['symbol', 'date', 'time', 'open', 'high', 'low', 'last', 'volume', 'turnover',
+                    'bidprice1', 'askprice1', 'bidvolume1', 'askvolume1']
+
+    def __init__(self, addr="tcp://127.0.0.1:8910", latency=0.0, quote_rate=1.0, users=None):
+        self.addr = addr
+        self.latency = latency
+        self.quote_rate = quote_rate
+        self.users = users
+
+        self.stats = dict()
+        self.reset_stats()
+
+        self._handlers = {'.sys.heartbeat': self._on_heartbeat,
+                          'auth.login': self._on_login,
+                          'auth.logout': self._on_logout,
+                          'jsd.query': self._on_daily,
+                          'jsi.query': self._on_bar,
+                          'jsi.bar_view': self._on_bar,
+                          'jsq.query': self._on_quote,
+                          'jset.query': self._on_query,
+                          'jsq.subscribe': self._on_subscribe}
+        self._recorded = []
+
+        dates = pd.bdate_range(str(self.START_DATE), str(self.END_DATE))
+        self._dates = (dates.year * 10000 + dates.month * 100 + dates.day).values.astype(np.int64)
+        bar_times = pd.date_range('09:31', '11:30', freq='1min').append(pd.date_range('13:01', '15:00', freq='1min'))
+        self._bar_times = (bar_times.hour * 10000 + bar_times.minute * 100).values.astype(np.int64)
+        self._history = dict()
+
+        # per client identity
+        self._sessions = dict()
+        self._subscriptions = dict()
+
+        self._delayed = []
+        self._seq = 0
+        self._last_push_time = 0.0
+
+        self._should_close = False
+        self._thread = None
+        self._ready = threading.Event()
+
+    # -------------------------------------------------------------------------------------------
+    # Public interface
+    def start(self):
+        """Bind and serve in a background thread."""
+        self._should_close = False
+        self._ready.clear()
+        self._sessions = dict()
+        self._subscriptions = dict()
+        self._delayed = []
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self):
+        """Stop serving and unbind. Connected clients will see heartbeat timeouts."""
+        self._should_close = True
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def reset_stats(self):
+        self.stats.update({'requests': 0,
+                           'pushes': 0,
+                           'bytes_in': 0,
+                           'bytes_out': 0,
+                           'methods': dict()})
+
+    def register_handler(self, method, func):
+        """
+        Serve method by func(params, identity) which returns the result.
+
+        Raise MockRpcError in func to reply with an error.
+
+        """
+        self._handlers[method] = func
+
+    def add_recorded(self, method, result, **match):
+        """
+        Serve a recorded result for method when request params contain match.
+
+        Parameters
+        ----------
+        method : str
+            e.g. 'jset.query'
+        result : pd.DataFrame or dict
+            DataFrames are converted to {column: list}.
+        match : dict
+            Params the request must have, e.g. view='lb.income'.
+            For jset.query, keys of the filter string can be matched as well.
+
+        """
+        if isinstance(result, pd.DataFrame):
+            result = _columnset(result)
+        self._recorded.append((method, match, result))
+
+    # -------------------------------------------------------------------------------------------
+    # Server loop
+    def _run(self):
+        ctx = zmq.Context()
+        sock = ctx.socket(zmq.ROUTER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind(self.addr)
+        self._ready.set()
+
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+
+        try:
+            while not self._should_close:
+                # wake up in time for delayed replies and quote pushes
+                wake_time = time.time() + 0.1
+                if self._delayed:
+                    wake_time = min(wake_time, self._delayed[0][0])
+                if self._subscriptions and self.quote_rate > 0:
+                    wake_time = min(wake_time, self._last_push_time + 1.0 / self.quote_rate)
+                timeout = max(0, int((wake_time - time.time()) * 1000))
+
+                socks = dict(poller.poll(timeout))
+                if sock in socks:
+                    # drain everything available before doing periodic work
+                    while True:
+                        try:
+                            frames = sock.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                        self._on_request(sock, frames[0], frames[-1])
+
+                self._send_due(sock)
+                self._push_quotes(sock)
+        finally:
+            sock.close()
+            ctx.term()
+
+    def _send(self, sock, identity, msg):
+        data = jrpc_py._pack(msg)
+        self.stats['bytes_out'] += len(data)
+        if self.latency > 0:
+            self._seq += 1
+            heapq.heappush(self._delayed, (time.time() + self.latency, self._seq, identity, data))
+        else:
+            sock.send_multipart([identity, data])
+
+    def _send_due(self, sock):
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, identity, data = heapq.heappop(self._delayed)
+            sock.send_multipart([identity, data])
+
+    def _on_request(self, sock, identity, data):
+        self.stats['requests'] += 1
+        self.stats['bytes_in'] += len(data)
+
+        msg = jrpc_py._unpack(data)
+        if not msg or 'method' not in msg:
+            return
+        method = msg['method']
+        params = msg.get('params', None) or dict()
+        self.stats['methods'][method] = self.stats['methods'].get(method, 0) + 1
+
+        rsp = {'jsonrpc': '2.0', 'method': method, 'id': msg.get('id', None)}
+        try:
+            if method not in ('.sys.heartbeat', 'auth.login') and identity not in self._sessions:
+                raise MockRpcError(-1, "no login session")
+
+            result = self._find_recorded(method, params)
+            if result is None:
+                handler = self._handlers.get(method, None)
+                if handler is None:
+                    raise MockRpcError(-1, "unknown method: {:s}".format(method))
+                result = handler(params, identity)
+
+            rsp['result'] = result
+            rsp['error'] = {'error': 0, 'message': ""}
+        except MockRpcError as e:
+            rsp['error'] = {'error': e.code, 'message': e.message}
+        except Exception as e:
+            rsp['error'] = {'error': -1, 'message': "{}: {}".format(type(e).__name__, e)}
+
+        self._send(sock, identity, rsp)
+
+    def _find_recorded(self, method, params):
+        for method_, match, result in self._recorded:
+            if method_ != method:
+                continue
+            available = dict(params)
+            available.update(_parse_filter(params.get('filter', "") or ""))
+            if all(str(available.get(k, None)) == str(v) for k, v in match.items()):
+                return result
+        return None
+
+    def _push_quotes(self, sock):
+        if not self._subscriptions or self.quote_rate <= 0:
+            return
+        now = time.time()
+        if now - self._last_push_time < 1.0 / self.quote_rate:
+            return
+        self._last_push_time = now
+
+        indicators = list(range(len(self.QUOTE_FIELDS)))
+        for identity, (schema_id, symbols) in list(self._subscriptions.items()):
+            quotes = self._make_quote(symbols)
+            for i in range(len(symbols)):
+                msg = {'jsonrpc': '2.0',
+                       'method': 'jsq.quote_ind',
+                       'result': {'schema_id': schema_id,
+                                  'indicators': indicators,
+                                  'values': [quotes[f][i] for f in self.QUOTE_FIELDS]}}
+                self._send(sock, identity, msg)
+                self.stats['pushes'] += 1
+
+    # -------------------------------------------------------------------------------------------
+    # Synthetic data
+    def _get_history(self, symbol):
+        """Daily prices of symbol over all dates, generated once by a random walk seeded by symbol."""
+        dic = self._history.get(symbol, None)
+        if dic is not None:
+            return dic
+
+        rs = np.random.RandomState(_seed(symbol))
+        n = len(self._dates)
+        base = 5.0 + 95.0 * rs.rand()
+        close = base * np.exp(np.cumsum(rs.randn(n) * 0.02))
+        pre_close = np.r_[close[:1], close[:-1]]
+        open_ = pre_close * (1 + rs.randn(n) * 0.005)
+        high = np.maximum(open_, close) * (1 + np.abs(rs.randn(n)) * 0.005)
+        low = np.minimum(open_, close) * (1 - np.abs(rs.randn(n)) * 0.005)
+        volume = np.floor(rs.rand(n) * 1e7)
+        vwap = (open_ + high + low + close) / 4.0
+        dic = {'open': open_, 'high': high, 'low': low, 'close': close, 'volume': volume, 'vwap': vwap,
+               'turnover': volume * vwap}
+        self._history[symbol] = dic
+        return dic
+
+    def _date_slice(self, begin_date, end_date):
+        return slice(np.searchsorted(self._dates, int(begin_date), side='left'),
+                     np.searchsorted(self._dates, int(end_date), side='right'))
+
+    def _make_daily(self, symbol, begin_date, end_date):
+        sl = self._date_slice(begin_date, end_date)
+        his = self._get_history(symbol)
+        dates = self._dates[sl]
+        n = len(dates)
+
+        dic = dict([(k, v[sl]) for k, v in his.items()])
+        dic['last'] = dic['close']
+        dic['settle'] = dic['close']
+        dic['oi'] = np.zeros(n)
+        dic['trade_date'] = dates
+        dic['symbol'] = np.array([symbol] * n, dtype=object)
+        dic['code'] = np.array([symbol.split('.')[0]] * n, dtype=object)
+        dic['trade_status'] = np.array([u'交易'] * n, dtype=object)
+        return dic
+
+    def _make_bar(self, symbol, trade_date, begin_time, end_time, freq):
+        sl = self._date_slice(trade_date, trade_date)
+        if sl.start == sl.stop:
+            return _concat([], self.BAR_FIELDS)
+        his = self._get_history(symbol)
+        day_open, day_close, day_volume = his['open'][sl.start], his['close'][sl.start], his['volume'][sl.start]
+
+        step = {'1m': 1, '5m': 5, '15m': 15}.get(freq, 1)
+        times = self._bar_times[step - 1::step]
+        n = len(times)
+        rs = np.random.RandomState(_seed(symbol, trade_date))
+        # intraday path from open to close
+        walk = np.cumsum(rs.randn(n)) / np.sqrt(n)
+        walk = walk - np.linspace(0, walk[-1], n)
+        close = day_open + (day_close - day_open) * np.arange(1, n + 1) / n + walk * day_close * 0.002
+        open_ = np.r_[day_open, close[:-1]]
+        high = np.maximum(open_, close) * (1 + np.abs(rs.randn(n)) * 0.001)
+        low = np.minimum(open_, close) * (1 - np.abs(rs.randn(n)) * 0.001)
+        volume = np.floor(rs.rand(n) * day_volume * 2.0 / n)
+        vwap = (open_ + high + low + close) / 4.0
+
+        mask = (times >= begin_time) & (times <= end_time)
+        n = mask.sum()
+        dic = {'symbol': np.array([symbol] * n, dtype=object),
+               'code': np.array([symbol.split('.')[0]] * n, dtype=object),
+               'date': np.full(n, int(trade_date), dtype=np.int64),
+               'time': times[mask],
+               'trade_date': np.full(n, int(trade_date), dtype=np.int64),
+               'freq': np.array([freq] * n, dtype=object),
+               'open': open_[mask],
+               'high': high[mask],
+               'low': low[mask],
+               'close': close[mask],
+               'volume': volume[mask],
+               'turnover': (volume * vwap)[mask],
+               'vwap': vwap[mask],
+               'oi': np.zeros(n),
+               'settle': np.zeros(n)}
+        return dic
+
+    def _make_quote(self, symbols):
+        date = int(time.strftime('%Y%m%d'))
+        time_int = int(time.strftime('%H%M%S')) * 1000
+        idx = max(0, min(np.searchsorted(self._dates, date, side='right') - 1, len(self._dates) - 1))
+        n = len(symbols)
+
+        pre_close = np.array([self._get_history(s)['close'][idx] for s in symbols])
+        last = np.round(pre_close * (1 + np.random.randn(n) * 0.001), 2)
+        pre_close = np.round(pre_close, 2)
+        return {'symbol': list(symbols),
+                'date': [date] * n,
+                'time': [time_int] * n,
+                'open': pre_close.tolist(),
+                'high': np.maximum(last, pre_close).tolist(),
+                'low': np.minimum(last, pre_close).tolist(),
+                'last': last.tolist(),
+                'volume': np.floor(np.random.rand(n) * 1e6).astype(np.int64).tolist(),
+                'turnover': (last * 1e6).tolist(),
+                'bidprice1': (last - 0.01).tolist(),
+                'askprice1': (last + 0.01).tolist(),
+                'bidvolume1': np.floor(np.random.rand(n) * 1e4).astype(np.int64).tolist(),
+                'askvolume1': np.floor(np.random.rand(n) * 1e4).astype(np.int64).tolist()}
+
+    # -------------------------------------------------------------------------------------------
+    # Handlers
+    def _on_heartbeat(self, params, identity):
+        sub = self._subscriptions.get(identity, None)
+        sub_hash = self._sub_hash(sub[1]) if sub else ""
+        return {'time': time.time(), 'sub_hash': sub_hash}
+
+    def _on_login(self, params, identity):
+        username = params.get('username', "")
+        password = params.get('password', "")
+        if self.users is not None and self.users.get(username, None) != password:
+            raise MockRpcError(-1000, "wrong username or password")
+        self._sessions[identity] = username
+        return {'username': username, 'name': username}
+
+    def _on_logout(self, params, identity):
+        self._sessions.pop(identity, None)
+        self._subscriptions.pop(identity, None)
+        return True
+
+    def _on_daily(self, params, identity):
+        dics = [self._make_daily(symbol, params.get('begin_date', 0), params.get('end_date', 0))
+                for symbol in _split(params.get('symbol', ""))]
+        dic = _concat(dics, self.DAILY_FIELDS + ['last'])
+        return _columnset(_select_fields(dic, params.get('fields', ""), self.DAILY_FIELDS))
+
+    def _on_bar(self, params, identity):
+        trade_date = int(params.get('trade_date', 0)) or int(time.strftime('%Y%m%d'))
+        begin_time = int(params.get('begin_time', 200000))
+        end_time = int(params.get('end_time', 160000))
+        if begin_time > end_time:
+            # night session start, e.g. 200000, is before day session end
+            begin_time = 0
+        dics = [self._make_bar(symbol, trade_date, begin_time, end_time, params.get('freq', '1m'))
+                for symbol in _split(params.get('symbol', ""))]
+        dic = _concat(dics, self.BAR_FIELDS)
+        return _columnset(_select_fields(dic, params.get('fields', ""), self.BAR_FIELDS))
+
+    def _on_quote(self, params, identity):
+        dic = self._make_quote(_split(params.get('symbol', "")))
+        return _columnset(_select_fields(dic, params.get('fields', ""), self.QUOTE_FIELDS))
+
+    def _on_query(self, params, identity):
+        """Synthetic jset.query: one row per symbol, and per trade date if a date range is in filter."""
+        dic_filter = _parse_filter(params.get('filter', "") or "")
+        fields = _split(params.get('fields', "") or "")
+        view = params.get('view', "")
+
+        start_date = int(dic_filter.get('start_date', 0) or 0)
+        end_date = int(dic_filter.get('end_date', 0) or 0)
+        sl = self._date_slice(start_date, end_date) if start_date and end_date else None
+
+        if view == 'jz.secTradeCal':
+            return _columnset({'trade_date': self._dates[sl] if sl is not None else np.array([], dtype=np.int64)})
+
+        dics = []
+        for symbol in _split(dic_filter.get('symbol', "")) or ['']:
+            dates = self._dates[sl] if sl is not None else np.array([0], dtype=np.int64)
+            n = len(dates)
+            dic = {'symbol': np.array([symbol] * n, dtype=object)}
+            if sl is not None:
+                dic['trade_date'] = dates
+            for f in fields:
+                if f not in dic:
+                    # values of a (view, field, symbol) are fixed for each date
+                    rs = np.random.RandomState(_seed(view, f, symbol))
+                    values = rs.randn(len(self._dates))
+                    dic[f] = values[sl] if sl is not None else values[:1]
+            dics.append(dic)
+        columns = sorted(set.union(*[set(dic.keys()) for dic in dics]))
+        return _columnset(_concat(dics, columns))
+
+    def _on_subscribe(self, params, identity):
+        _, old = self._subscriptions.get(identity, (0, []))
+        symbols = sorted(set(old).union(_split(params.get('symbol', ""))))
+        schema_id = len(self.QUOTE_FIELDS)
+        self._subscriptions[identity] = (schema_id, symbols)
+        return {'schema_id': schema_id,
+                'schema': [{'id': i, 'name': name} for i, name in enumerate(self.QUOTE_FIELDS)],
+                'sub_hash': self._sub_hash(symbols),
+                'securities': symbols}
+
+    @staticmethod
+    def _sub_hash(symbols):
+        return str(_seed(','.join(symbols)))
+
+
+if __name__ == "__main__":
+    server = MockDataServer()
+    server.start()
+    print("MockDataServer serving at " + server.addr)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -15,7 +15,9 @@ import pandas as pd
 import quantos.util.fileio
 from quantos.util import dtutil
 from quantos.data.align import align
-from quantos.data.py_expression_eval import Parser
+from quantos.data.formula_dag import FormulaDAG
+from quantos.data.profiling import FormulaProfiler
+from quantos.data.pit import StatementVersions
 
 
 class DataView(object):
@@ -56,13 +58,19 @@ class DataView(object):
         self.meta_data_list = ['start_date', 'end_date',
                                'extended_start_date_d', 'extended_start_date_q',
                                'freq', 'fields', 'symbol', 'universe',
-                               'custom_daily_fields', 'custom_quarterly_fields']
+                               'custom_daily_fields', 'custom_quarterly_fields', 'formulas']
         self.adjust_mode = 'post'
         
         self.data_d = None
         self.data_q = None
         self._data_benchmark = None
         self._data_group = None
+        self._formula_dag = None
+        self.profiler = None
+        # all versions of financial statements, data_q only keeps the original version of each report
+        self.statements = StatementVersions()
+        # {field_name: [formula, formula_func_name_style, is_quarterly]} of fields added by formulas
+        self.formulas = dict()
         
         common_list = {'symbol', 'start_date', 'end_date'}
         market_bar_list = {'open', 'high', 'low', 'close', 'volume', 'turnover', 'vwap', 'oi'}
@@ -231,6 +239,13 @@ class DataView(object):
             raise ValueError("You must provide a DataFrame with the same shape of data_benchmark.")
         self._data_benchmark = df_new
     
+    @property
+    def formula_dag(self):
+        """FormulaDAG shared by all formulas of this DataView, so common sub-expressions are computed once."""
+        if self._formula_dag is None:
+            self._formula_dag = FormulaDAG()
+        return self._formula_dag
+    
     @staticmethod
     def _group_df_to_dict(df, by):
         gp = df.groupby(by=by)
@@ -600,11 +615,20 @@ class DataView(object):
         if not dic:
             return None
         new_dic = dict()
+        versions = []
         for sec, df in dic.viewitems():
             df_mod = df.loc[:, self._get_fields(type_, fields, append=True)]
+            
+            # keep restatements in self.statements, and the original version (earliest ann_date) in data_q
+            df_versions = df_mod.copy()
+            df_versions['symbol'] = sec
+            versions.append(df_versions)
+            df_mod = df_mod.sort_values([self.REPORT_DATE_FIELD_NAME, self.ANN_DATE_FIELD_NAME])
+            
             df_mod = self._process_index(df_mod, self.REPORT_DATE_FIELD_NAME)
             
             new_dic[sec] = df_mod
+        self.statements.add(pd.concat(versions, axis=0, ignore_index=True))
     
         res = self._dic_of_df_to_multi_index_df(new_dic, level_names=['symbol', 'field'])
         return res
@@ -757,6 +781,8 @@ class DataView(object):
         # prepare benchmark and group
         print "Query data..."
         self.data_d, self.data_q = self._prepare_data(self.fields)
+        if self._formula_dag is not None:
+            self._formula_dag.clear_cache()
 
         print "Query adj_factor..."
         self._prepare_adj_factor()
@@ -872,7 +898,8 @@ class DataView(object):
         merge = merge.loc[:, pd.IndexSlice[:, field_name]]
         self.append_df(merge, field_name, is_quarterly=is_quarterly)  # whether contain only trade days is decided by existing data.
     
-    def add_formula(self, field_name, formula, is_quarterly, formula_func_name_style='upper', data_api=None):
+    def add_formula(self, field_name, formula, is_quarterly, formula_func_name_style='upper', data_api=None,
+                    n_jobs=1):
         """
         Add a new field, which is calculated using existing fields.
         
@@ -886,6 +913,8 @@ class DataView(object):
             Whether df is quarterly data (like quarterly financial statement) or daily data.
         formula_func_name_style : {'upper', 'lower'}, optional
         data_api : RemoteDataService, optional
+        n_jobs : int, optional
+            Number of processes evaluating time series sub-expressions on shards of symbols.
         
         """
         if data_api is not None:
@@ -895,14 +924,78 @@ class DataView(object):
             print "Add formula failed: field name [{:s}] exist. Try another name.".format(field_name)
             return
         
-        parser = Parser()
-        parser.set_capital(formula_func_name_style)
+        root = self.formula_dag.compile(formula, func_name_style=formula_func_name_style)
+        self._prepare_formula_vars(self.formula_dag.variables([root]))
+        
+        df_eval, = self._evaluate_formulas([root], n_jobs=n_jobs, names=[field_name])
+        self.append_df(df_eval, field_name, is_quarterly=is_quarterly)
+        self.formulas[field_name] = [formula, formula_func_name_style, is_quarterly]
+
+    def add_formulas(self, formulas, is_quarterly, formula_func_name_style='upper', data_api=None, n_jobs=1):
+        """
+        Add several new fields at once. Sub-expressions shared by formulas are computed only once.
+        
+        Parameters
+        ----------
+        formulas : dict or list of tuple
+            {field_name: formula} or [(field_name, formula), ...]
+        is_quarterly : bool
+            Whether results are quarterly data or daily data.
+        formula_func_name_style : {'upper', 'lower'}, optional
+        data_api : RemoteDataService, optional
+        n_jobs : int, optional
+            Number of processes evaluating time series sub-expressions on shards of symbols.
+
+        """
+        if data_api is not None:
+            self.data_api = data_api
+        
+        if isinstance(formulas, dict):
+            formulas = sorted(formulas.items())
+        
+        field_names = []
+        accepted = []
+        roots = []
+        for field_name, formula in formulas:
+            if field_name in self.fields or field_name in field_names:
+                print "Add formula failed: field name [{:s}] exist. Try another name.".format(field_name)
+                continue
+            field_names.append(field_name)
+            accepted.append(formula)
+            roots.append(self.formula_dag.compile(formula, func_name_style=formula_func_name_style))
+        if not roots:
+            return
         
-        expr = parser.parse(formula)
+        self._prepare_formula_vars(self.formula_dag.variables(roots))
         
-        var_df_dic = dict()
-        var_list = expr.variables()
+        dfs_eval = self._evaluate_formulas(roots, n_jobs=n_jobs, names=field_names)
+        for field_name, formula, df_eval in zip(field_names, accepted, dfs_eval):
+            self.append_df(df_eval, field_name, is_quarterly=is_quarterly)
+            self.formulas[field_name] = [formula, formula_func_name_style, is_quarterly]
+
+    def enable_profiling(self, enable=True):
+        """
+        Record time and memory of every operator in formulas evaluated from now on.
         
+        Parameters
+        ----------
+        enable : bool, optional
+            If False, stop recording.
+
+        Returns
+        -------
+        FormulaProfiler or None
+            Collects records of all formulas of this DataView, see FormulaProfiler.report and save_folded.
+
+        """
+        if not enable:
+            self.profiler = None
+        elif self.profiler is None:
+            self.profiler = FormulaProfiler()
+        return self.profiler
+
+    def _prepare_formula_vars(self, var_list):
+        """Make sure all variables used by formulas are available."""
         # TODO
         # users do not need to prepare data before add_formula
         if not self.fields:
@@ -914,22 +1007,311 @@ class DataView(object):
                     print "variable [{:s}] is not recognized (it may be wrong)," \
                           "try to fetch from the server...".format(var)
                     self.add_field(var)
+
+    def eval_formula(self, formula, start_date=0, end_date=0, formula_func_name_style='upper'):
+        """
+        Evaluate a formula of daily result on dates in [start_date, end_date] only, without adding a field.
+        Inputs are cut to the lookback needed by the formula, so recomputing recent dates is cheap.
         
-        df_ann = self.get_ann_df()
-        for var in var_list:
+        Parameters
+        ----------
+        formula : str
+        start_date : int, optional
+            Default 0 (self.start_date).
+        end_date : int, optional
+            Default 0 (self.end_date).
+        formula_func_name_style : {'upper', 'lower'}, optional
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is date, column is symbol.
+
+        """
+        root = self.formula_dag.compile(formula, func_name_style=formula_func_name_style)
+        self._prepare_formula_vars(self.formula_dag.variables([root]))
+        
+        df_eval, = self._evaluate_formulas([root], start_date=start_date or self.start_date,
+                                           end_date=end_date or self.end_date, names=[formula])
+        return df_eval
+    
+    def eval_formula_grid(self, template, grid, start_date=0, end_date=0, formula_func_name_style='upper',
+                          n_jobs=1):
+        """
+        Evaluate a formula template of daily result for every combination of parameters in one pass.
+        Sub-expressions not depending on parameters are computed once, and Sum / Ts_Mean / StdDev /
+        CountNans / Product of the same input with different windows share one cumulative pass.
+        
+        Parameters
+        ----------
+        template : str
+            Formula with placeholders, e.g. 'Ts_Mean(close, {n}) / Ts_Mean(close, {m})'.
+        grid : dict or list of dict
+            {parameter name: list of values} for all combinations, or list of {parameter name: value}.
+        start_date : int, optional
+            Default 0 (self.start_date).
+        end_date : int, optional
+            Default 0 (self.end_date).
+        formula_func_name_style : {'upper', 'lower'}, optional
+        n_jobs : int, optional
+            Number of processes evaluating time series sub-expressions on shards of symbols.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is date, columns are MultiIndex of parameters and symbol.
+
+        Examples
+        --------
+        >>> df = dv.eval_formula_grid('Ts_Mean(close, {n}) / close', {'n': range(5, 65, 5)})
+        >>> df[20]  # result of n = 20
+
+        """
+        names, params, roots = self.formula_dag.compile_grid(template, grid,
+                                                             func_name_style=formula_func_name_style)
+        self._prepare_formula_vars(self.formula_dag.variables(roots))
+        
+        dfs_eval = self._evaluate_formulas(roots, start_date=start_date or self.start_date,
+                                           end_date=end_date or self.end_date, n_jobs=n_jobs)
+        keys = [p[0] for p in params] if len(names) == 1 else params
+        return pd.concat(dfs_eval, axis=1, keys=keys, names=names + ['symbol'])
+    
+    def _evaluate_formulas(self, roots, start_date=0, end_date=0, n_jobs=1, names=None):
+        """
+        Evaluate compiled formulas on data of this DataView.
+        
+        Parameters
+        ----------
+        roots : list of Node
+            Returned by self.formula_dag.compile
+        start_date : int, optional
+            If not 0, only evaluate daily results in [start_date, end_date]. Daily inputs start
+            from start_date minus lookback of roots, and results are not cached.
+        end_date : int, optional
+            Default 0 (self.end_date).
+        n_jobs : int, optional
+            Number of processes for time series sub-expressions, see FormulaDAG.evaluate.
+        names : list of str, optional
+            Names of roots in reports of self.profiler.
+
+        Returns
+        -------
+        list of pd.DataFrame
+
+        """
+        dates = self.dates
+        first_date = self.extended_start_date_d
+        if not end_date:
+            end_date = self.end_date
+        
+        use_cache = not start_date
+        if start_date:
+            lookback = self.formula_dag.lookback(roots)
+            i_start = np.searchsorted(dates, start_date)
+            i_first = 0 if lookback is None else max(i_start - lookback, 0)
+            first_date = dates[min(i_first, len(dates) - 1)]
+            dates = dates[i_first: np.searchsorted(dates, end_date, side='right')]
+        
+        def get_var(var):
             if self._is_quarter_field(var):
-                df_var = self.get_ts_quarter(var, start_date=self.extended_start_date_q)
+                return self.get_ts_quarter(var, start_date=self.extended_start_date_q)
             else:
                 # must use extended date. Default is start_date
-                df_var = self.get_ts(var, start_date=self.extended_start_date_d, end_date=self.end_date)
-            
-            var_df_dic[var] = df_var
+                return self.get_ts(var, start_date=first_date, end_date=end_date)
         
         # TODO: send ann_date into expr.evaluate. We assume that ann_date of all fields of a symbol is the same
-        df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates, df_group=self.data_group)
+        df_ann = self.get_ann_df()
+        res = self.formula_dag.evaluate(roots, get_var, ann_dts=df_ann, trade_dts=dates,
+                                        df_group=self.data_group, use_cache=use_cache, n_jobs=n_jobs,
+                                        profiler=self.profiler, names=names)
+        if any(self._is_quarter_field(var) for var in self.formula_dag.variables(roots)):
+            res = self._restate(roots, res, dates, self.statements.restatements(), get_var)
+        if start_date:
+            res = [df.loc[start_date: end_date] for df in res]
+        return res
+
+    def _restate(self, roots, results, dates, events, get_var):
+        """
+        Recompute daily results of formulas of some symbols on and after some dates, with financial statements
+        as known on each date.
         
-        self.append_df(df_eval, field_name, is_quarterly=is_quarterly)
+        Results of a symbol on and after its event date are evaluated again once for each interval between
+        restatements of its statements (one interval if formulas do not use quarterly fields), with versions
+        announced up to the start of the interval. Only symbols of events are evaluated (all symbols if formulas
+        have cross-section functions), on dates of the interval plus the lookback of formulas.
+        
+        Parameters
+        ----------
+        roots : list of Node
+        results : list of pd.DataFrame
+            Results of roots to update. Quarterly results are not changed.
+        dates : np.ndarray
+            Trade dates of daily results.
+        events : pd.DataFrame
+            Columns symbol and ann_date, e.g. restatements: results of symbol on and after ann_date are recomputed.
+        get_var : callable
+            Returns data of a variable, with original statements for quarterly fields.
+
+        Returns
+        -------
+        list of pd.DataFrame
+
+        """
+        quarterly_vars = [v for v in self.formula_dag.variables(roots) if self._is_quarter_field(v)]
+        is_daily = [isinstance(df, pd.DataFrame) and np.array_equal(df.index.values, dates) for df in results]
+        if not len(events) or not any(is_daily):
+            return results
+        
+        all_symbols = list(results[is_daily.index(True)].columns)
+        events = events.loc[(events['ann_date'] <= dates[-1]) & events['symbol'].isin(all_symbols)]
+        if not len(events):
+            return results
+        column_wise = self.formula_dag.is_column_wise(roots)
+        starts = events.groupby('symbol')['ann_date'].min()
+        if not column_wise:
+            starts = pd.Series(starts.min(), index=all_symbols)
+        
+        # statements of a symbol change on ann_dates of its restatements (of any symbol for cross-section)
+        change_dates = dict()
+        if quarterly_vars:
+            changes = self.statements.restatements()
+            if column_wise:
+                change_dates = changes.groupby('symbol')['ann_date'].unique().to_dict()
+            else:
+                change_dates = dict.fromkeys(all_symbols, changes['ann_date'].unique())
+        
+        # {begin of interval: [(symbol, end of interval)]}
+        intervals = dict()
+        for symbol, start in starts.iteritems():
+            later = [d for d in change_dates.get(symbol, []) if start < d <= dates[-1]]
+            bounds = sorted(set(later)) + [np.inf]
+            intervals.setdefault(start, []).append((symbol, bounds[0]))
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                intervals.setdefault(begin, []).append((symbol, end))
+        
+        lookback = self.formula_dag.lookback(roots)
+        results = [df.copy() if daily else df for df, daily in zip(results, is_daily)]
+        for begin, ends in sorted(intervals.items()):
+            symbols = sorted(symbol for symbol, _ in ends) if column_wise else all_symbols
+            i_begin = np.searchsorted(dates, begin)
+            i_end = np.searchsorted(dates, max(end for _, end in ends))
+            if i_begin >= i_end:
+                continue
+            i_first = 0 if lookback is None else max(i_begin - lookback, 0)
+            eval_dates = dates[i_first: i_end]
+            
+            df_ann = None
+            if quarterly_vars:
+                vintage = self.statements.vintage(begin, symbols)
+                df_ann = vintage[self.ANN_DATE_FIELD_NAME].unstack(level='symbol').reindex(columns=symbols)
+            values = dict()
+            for var in self.formula_dag.variables(roots):
+                if var in quarterly_vars:
+                    if var in vintage.columns:
+                        df = vintage[var].unstack(level='symbol')
+                    else:
+                        df = get_var(var)
+                    df = df.reindex(index=df_ann.index)
+                else:
+                    df = get_var(var).loc[eval_dates[0]: eval_dates[-1]]
+                values[var] = df.reindex(columns=symbols)
+            df_group = self.data_group if not column_wise else None
+            
+            res = self.formula_dag.evaluate(roots, values, ann_dts=df_ann, trade_dts=eval_dates, df_group=df_group,
+                                            use_cache=False)
+            by_end = dict()
+            for symbol, end in ends:
+                by_end.setdefault(end, []).append(symbol)
+            for end, end_symbols in by_end.items():
+                rows = (dates >= begin) & (dates < end)
+                for df, df_new, daily in zip(results, res, is_daily):
+                    if daily:
+                        df.loc[rows, end_symbols] = df_new.loc[dates[rows], end_symbols].values
+        return results
+    
+    def _formula_field_order(self, fields):
+        """Daily formula fields in dependency order: a field comes after formula fields in its formula."""
+        deps = dict()
+        for field_name in fields:
+            formula, style, _ = self.formulas[field_name]
+            root = self.formula_dag.compile(formula, func_name_style=style)
+            deps[field_name] = [v for v in self.formula_dag.variables([root]) if v in fields]
+        
+        order = []
+        visited = set()
+        
+        def visit(field_name):
+            if field_name in visited:
+                return
+            visited.add(field_name)
+            for dep in deps[field_name]:
+                visit(dep)
+            order.append(field_name)
+        
+        for field_name in fields:
+            visit(field_name)
+        return order
+    
+    def add_statement_versions(self, df):
+        """
+        Add newly announced versions of financial statements (e.g. restatements), and update daily formula
+        fields of affected symbols on and after their announcement dates.
+        
+        Formula fields are updated in dependency order, so fields using other formula fields
+        (e.g. 'f1 * 2') are updated where those fields changed.
+        
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Columns are symbol, report_date, ann_date and fields of statements.
+
+        Returns
+        -------
+        pd.DataFrame
+            Keys (symbol, report_date, ann_date) of new versions.
 
+        """
+        new = self.statements.add(df)
+        fields = [name for name, (formula, style, is_quarterly) in sorted(self.formulas.items())
+                  if not is_quarterly and name in self.fields]
+        if not len(new) or not fields:
+            return new
+        
+        def get_var(var):
+            if self._is_quarter_field(var):
+                return self.get_ts_quarter(var, start_date=self.extended_start_date_q)
+            else:
+                return self.get_ts(var, start_date=self.extended_start_date_d, end_date=self.end_date)
+        
+        dates = self.dates
+        changed = dict()  # {field: first date of changed results of each symbol}
+        for field_name in self._formula_field_order(fields):
+            formula, style, _ = self.formulas[field_name]
+            root = self.formula_dag.compile(formula, func_name_style=style)
+            variables = self.formula_dag.variables([root])
+            events = [pd.DataFrame({'symbol': changed[var].index, 'ann_date': changed[var].values})
+                      for var in variables if var in changed]
+            if any(self._is_quarter_field(var) for var in variables):
+                events.append(new)
+            if not events:
+                continue
+            
+            df_old = self.get_ts(field_name, start_date=self.extended_start_date_d, end_date=self.end_date)
+            df_old = df_old.reindex(index=dates)
+            df_new, = self._restate([root], [df_old], dates, pd.concat(events, axis=0), get_var)
+            
+            diff = pd.DataFrame((df_new.values != df_old.values) & ~(df_new.isnull().values & df_old.isnull().values),
+                                index=dates, columns=df_new.columns)
+            diff = diff.loc[:, diff.any()]
+            if not diff.shape[1]:
+                continue
+            changed[field_name] = diff.idxmax()
+            df_new.columns = pd.MultiIndex.from_product([df_new.columns, [field_name]])
+            self.data_d.loc[:, df_new.columns] = df_new.values
+            if self._formula_dag is not None:
+                self._formula_dag.invalidate(field_name)
+        return new
+    
     @staticmethod
     def _load_h5(fp):
         """Load data and meta_data from hd5 file.
@@ -966,7 +1348,9 @@ class DataView(object):
         self.data_q = dic.get('/data_q', None)
         self._data_benchmark = dic.get('/data_benchmark', None)
         self._data_group = dic.get('/data_group', None)
+        self.statements = StatementVersions(dic.get('/statements', None))
         self.__dict__.update(meta_data)
+        self._formula_dag = None
         
         print "Dataview loaded successfully."
 
@@ -1041,7 +1425,13 @@ class DataView(object):
             
             dic_expanded = dict()
             for field_name, df in df_ref_quarterly.groupby(level=1, axis=1):  # by column multiindex fields
-                df_expanded = align(df, df_ref_ann, self.dates)
+                if field_name in self.statements.fields:
+                    # point-in-time: latest report visible on each date, in its latest version visible
+                    df_expanded = self.statements.expand(field_name, self.dates,
+                                                         df.columns.get_level_values('symbol'))
+                    df_expanded.columns = df.columns
+                else:
+                    df_expanded = align(df, df_ref_ann, self.dates)
                 dic_expanded[field_name] = df_expanded
             df_ref_expanded = pd.concat(dic_expanded.values(), axis=1)
             df_ref_expanded.index.name = self.TRADE_DATE_FIELD_NAME
@@ -1161,7 +1551,8 @@ class DataView(object):
         
         data_to_store = {'data_d': self.data_d, 'data_q': self.data_q,
                          'data_benchmark': self._data_benchmark,
-                         'data_group': self._data_group}
+                         'data_group': self._data_group,
+                         'statements': self.statements.data if len(self.statements) else None}
         data_to_store = {k: v for k, v in data_to_store.items() if v is not None}
         meta_data_to_store = {key: self.__dict__[key] for key in self.meta_data_list}
 
@@ -1212,6 +1603,8 @@ class DataView(object):
             df = pd.DataFrame(df)
         else:
             raise ValueError("Data to be appended must be pandas format. But we have {}".format(type(df)))
+        # do not modify columns of the caller's DataFrame, which may be a cached formula result
+        df = df.copy(deep=False)
         
         if is_quarterly:
             the_data = self.data_q
@@ -0,0 +1,788 @@
+# encoding: utf-8
+"""
+Compile formulas into a shared DAG and evaluate them with each distinct
+sub-expression computed only once.
+
+Formulas are parsed by Parser, then the RPN tokens are turned into a tree of
+Node. Nodes are hash-consed by a canonical key (function names are case
+insensitive, aliases like Corr / Correlation are merged, operands of
+commutative operators are sorted), so the same sub-expression appearing in
+different formulas is the same Node. Intermediate results are kept in a
+memory-bounded LRU cache and reused by later evaluations.
+
+"""
+import itertools
+import math
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+from quantos.data.py_expression_eval import Parser, TNUMBER, TOP1, TOP2, TVAR, TFUNCALL
+from quantos.data import fusion
+from quantos.data import rolling
+
+
+class Node(object):
+    """
+    A node of formula DAG.
+
+    Attributes
+    ----------
+    kind : {'const', 'var', 'func', 'op1', 'op2', 'call'}
+    name : str
+        Variable name, operator or canonical (lower case) function name.
+    children : tuple of Node
+    value : object
+        Value of constant node.
+    key : str
+        Canonical string of the sub-expression, unique within a DAG.
+
+    """
+    CONST = 'const'
+    VAR = 'var'
+    FUNC = 'func'
+    OP1 = 'op1'
+    OP2 = 'op2'
+    CALL = 'call'
+
+    def __init__(self, kind, name, children=(), value=None, key=""):
+        self.kind = kind
+        self.name = name
+        self.children = tuple(children)
+        self.value = value
+        self.key = key
+
+    def __repr__(self):
+        return "Node({:s})".format(self.key)
+
+
+class _ArgList(object):
+    """Temporary holder of comma separated arguments during compiling."""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+
+def _nbytes(obj):
+    """Approximate memory used by a result."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        res = obj.memory_usage(index=True)
+        return int(np.sum(res))
+    elif isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    return 0
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache bounded by total bytes of values.
+
+    Attributes
+    ----------
+    max_bytes : int
+    nbytes : int
+        Bytes currently used.
+    hits, misses : int
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value, size = self._data.pop(key)
+        self._data[key] = (value, size)
+        return value
+
+    def put(self, key, value):
+        """Store value. Values larger than max_bytes are not stored."""
+        self.pop(key)
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        self._data[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, size_old) = self._data.popitem(last=False)
+            self.nbytes -= size_old
+
+    def pop(self, key):
+        if key in self._data:
+            value, size = self._data.pop(key)
+            self.nbytes -= size
+            return value
+        return None
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+
+class FormulaDAG(object):
+    """
+    Shared DAG of all compiled formulas, with result cache.
+
+    Cached results are only valid for the same data (variables, ann_dts,
+    trade_dts, df_group). Call clear_cache or invalidate when data changes.
+
+    Attributes
+    ----------
+    parser : Parser
+        Provides functions and operators, and holds alignment data during evaluation.
+    nodes : dict
+        {key: Node} of all distinct sub-expressions.
+    cache : LRUCache
+    n_computed : int
+        Number of nodes computed (not read from cache) so far.
+    fuse : bool
+        Whether trees of element-wise nodes are evaluated at once by fusion.FusedKernel.
+
+    """
+    # binary operators whose operands can be swapped
+    COMMUTATIVE_OPS = {'+', '*', '==', '!=', '&&', '||'}
+    
+    # {function: (position of window argument, rows before current row needed = window + offset)}
+    WINDOW_FUNCTIONS = {'delay': (1, 0), 'delta': (1, 0), 'return': (1, 0),
+                        'sum': (1, -1), 'product': (1, -1), 'countnans': (1, -1), 'stddev': (1, -1),
+                        'ts_mean': (1, -1), 'ts_min': (1, -1), 'ts_max': (1, -1),
+                        'ts_skewness': (1, -1), 'ts_kurtosis': (1, -1), 'decay_linear': (1, -1),
+                        'covariance': (2, -1), 'correlation': (2, -1), 'corr': (2, -1), 'decay_exp': (2, -1),
+                        'ts_rank': (1, -1), 'ts_argmax': (1, -1), 'ts_argmin': (1, -1),
+                        'ts_beta': (2, -1), 'ts_residual': (2, -1)}
+    # functions whose result on a date only depends on arguments on the same date
+    SAME_DATE_FUNCTIONS = {'min', 'max', 'rank', 'grouprank', 'conditionrank', 'standardize', 'cutoff',
+                           'quantileclip', 'rankgauss', 'groupapply', 'neutralize', 'industryneutral',
+                           'pow', 'signedpower', 'if', 'tail'}
+    # functions mixing values of different symbols on the same date
+    CROSS_SECTION_FUNCTIONS = {'rank', 'grouprank', 'conditionrank', 'standardize', 'cutoff', 'quantileclip',
+                               'rankgauss', 'groupapply', 'neutralize', 'industryneutral'}
+    # functions of quarterly data on report dates, results are expanded to trade dates afterwards
+    QUARTERLY_FUNCTIONS = {'ttm', 'sq', 'yoy', 'qoq'}
+    # window functions computed from prefix sums: {function: method of rolling.CumulativeWindows}
+    # nodes of the same input with different windows in one batch share the prefix sums
+    CUMULATIVE_FUNCTIONS = {'sum': 'rolling_sum', 'ts_mean': 'rolling_mean', 'stddev': 'rolling_std',
+                            'countnans': 'rolling_count_nans', 'product': 'rolling_product'}
+    # exponentially weighted functions have infinite memory, history is cut where
+    # total weight of older rows falls below this fraction
+    EWM_TOLERANCE = 1e-6
+
+    def __init__(self, max_cache_bytes=2 * 1024 ** 3):
+        self.parser = Parser()
+        self.nodes = dict()
+        self.cache = LRUCache(max_cache_bytes)
+        self.n_computed = 0
+        self.fuse = True
+
+        self._functions = dict()
+        self._ops1 = dict()
+        self._canonical = dict()
+        self._update_names()
+
+    def _update_names(self):
+        """Build case insensitive lookup of functions and map aliases to one canonical name."""
+        self._functions = {k.lower(): v for k, v in self.parser.functions.items()}
+        self._ops1 = {k.lower(): v for k, v in self.parser.ops1.items()}
+
+        self._canonical = dict()
+        for dic in [self._functions, self._ops1]:
+            for name in sorted(dic.keys()):
+                func = dic[name]
+                aliases = [k for k in sorted(dic.keys()) if dic[k] == func]
+                self._canonical[name] = aliases[0]
+
+    def register_function(self, name, func):
+        """Register a new function, see Parser.register_function."""
+        self.parser.register_function(name, func)
+        self._update_names()
+
+    # -----------------------------------------------------
+    # compile
+    def _get_node(self, kind, name, children=(), value=None):
+        """Return the existing node with the same canonical key, or create one."""
+        if kind == Node.CONST:
+            key = repr(value)
+        elif kind == Node.VAR:
+            key = name
+        elif kind == Node.FUNC:
+            # function reference passed as argument, e.g. GroupApply(Rank, x)
+            key = "<{:s}>".format(name)
+        elif kind == Node.OP1:
+            key = "{:s}({:s})".format(name, children[0].key)
+        elif kind == Node.OP2:
+            if name in self.COMMUTATIVE_OPS:
+                children = sorted(children, key=lambda n: n.key)
+            key = "({:s}{:s}{:s})".format(children[0].key, name, children[1].key)
+        else:
+            key = "{:s}({:s})".format(name, ','.join([c.key for c in children]))
+
+        node = self.nodes.get(key, None)
+        if node is None:
+            node = Node(kind, name, children=children, value=value, key=key)
+            self.nodes[key] = node
+        return node
+
+    def compile(self, formula, func_name_style='upper'):
+        """
+        Parse formula and merge it into the DAG.
+
+        Parameters
+        ----------
+        formula : str
+        func_name_style : {'upper', 'lower'}
+
+        Returns
+        -------
+        Node
+            Root node of the formula.
+
+        """
+        parser = Parser()
+        parser.set_capital(func_name_style)
+        # functions registered to this DAG
+        for name, func in self.parser.functions.items():
+            if func_name_style == 'lower':
+                name = name.lower()
+            if name not in parser.functions:
+                parser.functions[name] = func
+        parser.parse(formula)
+
+        stack = []
+        for item in parser.tokens:
+            type_ = item.type_
+            if type_ == TNUMBER:
+                if isinstance(item.number_, list):
+                    # nullary call
+                    stack.append(_ArgList([]))
+                else:
+                    stack.append(self._get_node(Node.CONST, '', value=item.number_))
+            elif type_ == TVAR:
+                name = item.index_
+                if name in parser.functions:
+                    stack.append(self._get_node(Node.FUNC, self._canonical[name.lower()]))
+                else:
+                    stack.append(self._get_node(Node.VAR, name))
+            elif type_ == TOP1:
+                n1 = stack.pop()
+                name = item.index_
+                if name not in ('-', '!'):
+                    name = self._canonical[name.lower()]
+                else:
+                    name = '-'
+                stack.append(self._get_node(Node.OP1, name, children=(n1,)))
+            elif type_ == TOP2:
+                n2 = stack.pop()
+                n1 = stack.pop()
+                if item.index_ == ',':
+                    args = n1.nodes if isinstance(n1, _ArgList) else [n1]
+                    stack.append(_ArgList(args + [n2]))
+                else:
+                    stack.append(self._get_node(Node.OP2, item.index_, children=(n1, n2)))
+            elif type_ == TFUNCALL:
+                n1 = stack.pop()
+                f = stack.pop()
+                if not isinstance(f, Node) or f.kind != Node.FUNC:
+                    raise Exception('{} is not a function'.format(f))
+                args = n1.nodes if isinstance(n1, _ArgList) else [n1]
+                stack.append(self._get_node(Node.CALL, f.name, children=args))
+            else:
+                raise Exception('invalid Expression')
+        if len(stack) != 1 or not isinstance(stack[0], Node):
+            raise Exception('invalid Expression (parity)')
+        return stack[0]
+
+    @staticmethod
+    def expand_grid(template, grid):
+        """
+        Formulas of a template for every combination of parameters.
+
+        Parameters
+        ----------
+        template : str
+            Formula with placeholders of str.format, e.g. 'Ts_Mean(close, {n}) / Decay_linear(close, {m})'.
+        grid : dict or list of dict
+            {parameter name: list of values}, all combinations are used (parameters in sorted order
+            unless grid is an OrderedDict); or a list of {parameter name: value}.
+
+        Returns
+        -------
+        names : list of str
+            Parameter names.
+        params : list of tuple
+            Values of parameters of each formula, in the order of names.
+        formulas : list of str
+
+        """
+        if isinstance(grid, dict):
+            names = list(grid.keys()) if isinstance(grid, OrderedDict) else sorted(grid.keys())
+            params = list(itertools.product(*[list(grid[name]) for name in names]))
+        else:
+            names = sorted(grid[0].keys()) if grid else []
+            params = [tuple(dic[name] for name in names) for dic in grid]
+        formulas = [template.format(**dict(zip(names, values))) for values in params]
+        return names, params, formulas
+
+    def compile_grid(self, template, grid, func_name_style='upper'):
+        """
+        Compile a formula template for every combination of parameters, see expand_grid.
+        Sub-expressions not depending on parameters are shared by all formulas.
+
+        Returns
+        -------
+        names : list of str
+        params : list of tuple
+        roots : list of Node
+
+        """
+        names, params, formulas = self.expand_grid(template, grid)
+        roots = [self.compile(formula, func_name_style=func_name_style) for formula in formulas]
+        return names, params, roots
+
+    # -----------------------------------------------------
+    # graph helpers
+    @staticmethod
+    def topological_order(roots):
+        """
+        Distinct nodes reachable from roots, children before parents.
+
+        Parameters
+        ----------
+        roots : list of Node
+
+        Returns
+        -------
+        list of Node
+
+        """
+        order = []
+        visited = set()
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if node.key in visited:
+                    continue
+                if expanded:
+                    visited.add(node.key)
+                    order.append(node)
+                else:
+                    stack.append((node, True))
+                    for child in reversed(node.children):
+                        if child.key not in visited:
+                            stack.append((child, False))
+        return order
+
+    def variables(self, roots):
+        """Names of variables used by roots."""
+        return [node.name for node in self.topological_order(roots) if node.kind == Node.VAR]
+
+    def _node_lookback(self, node, child_lookbacks):
+        """Lookback of node given lookbacks of its children, None if unbounded."""
+        if node.kind in (Node.CONST, Node.VAR, Node.FUNC):
+            return 0
+        if any(lb is None for lb in child_lookbacks):
+            return None
+        lb_children = max(child_lookbacks) if child_lookbacks else 0
+        if node.kind in (Node.OP1, Node.OP2):
+            return lb_children
+
+        def const_arg(i, default=None):
+            if i >= len(node.children):
+                return default
+            child = node.children[i]
+            return child.value if child.kind == Node.CONST else None
+
+        name = node.name
+        if name in self.SAME_DATE_FUNCTIONS or name in self.QUARTERLY_FUNCTIONS:
+            own = 0
+        elif name in self.WINDOW_FUNCTIONS:
+            i, offset = self.WINDOW_FUNCTIONS[name]
+            n = const_arg(i, default=1 if name == 'return' else None)
+            if n is None:
+                return None
+            own = max(int(math.ceil(n)) + offset, 0)
+        elif name == 'ewma':
+            halflife = const_arg(1)
+            if halflife is None:
+                return None
+            own = int(math.ceil(halflife * math.log(1.0 / self.EWM_TOLERANCE, 2)))
+        elif name == 'sma':
+            n, m = const_arg(1), const_arg(2)
+            if n is None or m is None:
+                return None
+            decay = 1.0 - m * 1.0 / n
+            own = int(math.ceil(math.log(self.EWM_TOLERANCE) / math.log(decay))) if 0 < decay < 1 else 0
+        else:
+            # unknown functions, or results depending on the whole history (like Step)
+            return None
+        return lb_children + own
+
+    def lookback(self, roots):
+        """
+        Number of rows before the first requested row that inputs must include
+        for results of roots to be the same as evaluated on the full history.
+        
+        Windows of nested functions add up, e.g. Ts_Mean(Delta(close, 5), 10) needs 5 + 9 rows.
+        Ewma and Sma are cut where older rows weigh less than EWM_TOLERANCE.
+        
+        Parameters
+        ----------
+        roots : list of Node
+
+        Returns
+        -------
+        int or None
+            None if results depend on the whole history (e.g. Step, unknown functions, non-constant windows).
+
+        """
+        lookbacks = dict()
+        for node in self.topological_order(roots):
+            lookbacks[node.key] = self._node_lookback(node, [lookbacks[c.key] for c in node.children])
+        res = [lookbacks[root.key] for root in roots]
+        if any(lb is None for lb in res):
+            return None
+        return max(res) if res else 0
+
+    def _is_column_wise(self, node):
+        """Whether each symbol (column) of the result of node only depends on the same symbol of its arguments."""
+        if node.kind != Node.CALL:
+            return True
+        known = (set(self.WINDOW_FUNCTIONS) | self.SAME_DATE_FUNCTIONS | self.QUARTERLY_FUNCTIONS
+                 | {'ewma', 'sma', 'step'})
+        return node.name in known and node.name not in self.CROSS_SECTION_FUNCTIONS
+
+    def is_column_wise(self, roots):
+        """Whether each symbol of results of roots only depends on the same symbol of variables."""
+        return all(self._is_column_wise(node) for node in self.topological_order(roots))
+
+    def time_series_subtrees(self, roots, skip=()):
+        """
+        Maximal sub-expressions of roots without any cross-section function, which can be
+        evaluated on each subset of symbols independently.
+        
+        Parameters
+        ----------
+        roots : list of Node
+        skip : container of str
+            Keys of nodes whose results are already available.
+
+        Returns
+        -------
+        list of Node
+
+        """
+        column_wise = dict()
+        for node in self.topological_order(roots):
+            column_wise[node.key] = self._is_column_wise(node) and all(column_wise[c.key] for c in node.children)
+
+        res = []
+        visited = set()
+        stack = list(reversed(roots))
+        while stack:
+            node = stack.pop()
+            if node.key in visited or node.key in skip:
+                continue
+            visited.add(node.key)
+            if column_wise[node.key]:
+                if node.kind in (Node.OP1, Node.OP2, Node.CALL) and self.variables([node]):
+                    res.append(node)
+            else:
+                stack.extend(reversed(node.children))
+        return res
+
+    def invalidate(self, var_name):
+        """Drop cached results depending on variable var_name."""
+        dependent = set()
+        for node in self.topological_order(list(self.nodes.values())):
+            if ((node.kind == Node.VAR and node.name == var_name)
+                    or any(c.key in dependent for c in node.children)):
+                dependent.add(node.key)
+        for key in dependent:
+            self.cache.pop(key)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    # -----------------------------------------------------
+    # evaluate
+    @staticmethod
+    def _get_var(name, values):
+        if callable(values):
+            return values(name)
+        if name in values:
+            return values[name]
+        raise Exception('undefined variable: ' + name)
+
+    def _compute(self, node, args, values):
+        if node.kind == Node.CONST:
+            return node.value
+        elif node.kind == Node.FUNC:
+            return self._functions[node.name]
+        elif node.kind == Node.VAR:
+            return self._get_var(node.name, values)
+        elif node.kind == Node.OP1:
+            if node.name == '-':
+                return self.parser.neg(args[0])
+            return self._ops1[node.name](args[0])
+        elif node.kind == Node.OP2:
+            return self.parser.ops2[node.name](args[0], args[1])
+        elif node.kind == Node.CALL:
+            return self._functions[node.name](*args)
+        raise Exception('invalid node kind: {}'.format(node.kind))
+
+    def _is_cumulative(self, node):
+        return (node.kind == Node.CALL and node.name in self.CUMULATIVE_FUNCTIONS
+                and len(node.children) == 2 and node.children[1].kind == Node.CONST)
+
+    def _cumulative_inputs(self, nodes):
+        """{input key: number of nodes} of inputs used by at least two cumulative window nodes."""
+        counts = dict()
+        for node in nodes:
+            if self._is_cumulative(node):
+                key = node.children[0].key
+                counts[key] = counts.get(key, 0) + 1
+        return {key: count for key, count in counts.items() if count > 1}
+
+    def _compute_fused(self, node, inlined, results, values):
+        """
+        Evaluate node and its inlined descendants by one FusedKernel.
+        Fall back to node by node evaluation if inputs can not be fused.
+
+        Returns
+        -------
+        res : object
+            Result of node.
+        nodes : list of Node
+            All nodes evaluated.
+
+        """
+        kernel = fusion.FusedKernel(node, lambda n: n.key not in inlined)
+        leaf_values = [results[leaf.key] for leaf in kernel.leaves]
+        res = kernel(leaf_values)
+        if res is None and self.parser.trade_dts is not None and self.parser.ann_dts is not None:
+            # mixed frequency: expand quarterly leaves first, element-wise operators commute with expansion
+            n_dates = len(self.parser.trade_dts)
+            if any(isinstance(v, pd.DataFrame) and len(v) == n_dates for v in leaf_values):
+                res = kernel([self.parser._align_univariate(v) for v in leaf_values])
+        if res is None:
+            local = dict()
+            for n in kernel.nodes:
+                args = [local[c.key] if c.key in inlined else results[c.key] for c in n.children]
+                local[n.key] = self._compute(n, args, values)
+            res = local[node.key]
+        return res, kernel.nodes
+
+    def _evaluate_sharded(self, nodes, values, ann_dts, trade_dts, n_jobs):
+        """
+        Evaluate column-wise nodes on symbol shards in a process pool.
+
+        Inputs are read by forked workers from the memory of this process, only results are sent back.
+
+        Returns
+        -------
+        dict
+            {node key: result}, including variables used by nodes.
+
+        """
+        data = {name: self._get_var(name, values) for name in self.variables(nodes)}
+        columns = None
+        for df in data.values():
+            if isinstance(df, pd.DataFrame):
+                columns = df.columns
+                break
+        if columns is None or len(columns) < 2:
+            return dict()
+
+        shards = [columns[idx] for idx in np.array_split(np.arange(len(columns)), min(n_jobs, len(columns)))]
+        global _shard_task
+        _shard_task = (self, nodes, data, ann_dts, trade_dts, shards)
+        try:
+            pool = multiprocessing.Pool(len(shards))
+            try:
+                parts = pool.map(_evaluate_shard, range(len(shards)))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _shard_task = None
+
+        # key of variable node is its name
+        res = dict(data)
+        for i, node in enumerate(nodes):
+            res[node.key] = pd.concat([part[i] for part in parts], axis=1)
+        return res
+
+    def evaluate(self, roots, values, ann_dts=None, trade_dts=None, df_group=None, use_cache=True, n_jobs=1,
+                 profiler=None, names=None):
+        """
+        Evaluate a batch of formulas, computing each distinct node once.
+
+        Parameters
+        ----------
+        roots : list of Node
+            Returned by compile.
+        values : dict or callable
+            {variable name: pd.DataFrame}, or a function which takes variable name and returns its value.
+            A function is only called for variables whose dependent results are not cached.
+        ann_dts : pd.DataFrame
+        trade_dts : np.ndarray
+        df_group : pd.DataFrame
+            See Parser.evaluate.
+        use_cache : bool
+            If False, neither read nor store cached results, e.g. when values are only part of the data.
+        n_jobs : int
+            If larger than 1, sub-expressions without cross-section functions are evaluated
+            on n_jobs shards of symbols in parallel processes. Needs os.fork (not on Windows).
+        profiler : FormulaProfiler, optional
+            If not None, time and output of every computed node are recorded. Cached nodes are not
+            recorded, a fused tree is recorded as one 'fused' call, and nodes evaluated on shards
+            as one 'parallel' call.
+        names : list of str, optional
+            Names of roots in profiler reports. Default is the canonical formula of each root.
+
+        Returns
+        -------
+        list
+            Results in the same order of roots.
+
+        """
+        self.parser.ann_dts = ann_dts
+        self.parser.trade_dts = trade_dts
+        self.parser.df_group = df_group
+        # each quarterly result is expanded to trade_dts at most once in this batch
+        self.parser.clear_align_cache()
+
+        # only visit nodes whose results are needed and not cached
+        # cached results are taken out first, so evictions during this batch do not affect them
+        results = dict()
+        sharded = dict()
+        record_ids = dict()  # {node key: id of profiler record}
+        if n_jobs > 1 and hasattr(os, 'fork'):
+            nodes = self.time_series_subtrees(roots, skip=self.cache if use_cache else ())
+            if nodes:
+                if profiler is not None:
+                    start = profiler.timer()
+                sharded = self._evaluate_sharded(nodes, values, ann_dts, trade_dts, n_jobs)
+                if profiler is not None:
+                    rid = profiler.record('parallel', 'parallel', profiler.timer() - start, None,
+                                          expr='{:d} nodes'.format(len(nodes)))
+                    record_ids.update((key, rid) for key in sharded)
+        order = []
+        visited = set()
+        stack = [(root, False) for root in reversed(roots)]
+        while stack:
+            node, expanded = stack.pop()
+            if node.key in visited:
+                continue
+            if node.key in sharded:
+                visited.add(node.key)
+                results[node.key] = sharded[node.key]
+                self.n_computed += 1
+                if use_cache:
+                    self.cache.put(node.key, results[node.key])
+            elif use_cache and node.key in self.cache:
+                visited.add(node.key)
+                results[node.key] = self.cache.get(node.key)
+            elif expanded or not node.children:
+                visited.add(node.key)
+                order.append(node)
+            else:
+                stack.append((node, True))
+                for child in reversed(node.children):
+                    if child.key not in visited:
+                        stack.append((child, False))
+
+        # number of pending consumers of each result in this batch
+        n_refs = dict()
+        for node in order:
+            for child in node.children:
+                n_refs[child.key] = n_refs.get(child.key, 0) + 1
+        root_keys = {root.key for root in roots}
+
+        # an element-wise node whose only consumer is element-wise is evaluated inside the consumer's kernel
+        inlined = set()
+        if self.fuse:
+            consumers = dict()
+            for node in order:
+                for child in node.children:
+                    consumers.setdefault(child.key, []).append(node)
+            for node in order:
+                parents = consumers.get(node.key, [])
+                if (fusion.is_elementwise(node) and node.key not in root_keys
+                        and len(parents) == 1 and fusion.is_elementwise(parents[0])):
+                    inlined.add(node.key)
+
+        # e.g. Ts_Mean(x, 5), Ts_Mean(x, 10), Sum(x, 20) are all computed from prefix sums of x
+        cumulative = self._cumulative_inputs(order)
+        prefix_sums = dict()
+
+        for node in order:
+            if node.key in inlined:
+                continue
+            if profiler is not None:
+                start = profiler.timer()
+            if any(c.key in inlined for c in node.children):
+                res, nodes = self._compute_fused(node, inlined, results, values)
+            elif self._is_cumulative(node) and node.children[0].key in cumulative:
+                x, n = node.children
+                if x.key not in prefix_sums:
+                    prefix_sums[x.key] = rolling.CumulativeWindows(results[x.key])
+                res = getattr(prefix_sums[x.key], self.CUMULATIVE_FUNCTIONS[node.name])(n.value)
+                nodes = [node]
+                cumulative[x.key] -= 1
+                if cumulative[x.key] == 0:
+                    prefix_sums.pop(x.key)
+            else:
+                args = [results[c.key] for c in node.children]
+                res, nodes = self._compute(node, args, values), [node]
+            inputs = [c for n in nodes for c in n.children if c.key not in inlined]
+            if node.kind not in (Node.CONST, Node.FUNC):
+                self.n_computed += len(nodes)
+                if use_cache:
+                    self.cache.put(node.key, res)
+                if profiler is not None:
+                    elapsed = profiler.timer() - start
+                    name, kind = (node.name, node.kind) if len(nodes) == 1 else ('fused', 'fused')
+                    children = [record_ids[c.key] for c in inputs if c.key in record_ids]
+                    record_ids[node.key] = profiler.record(name, kind, elapsed, res, children, expr=node.key)
+            results[node.key] = res
+
+            # release results no longer needed in this batch
+            for child in inputs:
+                n_refs[child.key] -= 1
+                if n_refs[child.key] == 0 and child.key not in root_keys:
+                    results.pop(child.key, None)
+
+        if profiler is not None:
+            for i, root in enumerate(roots):
+                profiler.add_root(names[i] if names else root.key, record_ids.get(root.key))
+        return [results[root.key] for root in roots]
+
+
+# task of _evaluate_shard, set by the parent process before forking workers
+_shard_task = None
+
+
+def _evaluate_shard(i):
+    """Evaluate nodes of _shard_task on the i-th shard of symbols."""
+    dag, nodes, data, ann_dts, trade_dts, shards = _shard_task
+    columns = shards[i]
+    values = {name: df.loc[:, columns] if isinstance(df, pd.DataFrame) else df
+              for name, df in data.items()}
+    if isinstance(ann_dts, pd.DataFrame):
+        ann_dts = ann_dts.loc[:, columns]
+    return dag.evaluate(nodes, values, ann_dts=ann_dts, trade_dts=trade_dts, use_cache=False)
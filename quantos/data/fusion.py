@@ -0,0 +1,209 @@
+# encoding: utf-8
+"""
+Fused evaluation of element-wise sub-expressions.
+
+Evaluating ((close - low) - (high - close)) / (high - low) node by node
+creates a new DataFrame for every operator, and aligns operands every time.
+A FusedKernel evaluates such a tree of element-wise nodes at once on the raw
+arrays of its leaves: labels are checked once, and temporary arrays are
+reused as outputs of later operators, so only a few panel-sized buffers are
+allocated whatever the size of the tree.
+
+Results are the same as Parser operators, including NaN of comparison and
+logical operators where either operand is NaN.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+# -----------------------------------------------------
+# element-wise operations on arrays, out may be one of the arguments
+def _binary(ufunc):
+    def func(args, out):
+        return ufunc(args[0], args[1], out=out)
+    return func
+
+
+def _unary(ufunc):
+    def func(args, out):
+        return ufunc(args[0], out=out)
+    return func
+
+
+def _compare(ufunc):
+    def func(args, out):
+        a, b = args
+        mask = np.logical_or(np.isnan(a), np.isnan(b))
+        ufunc(a, b, out=out)
+        out[mask] = np.nan
+        return out
+    return func
+
+
+def _round(args, out):
+    return np.around(args[0], out=out)
+
+
+def _signed_power(args, out):
+    x, e = args
+    sign = np.sign(x)
+    np.absolute(x, out=out)
+    np.power(out, e, out=out)
+    return np.multiply(out, sign, out=out)
+
+
+def _if(args, out):
+    cond, b, c = args
+    mask = np.isnan(cond)
+    res = np.where(cond, b, c).astype(float)
+    res[mask] = np.nan
+    return res
+
+
+def _tail(args, out):
+    x, lower, upper, new_value = args
+    return np.where((x >= lower) & (x <= upper), new_value, x).astype(float)
+
+
+OP1_KERNELS = {'-': _unary(np.negative), 'sin': _unary(np.sin), 'cos': _unary(np.cos), 'tan': _unary(np.tan),
+               'sqrt': _unary(np.sqrt), 'log': _unary(np.log), 'abs': _unary(np.absolute),
+               'ceil': _unary(np.ceil), 'floor': _unary(np.floor), 'round': _round,
+               'sign': _unary(np.sign), 'exp': _unary(np.exp)}
+OP2_KERNELS = {'+': _binary(np.add), '-': _binary(np.subtract), '*': _binary(np.multiply),
+               '/': _binary(np.true_divide), '%': _binary(np.mod), '^': _binary(np.power),
+               '==': _compare(np.equal), '!=': _compare(np.not_equal),
+               '>': _compare(np.greater), '<': _compare(np.less),
+               '>=': _compare(np.greater_equal), '<=': _compare(np.less_equal),
+               '&&': _compare(np.logical_and), '||': _compare(np.logical_or)}
+CALL_KERNELS = {'min': _binary(np.minimum), 'max': _binary(np.maximum), 'pow': _binary(np.power),
+                'signedpower': _signed_power, 'if': _if, 'tail': _tail}
+
+# {Node.kind: kernels by Node.name}
+KERNELS = {'op1': OP1_KERNELS, 'op2': OP2_KERNELS, 'call': CALL_KERNELS}
+
+
+def is_elementwise(node):
+    """Whether a formula_dag.Node can be evaluated by a FusedKernel."""
+    return node.name in KERNELS.get(node.kind, ())
+
+
+class FusedKernel(object):
+    """
+    A tree of element-wise nodes evaluated at once.
+
+    Attributes
+    ----------
+    root : Node
+    nodes : list of Node
+        Nodes of the tree, children before parents.
+    leaves : list of Node
+        Inputs of the tree, whose results must be given when calling the kernel.
+
+    """
+    def __init__(self, root, is_leaf):
+        """
+        Parameters
+        ----------
+        root : Node
+        is_leaf : callable
+            Takes a child node and returns whether it is an input rather than part of the tree.
+
+        """
+        self.root = root
+        self.nodes = []
+        self.leaves = []
+
+        leaf_pos = dict()
+        # each instruction: (kernel function, argument refs); a ref is ('leaf', i) or ('tmp', j)
+        self._program = []
+        stack = [(root, False)]
+        tmp_pos = dict()
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, True))
+                for child in reversed(node.children):
+                    if not is_leaf(child):
+                        stack.append((child, False))
+                continue
+
+            refs = []
+            for child in node.children:
+                if is_leaf(child):
+                    if child.key not in leaf_pos:
+                        leaf_pos[child.key] = len(self.leaves)
+                        self.leaves.append(child)
+                    refs.append(('leaf', leaf_pos[child.key]))
+                else:
+                    refs.append(('tmp', tmp_pos[id(child)]))
+            tmp_pos[id(node)] = len(self.nodes)
+            self.nodes.append(node)
+            self._program.append((self._kernel(node), refs))
+
+    @staticmethod
+    def _kernel(node):
+        return KERNELS[node.kind][node.name]
+
+    def __call__(self, leaf_values):
+        """
+        Evaluate the tree.
+
+        Parameters
+        ----------
+        leaf_values : list
+            Results of self.leaves, DataFrames of the same index and columns, or numbers.
+
+        Returns
+        -------
+        pd.DataFrame or None
+            None if leaves can not be fused (e.g. different labels, need alignment), then
+            nodes should be evaluated one by one.
+
+        """
+        frames = [v for v in leaf_values if isinstance(v, pd.DataFrame)]
+        if not frames:
+            return None
+        index, columns = frames[0].index, frames[0].columns
+        inputs = []
+        for v in leaf_values:
+            if isinstance(v, pd.DataFrame):
+                if not (v.index.equals(index) and v.columns.equals(columns)):
+                    return None
+                try:
+                    inputs.append(np.asarray(v.values, dtype=float))
+                except (TypeError, ValueError):
+                    return None
+            elif isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+                inputs.append(v)
+            else:
+                return None
+        shape = frames[0].shape
+
+        temps = []
+        free = []
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            for func, refs in self._program:
+                args = []
+                owned = []
+                for kind, i in refs:
+                    if kind == 'leaf':
+                        args.append(inputs[i])
+                    else:
+                        args.append(temps[i])
+                        owned.append(temps[i])
+                        temps[i] = None  # every temporary has exactly one consumer
+                # write into a consumed temporary when possible, never into inputs
+                if owned:
+                    out = owned.pop(0)
+                elif free:
+                    out = free.pop()
+                else:
+                    out = np.empty(shape)
+                res = func(args, out)
+                if res is not out:
+                    free.append(out)
+                free.extend(owned)
+                temps.append(res)
+
+        return pd.DataFrame(temps[-1], index=index, columns=columns)
@@ -0,0 +1,186 @@
+# encoding: utf-8
+"""
+Point-in-time store of all versions of quarterly financial statements.
+
+One report_date of a security can be announced several times: the original
+statement and later restatements, each with its own ann_date. DataView.data_q
+keeps one row per report_date (the original version); StatementVersions keeps
+every version in long format (one row per symbol, report_date and ann_date),
+which only costs the rows actually announced.
+
+With all versions, what was known on a trade date is well defined:
+
+- expand gives the value of a field on each trade date, from the latest
+  report visible on that date, in its latest version visible on that date;
+- vintage gives all reports as known just after an announcement date, which
+  is used to recompute formulas only for the dates after a restatement.
+
+A missing value (NaN) in a version means the field is not part of that version
+(e.g. rows of income statement and balance sheet merged), so the previous
+version of the field is kept.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+SYMBOL = 'symbol'
+REPORT_DATE = 'report_date'
+ANN_DATE = 'ann_date'
+KEYS = [SYMBOL, REPORT_DATE, ANN_DATE]
+
+# ann_date and report_date are int dates like 20170331, far below this
+_DATE_SPAN = 10 ** 8
+
+
+class StatementVersions(object):
+    """
+    All versions of quarterly statements.
+
+    Attributes
+    ----------
+    data : pd.DataFrame
+        Columns are symbol, report_date, ann_date and fields. Sorted by (symbol, report_date, ann_date).
+
+    """
+    def __init__(self, data=None):
+        self.data = pd.DataFrame(columns=KEYS)
+        if data is not None:
+            self.add(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def fields(self):
+        return [c for c in self.data.columns if c not in KEYS]
+
+    def add(self, df):
+        """
+        Add versions of statements. Versions already stored are merged field by field.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Columns are symbol, report_date, ann_date and fields.
+
+        Returns
+        -------
+        pd.DataFrame
+            Keys (symbol, report_date, ann_date) of versions not stored before,
+            with a column is_restatement: whether an earlier version of the same report exists.
+
+        """
+        df = df.dropna(subset=KEYS).copy()
+        df[REPORT_DATE] = df[REPORT_DATE].astype(np.int64)
+        df[ANN_DATE] = df[ANN_DATE].astype(np.int64)
+
+        old = self.data
+        merged = pd.concat([old, df], axis=0, ignore_index=True)
+        # same version from different statements (or added twice): keep non-missing fields
+        merged = merged.groupby(KEYS, sort=True).first().reset_index()
+        merged[REPORT_DATE] = merged[REPORT_DATE].astype(np.int64)
+        merged[ANN_DATE] = merged[ANN_DATE].astype(np.int64)
+        for field in merged.columns:
+            if field not in KEYS and merged[field].dtype == object:
+                merged[field] = pd.to_numeric(merged[field], errors='ignore')
+        self.data = merged
+
+        new = df.loc[:, KEYS].drop_duplicates()
+        if len(old):
+            old_keys = pd.MultiIndex.from_arrays([old[k].values for k in KEYS])
+            new = new.loc[~pd.MultiIndex.from_arrays([new[k].values for k in KEYS]).isin(old_keys)]
+        new = new.sort_values([ANN_DATE, SYMBOL, REPORT_DATE]).reset_index(drop=True)
+        first_ann = merged.groupby([SYMBOL, REPORT_DATE])[ANN_DATE].min()
+        first_ann = first_ann.reindex(pd.MultiIndex.from_arrays([new[SYMBOL].values, new[REPORT_DATE].values]))
+        new['is_restatement'] = new[ANN_DATE].values > first_ann.values
+        return new
+
+    def _is_first(self):
+        """Whether each row is the first version of its report."""
+        first_ann = self.data.groupby([SYMBOL, REPORT_DATE])[ANN_DATE].transform('min')
+        return self.data[ANN_DATE].values == first_ann.values
+
+    def first_versions(self):
+        """Rows of the original version of each report."""
+        return self.data.loc[self._is_first()]
+
+    def restatements(self):
+        """Keys (symbol, report_date, ann_date) of versions after the original one, sorted by ann_date."""
+        res = self.data.loc[~self._is_first(), KEYS]
+        return res.sort_values([ANN_DATE, SYMBOL, REPORT_DATE]).reset_index(drop=True)
+
+    def vintage(self, ann_date, symbols=None):
+        """
+        All reports as known after announcements on ann_date, and reports first announced later.
+
+        Each report has the latest of its versions announced on or before ann_date (its original version
+        if first announced later), field by field. Its ann_date is that of the original version,
+        i.e. when the report became visible.
+
+        Parameters
+        ----------
+        ann_date : int
+        symbols : list of str, optional
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is (symbol, report_date), columns are ann_date and fields.
+
+        """
+        df = self.data
+        if symbols is not None:
+            df = df.loc[df[SYMBOL].isin(symbols)]
+        first_ann = df.groupby([SYMBOL, REPORT_DATE])[ANN_DATE].transform('min')
+        df = df.loc[(df[ANN_DATE].values <= ann_date) | (df[ANN_DATE].values == first_ann.values)]
+
+        gp = df.groupby([SYMBOL, REPORT_DATE], sort=True)
+        res = gp[self.fields].last()  # latest non-missing value of each field
+        res.insert(0, ANN_DATE, gp[ANN_DATE].min())
+        return res
+
+    def expand(self, field, trade_dts, symbols):
+        """
+        Point-in-time value of field on each trade date: the latest report visible on that date,
+        in its latest version visible on that date.
+
+        Parameters
+        ----------
+        field : str
+        trade_dts : np.ndarray
+        symbols : list of str
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is trade_dts, column is symbols.
+
+        """
+        trade_dts = np.asarray(trade_dts, dtype=np.int64)
+        df = self.data.loc[self.data[field].notnull() & self.data[SYMBOL].isin(symbols), KEYS + [field]]
+        code = pd.Index(symbols).get_indexer(df[SYMBOL].values).astype(np.int64)
+
+        # announcements of each symbol in time order; an announcement changes the visible value
+        # only if its report is the latest report announced so far (new report or restatement of it)
+        order = np.lexsort((df[REPORT_DATE].values, df[ANN_DATE].values, code))
+        code = code[order]
+        ann = df[ANN_DATE].values[order]
+        report = df[REPORT_DATE].values[order]
+        value = df[field].values[order].astype(float)
+
+        latest_report = pd.Series(report).groupby(code).cummax().values
+        effective = report == latest_report
+        keys = code[effective] * _DATE_SPAN + ann[effective]
+        value = value[effective]
+
+        res = np.full((len(trade_dts), len(symbols)), np.nan)
+        if len(keys):
+            query = (np.arange(len(symbols), dtype=np.int64)[np.newaxis, :] * _DATE_SPAN
+                     + trade_dts[:, np.newaxis])
+            idx = np.searchsorted(keys, query, side='right') - 1
+            idx_valid = np.maximum(idx, 0)
+            # the announcement found must be of the same symbol
+            found = (idx >= 0) & (keys[idx_valid] // _DATE_SPAN == query // _DATE_SPAN)
+            res[found] = value[idx_valid[found]]
+        return pd.DataFrame(res, index=trade_dts, columns=symbols)
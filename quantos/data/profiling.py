@@ -0,0 +1,197 @@
+# encoding: utf-8
+"""
+Per-operator profiling of formula evaluation.
+
+Pass a FormulaProfiler to Parser.evaluate or FormulaDAG.evaluate (or call
+DataView.enable_profiling) and every operator / function call is recorded
+with its wall time, output shape, output bytes and ratio of NaN in output.
+Records are kept across evaluations, so one profiler can aggregate all
+formulas of a DataView:
+
+>>> profiler = dv.enable_profiling()
+>>> dv.add_formula('alpha1', 'GroupApply(Standardize, Decay_linear(close, 10))', is_quarterly=False)
+>>> print profiler.report()
+>>> profiler.save_folded('formulas.folded')
+
+Each record only times the call itself, arguments are recorded separately as
+its children, so the time of a record is its "self time". save_folded writes
+the folded stack format read by flamegraph.pl / speedscope, where each stack
+is formula;outer call;...;inner call.
+
+"""
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+
+
+def _describe(obj):
+    """Shape, bytes and NaN ratio of a result."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        arr = obj.values
+    elif isinstance(obj, np.ndarray):
+        arr = obj
+    else:
+        return (), 0, np.nan
+
+    nbytes = int(arr.nbytes)
+    if arr.size == 0 or arr.dtype.kind not in 'fc':
+        return arr.shape, nbytes, 0.0
+    return arr.shape, nbytes, float(np.count_nonzero(np.isnan(arr))) / arr.size
+
+
+class FormulaProfiler(object):
+    """
+    Collect timing and memory information of operators during formula evaluation.
+
+    Attributes
+    ----------
+    records : list of dict
+        One record per call, with keys: id, formula, name, kind, expr, time (seconds),
+        shape, nbytes, nan_ratio, children (ids of records of arguments).
+    roots : list of tuple
+        (formula label, id of record of its result) of each evaluated formula.
+
+    """
+    COLUMNS = ['formula', 'name', 'kind', 'expr', 'time', 'shape', 'nbytes', 'nan_ratio']
+
+    def __init__(self):
+        self.records = []
+        self.roots = []
+
+    # for timing a call: start = profiler.timer(); ...; profiler.record(..., profiler.timer() - start)
+    timer = staticmethod(default_timer)
+
+    def clear(self):
+        self.records = []
+        self.roots = []
+
+    def record(self, name, kind, elapsed, result, children=(), expr=None):
+        """
+        Record a call.
+
+        Parameters
+        ----------
+        name : str
+            Operator or function name, e.g. '+', 'Ts_Mean'.
+        kind : str
+            Kind of call, e.g. 'op2', 'call', 'var', 'fused'.
+        elapsed : float
+            Wall time of the call in seconds, arguments excluded.
+        result : object
+            Output of the call.
+        children : list of int
+            Ids of records of arguments.
+        expr : str, optional
+            Sub-expression evaluated.
+
+        Returns
+        -------
+        int
+            Id of the new record.
+
+        """
+        shape, nbytes, nan_ratio = _describe(result)
+        rid = len(self.records)
+        self.records.append({'id': rid, 'formula': None, 'name': name, 'kind': kind, 'expr': expr,
+                             'time': elapsed, 'shape': shape, 'nbytes': nbytes, 'nan_ratio': nan_ratio,
+                             'children': list(children)})
+        return rid
+
+    def add_root(self, formula, rid):
+        """
+        Attribute a record and its descendants (if not yet attributed) to a formula.
+
+        Parameters
+        ----------
+        formula : str
+            Name of formula.
+        rid : int or None
+            Id of record of result of formula. None if nothing was computed (e.g. cached).
+
+        """
+        if rid is None:
+            return
+        self.roots.append((formula, rid))
+        stack = [rid]
+        while stack:
+            rec = self.records[stack.pop()]
+            if rec['formula'] is None:
+                rec['formula'] = formula
+                stack.extend(rec['children'])
+
+    # -----------------------------------------------------
+    # reports
+    def to_frame(self):
+        """All records as a DataFrame, one row per call."""
+        return pd.DataFrame(self.records, columns=['id'] + self.COLUMNS).set_index('id')
+
+    def summary(self, by='name'):
+        """
+        Aggregate records.
+
+        Parameters
+        ----------
+        by : {'name', 'formula', 'kind', 'expr'}
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is value of by, columns are number of calls, total and mean time, share of total time,
+            total output bytes, max output bytes and mean NaN ratio. Sorted by total time, descending.
+
+        """
+        df = self.to_frame()
+        if df.empty:
+            return pd.DataFrame(columns=['calls', 'time', 'mean_time', 'time_pct',
+                                         'nbytes', 'max_nbytes', 'nan_ratio'])
+        df[by] = df[by].fillna('')
+        gp = df.groupby(by)
+        res = pd.DataFrame({'calls': gp['time'].count(),
+                            'time': gp['time'].sum(),
+                            'mean_time': gp['time'].mean(),
+                            'nbytes': gp['nbytes'].sum(),
+                            'max_nbytes': gp['nbytes'].max(),
+                            'nan_ratio': gp['nan_ratio'].mean()})
+        total = df['time'].sum()
+        res['time_pct'] = res['time'] / total * 100.0 if total > 0 else 0.0
+        res = res.sort_values('time', ascending=False)
+        return res[['calls', 'time', 'mean_time', 'time_pct', 'nbytes', 'max_nbytes', 'nan_ratio']]
+
+    def report(self, by='name', n=20):
+        """Summary as text table of the top n rows."""
+        df = self.summary(by=by).head(n)
+        return df.to_string(float_format=lambda x: '{:.4f}'.format(x))
+
+    def folded_stacks(self):
+        """
+        Self time of each call path, in folded stack format.
+
+        A record shared by several formulas (e.g. by FormulaDAG) is counted once, under the first formula.
+
+        Returns
+        -------
+        list of str
+            Lines of 'formula;call;...;call microseconds'.
+
+        """
+        lines = []
+        visited = set()
+        for formula, rid in self.roots:
+            stack = [(rid, [formula.replace(';', ',').replace(' ', '')])]
+            while stack:
+                rid, path = stack.pop()
+                if rid in visited:
+                    continue
+                visited.add(rid)
+                rec = self.records[rid]
+                path = path + [rec['name'].replace(';', ',')]
+                lines.append('{} {:d}'.format(';'.join(path), int(round(rec['time'] * 1e6))))
+                for child in reversed(rec['children']):
+                    stack.append((child, path))
+        return lines
+
+    def save_folded(self, path):
+        """Write folded stacks to a file, input of flamegraph.pl."""
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.folded_stacks()) + '\n')
@@ -21,6 +21,9 @@ import numpy as np
 import pandas as pd
 
 from quantos.data.align import align
+from quantos.data import rolling
+from quantos.data import cross_section
+from quantos.data import quarterly
 
 TNUMBER = 0
 TOP1 = 1
@@ -278,7 +281,11 @@ class Parser(object):
             'ConditionRank': self.cond_rank,
             'Standardize': self.standardize,
             'Cutoff': self.cutoff,
+            'QuantileClip': self.quantile_clip,
+            'RankGauss': self.rank_gauss,
             'GroupApply': self.group_apply,
+            'Neutralize': self.neutralize,
+            'IndustryNeutral': self.industry_netural,
             # time series
             'Ewma': self.ewma,
             'Sma':self.sma,
@@ -297,10 +304,20 @@ class Parser(object):
             'Ts_Max': self.ts_max,
             'Ts_Skewness': self.ts_skew,
             'Ts_Kurtosis': self.ts_kurt,
+            'Ts_Rank': self.ts_rank,
+            'Ts_ArgMax': self.ts_argmax,
+            'Ts_ArgMin': self.ts_argmin,
+            'Ts_Beta': self.ts_beta,  # rolling regression versus another series, e.g. benchmark
+            'Ts_Residual': self.ts_residual,
             'Tail': self.tail,
             'Step': self.step,
             'Decay_linear': self.decay_linear,
             'Decay_exp': self.decay_exp,
+            # quarterly, on data indexed by report date before expansion
+            'TTM': quarterly.ttm,  # trailing twelve months
+            'SQ': quarterly.single_quarter,  # single quarter from cumulative
+            'YoY': quarterly.yoy,
+            'QoQ': quarterly.qoq,
             # inplace
             'Pow': np.power,
             'SignedPower': self.signed_power,
@@ -343,6 +360,8 @@ class Parser(object):
         self.ann_dts = None
         self.trade_dts = None
         self.df_group = None
+        # {id(quarterly DataFrame): (DataFrame, expanded DataFrame)}, valid during one evaluation
+        self._align_cache = dict()
     
     # -----------------------------------------------------
     # functions
@@ -504,20 +523,20 @@ class Parser(object):
     
     def corr(self, x, y, n):
         (x, y) = self._align_bivariate(x, y)
-        return pd.rolling_corr(x, y, n)
+        return rolling.rolling_corr(x, y, n)
     
     def cov(self, x, y, n):
         (x, y) = self._align_bivariate(x, y)
-        return pd.rolling_cov(x, y, n)
+        return rolling.rolling_cov(x, y, n)
     
     def std_dev(self, x, n):
-        return pd.rolling_std(x, n)
+        return rolling.rolling_std(x, n)
     
     def sum(self, x, n):
-        return pd.rolling_sum(x, n)
+        return rolling.rolling_sum(x, n)
     
     def count_nans(self, x, n):
-        return n - pd.rolling_count(x, n)
+        return rolling.rolling_count_nans(x, n)
     
     def delay(self, x, n):
         return x.shift(n)
@@ -535,22 +554,50 @@ class Parser(object):
         return res
     
     def ts_mean(self, x, n):
-        return pd.rolling_mean(x, n)
+        return rolling.rolling_mean(x, n)
     
     def ts_min(self, x, n):
-        return pd.rolling_min(x, n)
+        return rolling.rolling_min(x, n)
     
     def ts_max(self, x, n):
-        return pd.rolling_max(x, n)
+        return rolling.rolling_max(x, n)
     
     def ts_kurt(self, x, n):
-        return pd.rolling_kurt(x, n)
+        return rolling.rolling_kurt(x, n)
     
     def ts_skew(self, x, n):
-        return pd.rolling_skew(x, n)
+        return rolling.rolling_skew(x, n)
     
     def product(self, x, n):
-        return pd.rolling_apply(x, n, np.product)
+        return rolling.rolling_product(x, n)
+
+    def ts_rank(self, x, n):
+        return rolling.rolling_rank(x, n)
+
+    def ts_argmax(self, x, n):
+        return rolling.rolling_argmax(x, n)
+
+    def ts_argmin(self, x, n):
+        return rolling.rolling_argmin(x, n)
+
+    @staticmethod
+    def _broadcast_columns(x, like):
+        """Repeat a single series (e.g. benchmark) to all columns of like."""
+        if isinstance(x, pd.DataFrame) and x.shape[1] == 1 and isinstance(like, pd.DataFrame) and like.shape[1] > 1:
+            x = x.iloc[:, 0]
+        if isinstance(x, pd.Series) and isinstance(like, pd.DataFrame):
+            values = x.reindex(like.index).values
+            return pd.DataFrame(np.repeat(values[:, np.newaxis], like.shape[1], axis=1),
+                                index=like.index, columns=like.columns)
+        return x
+
+    def ts_beta(self, y, x, n):
+        (y, x) = self._align_bivariate(y, x)
+        return rolling.rolling_beta(y, self._broadcast_columns(x, y), n)
+
+    def ts_residual(self, y, x, n):
+        (y, x) = self._align_bivariate(y, x)
+        return rolling.rolling_residual(y, self._broadcast_columns(x, y), n)
 
     def rank(self, x):
         x = self._align_univariate(x)
@@ -577,10 +624,10 @@ class Parser(object):
         return np.dot(x, step) / np.sum(step)
     
     def decay_linear(self, x, n):
-        return pd.rolling_apply(x, n, self.decay_linear_array)
+        return rolling.decay_linear(x, n)
     
     def decay_exp(self, x, f, n):
-        return pd.rolling_apply(x, n, self.decay_exp_array, args=[f])
+        return rolling.decay_exp(x, n, f)
     
     def signed_power(self, x, e):
         signs = np.sign(x)
@@ -598,15 +645,7 @@ class Parser(object):
     # TODO: all cross-section operations support in-group modification: neutral, extreme values, standardize.
     def group_rank(self, x, group):
         x = self._align_univariate(x)
-        vals = pd.Series(group.values.ravel()).unique()
-        df = None
-        for val in vals:
-            rank = x[group == val].rank(axis=1)
-            if df is None:
-                df = rank
-            else:
-                df.fillna(rank, inplace=True)
-        return df
+        return cross_section.group_rank(x, group)
 
     def group_apply(self, func, df_arg, *args, **kwargs):
         """
@@ -628,15 +667,25 @@ class Parser(object):
         """
         df_group = self.df_group
         
+        # align for quarterly data
+        df_arg = self._align_univariate(df_arg)
+        
+        # operators with vectorized implementation over all (date, group) pairs
+        vectorized = {self.rank: cross_section.group_rank,
+                      self.standardize: cross_section.zscore,
+                      self.cutoff: cross_section.winsorize_mad,
+                      self.quantile_clip: cross_section.quantile_clip,
+                      self.rank_gauss: cross_section.rank_gauss}
+        if (func in vectorized and isinstance(df_arg, pd.DataFrame)
+                and isinstance(df_group, (pd.DataFrame, pd.Series)) and not kwargs):
+            return vectorized[func](df_arg, df_group, *args)
+        
         def gp_apply(df_value, df_group_):
             """df has date index and symbol columns."""
             gp = df_value.groupby(by=df_group_, axis=1)
             res_apply = gp.apply(func, *args, **kwargs)
             return res_apply
 
-        # align for quarterly data
-        df_arg = self._align_univariate(df_arg)
-        
         # validity check
         if isinstance(df_group, pd.DataFrame):
             if df_group.shape[0] == 1 or df_group.shape[1] == 1:
@@ -660,57 +709,105 @@ class Parser(object):
         res = pd.concat(res_list, axis=0)
         return res
 
-    @staticmethod
-    def standardize(df):
-        """Cross section."""
-        axis = 1
-        mean = df.mean(axis=axis)
-        std = df.std(axis=axis)
-        return df.sub(mean, axis=0).div(std, axis=0)
-    
-    def cutoff(self, df, z_score=3.0):
+    def standardize(self, df, mask=None):
         """
-        Cut off extreme values using Median Absolute Deviation
-        
+        Cross section z-score: (x - mean) / std, ignoring NaN.
+
         Parameters
         ----------
         df : pd.DataFrame
+        mask : pd.DataFrame, optional
+            Universe, e.g. index_member. Elements not in universe (zero or NaN) are NaN in result
+            and not in mean / std.
 
         Returns
         -------
         pd.DataFrame
 
         """
-        axis = 1
-        x = df.values
-        
-        median = np.median(x, axis=axis)
-        diff = x - median
-        diff_abs = np.abs(diff)
-        mad = np.median(np.abs(diff), axis=axis)
-        
-        mask = diff_abs > z_score * mad
-        x[mask] = z_score * mad * np.sign(diff[mask]) + median
+        df = self._align_univariate(df)
+        return cross_section.zscore(df, mask=mask)
+    
+    def cutoff(self, df, z_score=3.0, mask=None):
+        """
+        Cut off extreme values using Median Absolute Deviation, ignoring NaN.
         
-        return pd.DataFrame(index=df.index, columns=df.columns, data=x)
+        Parameters
+        ----------
+        df : pd.DataFrame
+        z_score : float
+            Values are clipped to median +- z_score * MAD of each date.
+        mask : pd.DataFrame, optional
+            Universe, e.g. index_member.
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        df = self._align_univariate(df)
+        return cross_section.winsorize_mad(df, z_score=z_score, mask=mask)
+    
+    def quantile_clip(self, df, lower=0.01, upper=0.99, mask=None):
+        """Clip values of each date to its [lower, upper] quantiles, ignoring NaN."""
+        df = self._align_univariate(df)
+        return cross_section.quantile_clip(df, lower=lower, upper=upper, mask=mask)
+    
+    def rank_gauss(self, df, mask=None):
+        """Ranks of each date mapped to quantiles of standard normal distribution, ignoring NaN."""
+        df = self._align_univariate(df)
+        return cross_section.rank_gauss(df, mask=mask)
     
     def industry_netural(self, x, group):
-        pass
+        x = self._align_univariate(x)
+        return cross_section.group_neutralize(x, group)
+
+    def neutralize(self, x, *exposures):
+        """
+        Residual of regression of x on groups (self.df_group, e.g. industry) and exposures on each date.
+
+        Parameters
+        ----------
+        x : pd.DataFrame
+        exposures : pd.DataFrame
+            e.g. Log(total_mv). No exposure means demeaning within groups.
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        x = self._align_univariate(x)
+        exposures = [self._align_univariate(e) for e in exposures]
+        return cross_section.neutralize(x, exposures, self.df_group)
     
     # -----------------------------------------------------
     # align functions
+    def _align(self, df):
+        """Expand quarterly df to trade_dts. The same df is only expanded once during an evaluation."""
+        key = id(df)
+        cached = self._align_cache.get(key, None)
+        if cached is None or cached[0] is not df:
+            # keep df referenced, so that its id is not reused by another object
+            cached = (df, align(df, self.ann_dts, self.trade_dts))
+            self._align_cache[key] = cached
+        return cached[1]
+
+    def clear_align_cache(self):
+        self._align_cache = dict()
+
     def _align_bivariate(self, df1, df2, force_align=False):
         if isinstance(df1, pd.DataFrame) and isinstance(df2, pd.DataFrame):
             len1 = len(df1.index)
             len2 = len(df2.index)
             if (self.ann_dts is not None) and (self.trade_dts is not None):
                 if len1 > len2:
-                    df2 = align(df2, self.ann_dts, self.trade_dts)
+                    df2 = self._align(df2)
                 elif len1 < len2:
-                    df1 = align(df1, self.ann_dts, self.trade_dts)
+                    df1 = self._align(df1)
                 elif force_align:
-                    df1 = align(df1, self.ann_dts, self.trade_dts)
-                    df2 = align(df2, self.ann_dts, self.trade_dts)
+                    df1 = self._align(df1)
+                    df2 = self._align(df2)
         return (df1, df2)
 
     def _align_univariate(self, df1):
@@ -719,7 +816,7 @@ class Parser(object):
                 len1 = len(df1.index)
                 len2 = len(self.trade_dts)
                 if len1 != len2:
-                    return align(df1, self.ann_dts, self.trade_dts)
+                    return self._align(df1)
         return df1
 
     # -----------------------------------------------------
@@ -901,7 +998,7 @@ class Parser(object):
         self.tokens = tokenstack
         return Expression(tokenstack, self.ops1, self.ops2, self.functions)
     
-    def evaluate(self, values, ann_dts=None, trade_dts=None, df_group=None):
+    def evaluate(self, values, ann_dts=None, trade_dts=None, df_group=None, profiler=None):
         """
         Evaluate the value of expression using. Data of different frequency will be automatically expanded.
         
@@ -916,6 +1013,8 @@ class Parser(object):
         df_group : pd.DataFrame
             Group codes used by group_apply function.
             Index is date, column is symbol.
+        profiler : FormulaProfiler, optional
+            If not None, time and output of every operator and function call are recorded.
 
         Returns
         -------
@@ -925,13 +1024,18 @@ class Parser(object):
         self.ann_dts = ann_dts
         self.trade_dts = trade_dts
         self.df_group = df_group
+        self.clear_align_cache()
         
         values = values or {}
         nstack = []
+        # with profiler, ids of records of each item on nstack (name of function for functions)
+        id_stack = []
         L = len(self.tokens)
         for i in range(0, L):
             item = self.tokens[i]
             type_ = item.type_
+            if profiler is not None:
+                start = profiler.timer()
             if type_ == TNUMBER:
                 nstack.append(item.number_)
             elif type_ == TOP2:
@@ -962,10 +1066,43 @@ class Parser(object):
                     raise Exception(f + ' is not a function')
             else:
                 raise Exception('invalid Expression')
+            if profiler is not None:
+                self._profile_token(profiler, item, nstack[-1], profiler.timer() - start, id_stack)
         if len(nstack) > 1:
             raise Exception('invalid Expression (parity)')
+        if profiler is not None:
+            profiler.add_root(self.expression, id_stack[0][0] if id_stack[0] else None)
         return nstack[0]
 
+    @staticmethod
+    def _profile_token(profiler, item, result, elapsed, id_stack):
+        """Record evaluation of a token and keep id_stack in step with the value stack."""
+        def pop_ids():
+            # a function passed as argument (e.g. Rank of GroupApply) has no record
+            ids = id_stack.pop()
+            return ids if isinstance(ids, list) else []
+
+        type_ = item.type_
+        if type_ == TNUMBER:
+            id_stack.append([])
+        elif type_ == TVAR:
+            id_stack.append(item.index_ if callable(result) else [])
+        elif type_ == TOP1:
+            children = pop_ids()
+            id_stack.append([profiler.record(item.index_, 'op1', elapsed, result, children)])
+        elif type_ == TOP2:
+            children2 = pop_ids()
+            children = pop_ids() + children2
+            if item.index_ == ',':
+                # building argument list, not an operation
+                id_stack.append(children)
+            else:
+                id_stack.append([profiler.record(item.index_, 'op2', elapsed, result, children)])
+        elif type_ == TFUNCALL:
+            children = pop_ids()
+            name = id_stack.pop()
+            id_stack.append([profiler.record(name, 'call', elapsed, result, children)])
+
     # -----------------------------------------------------
     # Other
     def error_parsing(self, column, msg):
@@ -0,0 +1,106 @@
+# encoding: utf-8
+"""
+Vectorized transforms of quarterly financial statement data.
+
+Inputs are (report_date x symbol) DataFrames of values reported cumulatively
+within the fiscal year (Q1, H1, Q1-Q3, annual), as in data_q of DataView.
+Report dates must be quarter ends (e.g. 20170331).
+
+Each transform puts the whole frame on a complete grid of consecutive quarters
+once, so previous quarters are found by position instead of by Delay / Delta
+on rows, which silently use the wrong quarter when a report is missing.
+A result is NaN where a quarter it needs is missing. Results are indexed by
+the original report dates, so they are expanded to trade dates afterwards by
+announcement date like any quarterly field.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+QUARTER_END_MMDD = (331, 630, 930, 1231)
+
+
+def _to_grid(df):
+    """
+    Put df on a complete grid of consecutive quarters.
+
+    Returns
+    -------
+    grid : np.ndarray
+        float array of shape (n_quarters, n_symbols).
+    pos : np.ndarray
+        Row of each row of df in grid.
+    quarter : np.ndarray
+        Quarter in fiscal year (0 to 3) of each row of grid.
+
+    """
+    dates = np.asarray(df.index, dtype=np.int64)
+    mmdd = dates % 10000
+    q = np.searchsorted(QUARTER_END_MMDD, mmdd)
+    if not np.all(np.append(QUARTER_END_MMDD, 0)[q] == mmdd):
+        raise ValueError("quarterly operators need data indexed by report date (quarter end), "
+                         "they must be applied before data are expanded to trade dates.")
+    serial = dates // 10000 * 4 + q
+    first = serial.min() if len(serial) else 0
+    pos = serial - first
+    n_quarters = pos.max() + 1 if len(pos) else 0
+
+    grid = np.full((n_quarters, df.shape[1]), np.nan)
+    grid[pos] = np.asarray(df.values, dtype=float)
+    quarter = (np.arange(n_quarters) + first) % 4
+    return grid, pos, quarter
+
+
+def _lag(grid, k):
+    """Rows of k quarters before, NaN if before the first quarter. k is a scalar or an array by row."""
+    rows = np.arange(grid.shape[0]) - k
+    res = grid[np.maximum(rows, 0)]
+    res[rows < 0] = np.nan
+    return res
+
+
+def _from_grid(res, pos, df):
+    return pd.DataFrame(res[pos], index=df.index, columns=df.columns)
+
+
+def _growth(cur, prev):
+    """Relative change, divided by absolute value of previous, so that growth from a loss is positive."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = (cur - prev) / np.abs(prev)
+    res[prev == 0] = np.nan
+    return res
+
+
+def single_quarter(df):
+    """Value of each single quarter from values cumulative in fiscal year: Q1 as is, others minus previous."""
+    grid, pos, quarter = _to_grid(df)
+    res = grid - _lag(grid, 1)
+    is_first = quarter == 0
+    res[is_first] = grid[is_first]
+    return _from_grid(res, pos, df)
+
+
+def ttm(df):
+    """
+    Trailing twelve months from values cumulative in fiscal year:
+    current + annual of last year - same quarter of last year. Annual values are kept as is.
+
+    """
+    grid, pos, quarter = _to_grid(df)
+    res = grid + _lag(grid, quarter + 1) - _lag(grid, 4)
+    is_annual = quarter == 3
+    res[is_annual] = grid[is_annual]
+    return _from_grid(res, pos, df)
+
+
+def yoy(df):
+    """Growth versus the same quarter of last year."""
+    grid, pos, _ = _to_grid(df)
+    return _from_grid(_growth(grid, _lag(grid, 4)), pos, df)
+
+
+def qoq(df):
+    """Growth versus the previous quarter. Apply to single_quarter (or ttm) of cumulative values."""
+    grid, pos, _ = _to_grid(df)
+    return _from_grid(_growth(grid, _lag(grid, 1)), pos, df)
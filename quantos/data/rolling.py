@@ -0,0 +1,698 @@
+# encoding: utf-8
+"""
+Vectorized rolling-window kernels for time series operators of the formula parser.
+
+All kernels work along axis 0 (dates) of a whole (date x symbol) panel at once
+and are O(N) in the number of dates, independent of window size (except
+decay_linear, which is a single C-level convolution).
+
+NaN semantics follow pd.rolling_* of pandas 0.20 with default min_periods,
+i.e. the result is NaN unless the window contains n valid values
+(rolling_count_nans, like pd.rolling_count, also counts partial windows).
+
+Inputs can be np.ndarray (1D or 2D), pd.Series or pd.DataFrame; outputs have
+the same type, index and columns.
+
+"""
+import itertools
+import time
+from math import factorial
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+_EPS = np.finfo(float).eps
+
+
+# -----------------------------------------------------
+# input / output helpers
+def _to_2d(x):
+    """Return float 2D array (copied only if necessary) and whether x was 1D."""
+    arr = np.asarray(x, dtype=float)
+    if arr.ndim == 1:
+        return arr[:, np.newaxis], True
+    return arr, False
+
+
+def _like(res, x, is_1d):
+    """Wrap result to the type of x."""
+    if is_1d:
+        res = res[:, 0]
+    if isinstance(x, pd.DataFrame):
+        return pd.DataFrame(res, index=x.index, columns=x.columns)
+    elif isinstance(x, pd.Series):
+        return pd.Series(res, index=x.index, name=x.name)
+    return res
+
+
+def _univariate(kernel):
+    def wrapper(x, n, *args):
+        arr, is_1d = _to_2d(x)
+        n = int(n)
+        if n < 1:
+            raise ValueError("window must be a positive integer, but n = {}".format(n))
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            res = kernel(arr, n, *args)
+        return _like(res, x, is_1d)
+    wrapper.__name__ = kernel.__name__
+    wrapper.__doc__ = kernel.__doc__
+    return wrapper
+
+
+def _bivariate(kernel):
+    def wrapper(x, y, n):
+        if isinstance(x, (pd.DataFrame, pd.Series)) and isinstance(y, (pd.DataFrame, pd.Series)):
+            x, y = x.align(y)
+        arr_x, is_1d = _to_2d(x)
+        arr_y, _ = _to_2d(y)
+        n = int(n)
+        if n < 1:
+            raise ValueError("window must be a positive integer, but n = {}".format(n))
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            res = kernel(arr_x, arr_y, n)
+        return _like(res, x, is_1d)
+    wrapper.__name__ = kernel.__name__
+    wrapper.__doc__ = kernel.__doc__
+    return wrapper
+
+
+# -----------------------------------------------------
+# building blocks
+def _cumsum0(a):
+    """Cumulative sum along axis 0 with a leading row of zeros."""
+    res = np.empty((a.shape[0] + 1,) + a.shape[1:], dtype=float)
+    res[0] = 0.0
+    np.cumsum(a, axis=0, out=res[1:])
+    return res
+
+
+def _window_diff(c, n):
+    """Window sums from cumulative sums c (with leading zeros). Rows without a full window are NaN."""
+    length = c.shape[0] - 1
+    res = np.empty((length,) + c.shape[1:], dtype=float)
+    res[:n - 1] = np.nan
+    if n <= length:
+        res[n - 1:] = c[n:] - c[:-n]
+    return res
+
+
+def _window_sum(a, n):
+    return _window_diff(_cumsum0(a), n)
+
+
+def _mask_incomplete(res, mask, n):
+    """Set NaN in place where the window ending at the row has less than n rows or any missing value."""
+    res[:n - 1] = np.nan
+    if n <= mask.shape[0] and mask.any():
+        cum = np.cumsum(mask, axis=0, dtype=np.int32)
+        n_missing = cum[n - 1:].copy()
+        n_missing[1:] -= cum[:-n]
+        res[n - 1:][n_missing > 0] = np.nan
+    return res
+
+
+def _fill_nan(arr, value=0.0):
+    mask = np.isnan(arr)
+    if mask.any():
+        arr = np.where(mask, value, arr)
+    return arr, mask
+
+
+def _block_ends(arr, n):
+    """Values of the first and of the last row of the block of n rows of each row (0 if missing)."""
+    length = arr.shape[0]
+    start = np.arange(length) // n * n
+    first = arr[start]
+    last = arr[np.minimum(start + n - 1, length - 1)]
+    first[np.isnan(first)] = 0.0
+    last[np.isnan(last)] = 0.0
+    return first, last
+
+
+def _block_cumsum(p, n, reverse=False):
+    """Cumulative sums along axis 0 restarting at each block of n rows, from the end of the block if reverse."""
+    length, n_cols = p.shape
+    n_blocks = -(-length // n)
+    pad = n_blocks * n - length
+    blocks = np.concatenate([p, np.zeros((pad, n_cols))], axis=0).reshape(n_blocks, n, n_cols)
+    if reverse:
+        res = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1]
+    else:
+        res = np.cumsum(blocks, axis=1)
+    return res.reshape(n_blocks * n, n_cols)[:length]
+
+
+def _binom(n, k):
+    return factorial(n) // (factorial(k) * factorial(n - k))
+
+
+def _local_sums(arrays, mask, n, terms):
+    """
+    Window sums of products of powers of centered values, e.g. terms [(1,), (2,)] give sums of c and c^2.
+
+    Rows are split into blocks of n rows. A window of n rows is a suffix of one block and a prefix
+    of the next (or one whole block), so its sums are two cumulative sums within blocks. Values of a
+    prefix are centered at the first row of their block, values of a suffix at the last row of their
+    block, and the suffix is moved to the center of the prefix with the binomial expansion. Both
+    centers are rows of the window, so rounding errors only depend on values in the window, not on
+    values before it (e.g. an outlier).
+
+    Parameters
+    ----------
+    arrays : list of np.ndarray
+    mask : np.ndarray of bool
+        Missing rows. Windows containing them are meant to be masked by _mask_incomplete.
+    n : int
+    terms : list of tuple of int
+        Exponents of each array.
+
+    Returns
+    -------
+    sums : list of np.ndarray
+        Sums of each term about the centers at the window's last row, NaN where there is no full window.
+    centers : list of np.ndarray
+        Center of each array at each row.
+
+    """
+    length, n_cols = arrays[0].shape
+    sums = [np.full((length, n_cols), np.nan) for _ in terms]
+    ends = [_block_ends(a, n) for a in arrays]
+    centers = [first for first, _ in ends]
+    if n > length:
+        return sums, centers
+
+    def power_cache(center_idx):
+        # powers[k][e] of values of array k centered at first (0) or last (1) row of the block
+        res = []
+        for a, e in zip(arrays, ends):
+            c = np.where(mask, 0.0, a - e[center_idx])
+            res.append([None, c])
+        return res
+
+    def product(powers, f):
+        p = None
+        for k, e in enumerate(f):
+            if not e:
+                continue
+            pk = powers[k]
+            while len(pk) <= e:
+                pk.append(pk[-1] * pk[1])
+            p = pk[e] if p is None else p * pk[e]
+        return p
+
+    prefix_powers, suffix_powers = power_cache(0), power_cache(1)
+    m = length - n + 1
+    start = np.arange(m)
+    # windows starting at the first row of a block are that block: no prefix of the next block
+    split = (start % n != 0)[:, np.newaxis]
+    count = (n - start % n)[:, np.newaxis].astype(float)
+    # powers of the distance from the center of the suffix to the center of the prefix
+    shifts = [[None, last[:m] - first[n - 1:]] for first, last in ends]
+
+    suffix = dict()
+    for term, res in zip(terms, sums):
+        win = res[n - 1:]
+        np.multiply(_block_cumsum(product(prefix_powers, term), n)[n - 1:], split, out=win)
+        for f in itertools.product(*[range(e + 1) for e in term]):
+            if not any(f):
+                part = count
+            else:
+                if f not in suffix:
+                    suffix[f] = _block_cumsum(product(suffix_powers, f), n, reverse=True)[:m]
+                part = suffix[f]
+            coef = 1
+            for d, e, k in zip(shifts, term, f):
+                if e > k:
+                    part = part * product([d], (e - k,))
+                    coef *= _binom(e, k)
+            if coef != 1:
+                part = part * float(coef)
+            win += part
+    return sums, centers
+
+
+# -----------------------------------------------------
+# kernels
+@_univariate
+def rolling_sum(arr, n):
+    """Rolling sum of n rows."""
+    arr0, mask = _fill_nan(arr)
+    res = _window_sum(arr0, n)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def rolling_mean(arr, n):
+    """Rolling mean of n rows."""
+    arr0, mask = _fill_nan(arr)
+    res = _window_sum(arr0, n) / n
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+def _var(arr, n, ddof):
+    mask = np.isnan(arr)
+    if n <= ddof:
+        return np.full(arr.shape, np.nan), mask
+    (s1, s2), _ = _local_sums([arr], mask, n, [(1,), (2,)])
+    ssq = s2 - s1 * s1 / n
+    # windows of constant values are treated as exactly zero variance
+    ssq[ssq <= 64 * _EPS * s2] = 0.0
+    res = ssq / (n - ddof)
+    _mask_incomplete(res, mask, n)
+    return res, mask
+
+
+@_univariate
+def rolling_var(arr, n, ddof=1):
+    """Rolling variance of n rows."""
+    return _var(arr, n, ddof)[0]
+
+
+@_univariate
+def rolling_std(arr, n, ddof=1):
+    """Rolling standard deviation of n rows."""
+    return np.sqrt(_var(arr, n, ddof)[0])
+
+
+@_bivariate
+def rolling_cov(x, y, n):
+    """Rolling covariance (ddof=1) of n rows. A row is missing if either x or y is missing."""
+    mask = np.isnan(x) | np.isnan(y)
+    if n <= 1:
+        return np.full(x.shape, np.nan)
+    (sx, sy, sxy), _ = _local_sums([x, y], mask, n, [(1, 0), (0, 1), (1, 1)])
+    res = (sxy - sx * sy / n) / (n - 1)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_bivariate
+def rolling_corr(x, y, n):
+    """Rolling Pearson correlation of n rows. NaN if either window is constant."""
+    mask = np.isnan(x) | np.isnan(y)
+    if n <= 1:
+        return np.full(x.shape, np.nan)
+    (sx, sy, sxx, syy, sxy), _ = _local_sums([x, y], mask, n, [(1, 0), (0, 1), (2, 0), (0, 2), (1, 1)])
+
+    ssq_x = sxx - sx * sx / n
+    ssq_y = syy - sy * sy / n
+    res = (sxy - sx * sy / n) / np.sqrt(ssq_x * ssq_y)
+    res[(ssq_x <= 64 * _EPS * sxx) | (ssq_y <= 64 * _EPS * syy)] = np.nan
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def rolling_skew(arr, n):
+    """Rolling skewness of n rows, bias corrected as pandas."""
+    mask = np.isnan(arr)
+    if n < 3:
+        return np.full(arr.shape, np.nan)
+    (s1, s2, s3), _ = _local_sums([arr], mask, n, [(1,), (2,), (3,)])
+    tol = 64 * _EPS * s2
+    a = s1 / n
+    b = s2 / n - a * a
+    c = s3 / n - a * a * a - 3 * a * b
+    res = np.sqrt(n * (n - 1.0)) * c / ((n - 2.0) * b ** 1.5)
+    res[b * n <= tol] = np.nan
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def rolling_kurt(arr, n):
+    """Rolling excess kurtosis of n rows, bias corrected as pandas."""
+    mask = np.isnan(arr)
+    if n < 4:
+        return np.full(arr.shape, np.nan)
+    (s1, s2, s3, s4), _ = _local_sums([arr], mask, n, [(1,), (2,), (3,), (4,)])
+    tol = 64 * _EPS * s2
+    a = s1 / n
+    r = a * a
+    b = s2 / n - r
+    r = r * a
+    c = s3 / n - r - 3 * a * b
+    r = r * a
+    d = s4 / n - r - 6 * b * a * a - 4 * c * a
+    k = (n * n - 1.0) * d / (b * b) - 3 * (n - 1.0) ** 2
+    res = k / ((n - 2.0) * (n - 3.0))
+    res[b * n <= tol] = np.nan
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+def _rolling_extreme(arr, n, func, fill):
+    """
+    van Herk / Gil-Werman algorithm: split rows into blocks of n, then window extreme
+    is the extreme of a block suffix and the next block prefix. About 3 comparisons per element.
+
+    """
+    arr0, mask = _fill_nan(arr, fill)
+    length, n_cols = arr0.shape
+    res = np.full(arr0.shape, np.nan)
+    if n > length:
+        return res
+
+    n_blocks = -(-length // n)
+    pad = n_blocks * n - length
+    blocks = np.concatenate([arr0, np.full((pad, n_cols), fill)], axis=0).reshape(n_blocks, n, n_cols)
+    prefix = func.accumulate(blocks, axis=1).reshape(n_blocks * n, n_cols)
+    suffix = func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(n_blocks * n, n_cols)
+
+    res[n - 1:] = func(suffix[:length - n + 1], prefix[n - 1:length])
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def rolling_min(arr, n):
+    """Rolling minimum of n rows."""
+    return _rolling_extreme(arr, n, np.minimum, np.inf)
+
+
+@_univariate
+def rolling_max(arr, n):
+    """Rolling maximum of n rows."""
+    return _rolling_extreme(arr, n, np.maximum, -np.inf)
+
+
+@_univariate
+def rolling_count_nans(arr, n):
+    """
+    Number of missing values in the last n rows, like n - pd.rolling_count(x, n).
+    Rows before the first row also count as missing.
+
+    """
+    valid = _cumsum0((~np.isnan(arr)).astype(float))
+    length = arr.shape[0]
+    end = np.arange(1, length + 1)
+    start = np.maximum(end - n, 0)
+    return n - (valid[end] - valid[start])
+
+
+@_univariate
+def rolling_product(arr, n):
+    """Rolling product of n rows, computed as sum of logarithms with separate sign and zero counts."""
+    arr0, mask = _fill_nan(arr, 1.0)
+    is_zero = arr0 == 0
+    n_zero = _window_sum(is_zero.astype(float), n)
+    n_neg = _window_sum((arr0 < 0).astype(float), n)
+    log_abs = np.log(np.abs(np.where(is_zero, 1.0, arr0)))
+
+    res = np.exp(_window_sum(log_abs, n))
+    res[np.mod(n_neg, 2) == 1] *= -1
+    res[n_zero > 0] = 0.0
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def decay_linear(arr, n):
+    """Weighted mean of last n rows, weights are 1, 2, ..., n from oldest to latest."""
+    arr0, mask = _fill_nan(arr)
+    weights = np.arange(n, 0, -1, dtype=float)  # by lag
+    weights /= weights.sum()
+    res = signal.lfilter(weights, [1.0], arr0, axis=0)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def decay_exp(arr, n, f):
+    """Weighted mean of last n rows, weights are f^(n-1), ..., f, 1 from oldest to latest."""
+    f = float(f)
+    arr0, mask = _fill_nan(arr)
+    weights = np.power(f, np.arange(n, dtype=float))  # by lag
+    total = weights.sum()
+    if 0 < abs(f) < 1:
+        # recursive form y[t] = f * y[t-1] + x[t] - f^n * x[t-n], O(1) per element
+        b = np.zeros(n + 1)
+        b[0] = 1.0
+        b[n] = -f ** n
+        res = signal.lfilter(b, [1.0, -f], arr0, axis=0) / total
+    else:
+        res = signal.lfilter(weights / total, [1.0], arr0, axis=0)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+def _lagged(arr, k, fill=np.nan):
+    """arr shifted down by k rows."""
+    if k == 0:
+        return arr
+    res = np.empty_like(arr)
+    res[:k] = fill
+    res[k:] = arr[:-k]
+    return res
+
+
+@_univariate
+def rolling_rank(arr, n):
+    """
+    Rank of the latest value among the last n rows, from 1 (smallest) to n (largest), ties get average rank.
+
+    Each of the n - 1 older rows is compared with the latest row on the whole panel at once,
+    which is O(n) vectorized passes, with no Python loop over windows.
+
+    """
+    mask = np.isnan(arr)
+    res = np.ones(arr.shape)
+    for k in range(1, min(n, arr.shape[0])):
+        older = _lagged(arr, k)
+        res += (older < arr)
+        res += 0.5 * (older == arr)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+def _rolling_arg_extreme(arr, n, better):
+    """Position (1 = oldest, n = latest) of the first extreme value in each window of n rows."""
+    mask = np.isnan(arr)
+    best = np.full(arr.shape, np.nan)
+    res = np.full(arr.shape, np.nan)
+    if n > arr.shape[0]:
+        return res
+    # scan rows of each window from oldest to latest, only strictly better values move the position
+    for pos in range(1, n + 1):
+        value = _lagged(arr, n - pos)
+        is_better = np.isnan(best) | better(value, best)
+        np.copyto(best, value, where=is_better)
+        np.copyto(res, pos, where=is_better)
+    _mask_incomplete(res, mask, n)
+    return res
+
+
+@_univariate
+def rolling_argmax(arr, n):
+    """Position of the maximum in the last n rows, 1 is the oldest row and n is the latest row."""
+    return _rolling_arg_extreme(arr, n, np.greater)
+
+
+@_univariate
+def rolling_argmin(arr, n):
+    """Position of the minimum in the last n rows, 1 is the oldest row and n is the latest row."""
+    return _rolling_arg_extreme(arr, n, np.less)
+
+
+def _regression(y, x, n):
+    """Rolling OLS of y on x (with intercept) from cumulative cross-moments: beta, alpha."""
+    mask = np.isnan(x) | np.isnan(y)
+    if n <= 1:
+        nan = np.full(y.shape, np.nan)
+        return nan, nan.copy(), mask
+    # moments are about local centers, alpha is shifted back afterwards
+    (sx, sy, sxx, sxy), (center_x, center_y) = _local_sums([x, y], mask, n, [(1, 0), (0, 1), (2, 0), (1, 1)])
+
+    ssq_x = sxx - sx * sx / n
+    beta = (sxy - sx * sy / n) / ssq_x
+    beta[ssq_x <= 64 * _EPS * sxx] = np.nan
+    alpha = (sy - beta * sx) / n + center_y - beta * center_x
+    _mask_incomplete(beta, mask, n)
+    _mask_incomplete(alpha, mask, n)
+    return beta, alpha, mask
+
+
+@_bivariate
+def rolling_beta(y, x, n):
+    """Slope of OLS regression of y on x (with intercept) over the last n rows."""
+    return _regression(y, x, n)[0]
+
+
+@_bivariate
+def rolling_residual(y, x, n):
+    """Residual of the latest row of y, from OLS regression of y on x (with intercept) over the last n rows."""
+    beta, alpha, _ = _regression(y, x, n)
+    return y - alpha - beta * x
+
+
+# -----------------------------------------------------
+# many windows of one input
+class CumulativeWindows(object):
+    """
+    Prefix sums of one input shared by sum-based kernels of any window size.
+
+    Evaluating e.g. Ts_Mean(x, n) for n in 5..60 costs one cumulative pass
+    over x plus one difference per window, instead of one full kernel per window.
+    Results are the same as rolling_sum, rolling_mean, rolling_count_nans and rolling_product;
+    rolling_std and rolling_var are computed by the kernels.
+
+    Examples
+    --------
+    >>> cw = CumulativeWindows(df)
+    >>> means = [cw.rolling_mean(n) for n in range(5, 61, 5)]
+
+    """
+    def __init__(self, x):
+        self._x = x
+        self._arr, self._is_1d = _to_2d(x)
+        self._mask = np.isnan(self._arr)
+        self._cums = dict()
+
+    def _cum(self, name):
+        """Cumulative sums (with leading zeros) computed on first use."""
+        if name not in self._cums:
+            arr, mask = self._arr, self._mask
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                if name == 'value':
+                    res = _cumsum0(np.where(mask, 0.0, arr))
+                elif name == 'missing':
+                    res = np.cumsum(mask, axis=0, dtype=np.int32)
+                elif name == 'valid':
+                    res = _cumsum0((~mask).astype(float))
+                elif name in ('zero', 'negative', 'log_abs'):
+                    arr0 = np.where(mask, 1.0, arr)
+                    is_zero = arr0 == 0
+                    if name == 'zero':
+                        res = _cumsum0(is_zero.astype(float))
+                    elif name == 'negative':
+                        res = _cumsum0((arr0 < 0).astype(float))
+                    else:
+                        res = _cumsum0(np.log(np.abs(np.where(is_zero, 1.0, arr0))))
+                else:
+                    raise ValueError("unknown cumulative sum: {}".format(name))
+            self._cums[name] = res
+        return self._cums[name]
+
+    def _mask_incomplete(self, res, n):
+        """Same as _mask_incomplete, using the shared cumulative count of missing values."""
+        res[:n - 1] = np.nan
+        if n <= res.shape[0] and self._mask.any():
+            cum = self._cum('missing')
+            n_missing = cum[n - 1:].copy()
+            n_missing[1:] -= cum[:-n]
+            res[n - 1:][n_missing > 0] = np.nan
+        return res
+
+    def _check(self, n):
+        n = int(n)
+        if n < 1:
+            raise ValueError("window must be a positive integer, but n = {}".format(n))
+        return n
+
+    def rolling_sum(self, n):
+        n = self._check(n)
+        res = _window_diff(self._cum('value'), n)
+        return _like(self._mask_incomplete(res, n), self._x, self._is_1d)
+
+    def rolling_mean(self, n):
+        n = self._check(n)
+        res = _window_diff(self._cum('value'), n) / n
+        return _like(self._mask_incomplete(res, n), self._x, self._is_1d)
+
+    def _var(self, n, ddof):
+        # rounding errors of differences of prefix sums of squares grow with the values since the first row
+        # (one outlier spoils all later windows), so variance uses the block-wise sums of _var
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            return _var(self._arr, n, ddof)[0]
+
+    def rolling_var(self, n, ddof=1):
+        return _like(self._var(self._check(n), ddof), self._x, self._is_1d)
+
+    def rolling_std(self, n, ddof=1):
+        return _like(np.sqrt(self._var(self._check(n), ddof)), self._x, self._is_1d)
+
+    def rolling_count_nans(self, n):
+        n = self._check(n)
+        valid = self._cum('valid')
+        end = np.arange(1, self._arr.shape[0] + 1)
+        start = np.maximum(end - n, 0)
+        return _like(n - (valid[end] - valid[start]), self._x, self._is_1d)
+
+    def rolling_product(self, n):
+        n = self._check(n)
+        n_zero = _window_diff(self._cum('zero'), n)
+        n_neg = _window_diff(self._cum('negative'), n)
+        with np.errstate(invalid='ignore', over='ignore'):
+            res = np.exp(_window_diff(self._cum('log_abs'), n))
+            res[np.mod(n_neg, 2) == 1] *= -1
+            res[n_zero > 0] = 0.0
+        return _like(self._mask_incomplete(res, n), self._x, self._is_1d)
+
+
+# -----------------------------------------------------
+# benchmark
+def benchmark(n_dates=2500, n_symbols=3000, n=20, n_symbols_apply=100, seed=0):
+    """
+    Compare kernels with pandas rolling functions used previously by Parser.
+
+    Baselines based on pd.rolling_apply run a Python function per window, so they
+    are timed on n_symbols_apply columns and scaled to n_symbols.
+
+    Returns
+    -------
+    pd.DataFrame
+        Seconds of pandas and kernel, and speedup of each operator.
+
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.randn(n_dates, n_symbols).cumsum(axis=0) + 100.0
+    data[rs.rand(n_dates, n_symbols) < 0.01] = np.nan
+    df = pd.DataFrame(data)
+    df2 = pd.DataFrame(rs.randn(n_dates, n_symbols))
+    df_small = df.iloc[:, :n_symbols_apply]
+    scale = n_symbols * 1.0 / n_symbols_apply
+
+    def decay_linear_array(x):
+        step = np.arange(1, len(x) + 1)
+        return np.dot(x, step) / np.sum(step)
+
+    def decay_exp_array(x, f):
+        fs = np.power(f, np.arange(len(x))[::-1])
+        return np.dot(x, fs) / np.sum(fs)
+
+    cases = [('Sum', lambda: df.rolling(n).sum(), lambda: rolling_sum(df, n), 1.0),
+             ('Ts_Mean', lambda: df.rolling(n).mean(), lambda: rolling_mean(df, n), 1.0),
+             ('StdDev', lambda: df.rolling(n).std(), lambda: rolling_std(df, n), 1.0),
+             ('Ts_Min', lambda: df.rolling(n).min(), lambda: rolling_min(df, n), 1.0),
+             ('Ts_Max', lambda: df.rolling(n).max(), lambda: rolling_max(df, n), 1.0),
+             ('Ts_Skewness', lambda: df.rolling(n).skew(), lambda: rolling_skew(df, n), 1.0),
+             ('Ts_Kurtosis', lambda: df.rolling(n).kurt(), lambda: rolling_kurt(df, n), 1.0),
+             ('Covariance', lambda: df.rolling(n).cov(df2), lambda: rolling_cov(df, df2, n), 1.0),
+             ('Correlation', lambda: df.rolling(n).corr(df2), lambda: rolling_corr(df, df2, n), 1.0),
+             ('CountNans', lambda: n - df.rolling(n, min_periods=0).count(),
+              lambda: rolling_count_nans(df, n), 1.0),
+             ('Product', lambda: df_small.rolling(n).apply(np.prod),
+              lambda: rolling_product(df, n), scale),
+             ('Decay_linear', lambda: df_small.rolling(n).apply(decay_linear_array),
+              lambda: decay_linear(df, n), scale),
+             ('Decay_exp', lambda: df_small.rolling(n).apply(decay_exp_array, args=(0.9,)),
+              lambda: decay_exp(df, n, 0.9), scale)]
+
+    rows = []
+    for name, func_pandas, func_kernel, factor in cases:
+        t0 = time.time()
+        func_pandas()
+        t_pandas = (time.time() - t0) * factor
+        t0 = time.time()
+        func_kernel()
+        t_kernel = time.time() - t0
+        rows.append((name, t_pandas, t_kernel, t_pandas / t_kernel))
+    res = pd.DataFrame(rows, columns=['operator', 'pandas', 'kernel', 'speedup']).set_index('operator')
+    return res
+
+
+if __name__ == "__main__":
+    print(benchmark())
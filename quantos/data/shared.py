@@ -0,0 +1,243 @@
+# encoding: utf-8
+"""
+Share one DataView between processes through memory-mapped files.
+
+publish writes the data of a DataView once into a folder, by default in shared memory
+(/dev/shm, a RAM-backed file system on Linux):
+
+- numeric columns of each DataFrame (data_d, data_q, benchmark) are stored as one
+  2-D array per dtype in .npy files, rows are dates and columns in the order of the layout;
+- other columns (e.g. trade_status), group data, statements, the index and columns of each
+  DataFrame and the meta data of the DataView (fields, symbol, dates...) are pickled into
+  layout.pkl, which is written last and marks the folder complete.
+
+attach maps the .npy files read-only (np.load with mmap_mode='r') and builds DataFrames on top of them
+without copying: all processes that attach read the same physical pages, only the small pickled
+parts are loaded in each process.
+
+Lifecycle: the publishing process owns the folder and removes it with SharedDataView.unlink
+(or by using the handle in a with statement). Processes that attached before keep valid data until
+they exit, because a mapped file stays alive until it is unmapped; attaching after unlink fails.
+Data of an attached DataView is read-only: operations that create new data (append_df, add_formula...)
+work on copies, writing into the arrays in place raises ValueError.
+
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from pandas.core.internals import BlockManager, make_block
+
+from quantos.data.pit import StatementVersions
+
+
+LAYOUT_FILE = 'layout.pkl'
+FRAMES = ['data_d', 'data_q', '_data_benchmark']
+
+
+def _default_root():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _publish_frame(df, folder, name):
+    """
+    Save numeric columns of df to one .npy file per dtype, return layout of df with other columns.
+
+    """
+    layout = {'index': df.index, 'columns': df.columns, 'blocks': [], 'others': None}
+    is_numeric = np.array([dtype.kind in 'biuf' for dtype in df.dtypes])
+    dtypes = df.dtypes.values
+    for dtype in sorted(set(dtypes[is_numeric]), key=str):
+        loc = np.flatnonzero(is_numeric & (dtypes == dtype))
+        fn = '{}.{}.npy'.format(name, dtype)
+        np.save(os.path.join(folder, fn), np.ascontiguousarray(df.iloc[:, loc].values))
+        layout['blocks'].append((fn, loc))
+    if not is_numeric.all():
+        loc = np.flatnonzero(~is_numeric)
+        layout['others'] = (df.iloc[:, loc].values, loc)
+    return layout
+
+
+def _attach_frame(layout, folder):
+    """
+    DataFrame of a layout, numeric columns on read-only memory maps.
+
+    Each file is one block of the DataFrame placed at the positions of its columns,
+    so columns are in the published order without copying the data.
+
+    """
+    # blocks hold values transposed: one row per column
+    parts = [(np.load(os.path.join(folder, fn), mmap_mode='r'), loc) for fn, loc in layout['blocks']]
+    if layout['others'] is not None:
+        parts.append(layout['others'])
+    if not parts:
+        return pd.DataFrame(index=layout['index'], columns=layout['columns'])
+    blocks = [make_block(values.T, placement=loc) for values, loc in parts]
+    return pd.DataFrame(BlockManager(blocks, [layout['columns'], layout['index']]))
+
+
+class SharedDataView(object):
+    """
+    Handle of a DataView published by publish.
+
+    Attributes
+    ----------
+    folder : str
+        Pass it to attach in other processes.
+    owner : bool
+        True in the publishing process: only the owner removes the folder.
+
+    Examples
+    --------
+    >>> with publish(dv) as shared:
+    ...     # in other processes
+    ...     dv_worker = attach(shared.folder)
+
+    """
+    def __init__(self, folder, owner=False):
+        self.folder = folder
+        self.owner = owner
+
+    def attach(self):
+        """DataView on the shared data, see attach."""
+        return attach(self.folder)
+
+    def unlink(self):
+        """Remove the shared data. Only the owner removes it."""
+        if self.owner and os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+    def __getstate__(self):
+        # copies sent to other processes never own the data
+        return {'folder': self.folder, 'owner': False}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def publish(dv, folder=None):
+    """
+    Write data of a DataView to a folder to be attached by other processes.
+
+    Parameters
+    ----------
+    dv : DataView
+    folder : str, optional
+        New folder to create. Default a new folder in /dev/shm (the temporary folder if there is no /dev/shm).
+
+    Returns
+    -------
+    SharedDataView
+        Owner of the folder.
+
+    """
+    if folder is None:
+        folder = os.path.join(_default_root(), 'quantos_dataview_' + uuid.uuid4().hex)
+    folder = os.path.abspath(folder)
+    os.makedirs(folder)
+
+    try:
+        layout = {'meta': {key: dv.__dict__[key] for key in dv.meta_data_list},
+                  'frames': {},
+                  'data_group': dv._data_group,
+                  'statements': dv.statements.data if len(dv.statements) else None}
+        for name in FRAMES:
+            df = getattr(dv, name)
+            if df is not None:
+                layout['frames'][name] = _publish_frame(df, folder, name.lstrip('_'))
+
+        fn = os.path.join(folder, LAYOUT_FILE)
+        with open(fn + '.tmp', 'wb') as f:
+            pickle.dump(layout, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(fn + '.tmp', fn)
+    except Exception:
+        shutil.rmtree(folder)
+        raise
+    return SharedDataView(folder, owner=True)
+
+
+def attach(folder):
+    """
+    DataView on data published to folder, without copying numeric data.
+
+    Parameters
+    ----------
+    folder : str or SharedDataView
+
+    Returns
+    -------
+    DataView
+
+    """
+    from quantos.data.dataview import DataView
+
+    if isinstance(folder, SharedDataView):
+        folder = folder.folder
+    fn = os.path.join(folder, LAYOUT_FILE)
+    if not os.path.exists(fn):
+        raise IOError("No published DataView in {}".format(folder))
+    with open(fn, 'rb') as f:
+        layout = pickle.load(f)
+
+    dv = DataView()
+    for name in FRAMES:
+        frame = layout['frames'].get(name)
+        setattr(dv, name, None if frame is None else _attach_frame(frame, folder))
+    dv._data_group = layout['data_group']
+    dv.statements = StatementVersions(layout['statements'])
+    dv.__dict__.update(layout['meta'])
+    dv._formula_dag = None
+    return dv
+
+
+def benchmark(n_dates=1000, n_symbols=3000, n_fields=10, n_repeat=3, seed=0):
+    """
+    Compare time to attach a published DataView with time to unpickle a copy of it,
+    which is what each worker does when a DataView is sent to it.
+
+    Returns
+    -------
+    pd.Series
+        Size of data (MB), best seconds of n_repeat runs of unpickle and attach, and speedup.
+
+    """
+    from quantos.data.dataview import DataView
+
+    rs = np.random.RandomState(seed)
+    dates = np.arange(n_dates) + 20000000
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    fields = ['field{:d}'.format(i) for i in range(n_fields)]
+    columns = pd.MultiIndex.from_product([symbols, fields], names=['symbol', 'field'])
+    dv = DataView()
+    dv.symbol, dv.fields = symbols, fields
+    dv.start_date, dv.end_date = dates[0], dates[-1]
+    dv.data_d = pd.DataFrame(rs.randn(n_dates, len(columns)), index=dates, columns=columns)
+
+    def best_time(func):
+        times = []
+        for _ in range(n_repeat):
+            t0 = time.time()
+            res = func()
+            times.append(time.time() - t0)
+            del res
+        return min(times)
+
+    s = pickle.dumps(dv, protocol=pickle.HIGHEST_PROTOCOL)
+    t_pickle = best_time(lambda: pickle.loads(s))
+    with publish(dv) as shared:
+        t_attach = best_time(lambda: attach(shared.folder))
+    return pd.Series([dv.data_d.values.nbytes / 2.0 ** 20, t_pickle, t_attach, t_pickle / t_attach],
+                     index=['size_mb', 'unpickle', 'attach', 'speedup'])
@@ -0,0 +1,245 @@
+# encoding: utf-8
+"""
+Incremental evaluation of formulas, one cross-section (date) at a time.
+
+For live trading, factor values of today are needed as soon as today's data
+arrive. Instead of evaluating formulas on the whole history again, each node
+of the formula DAG keeps a small state:
+
+- window functions (Ts_Mean, Delay, Delta, Corr, Decay_linear, ...) keep the
+  last rows of their arguments, and compute the last row only;
+- Ewma and Sma keep the exponentially weighted average and weight, updated
+  with the same recursion as pandas ewm (adjust=True);
+- element-wise operators and cross-section functions (Rank, GroupApply, ...)
+  only need the current cross-section.
+
+So each update costs O(symbols x nodes), times the window length for window
+functions, and results are the same as Parser / FormulaDAG on the same history.
+
+"""
+import math
+from collections import OrderedDict, deque
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.formula_dag import FormulaDAG, Node
+
+
+class _EwmState(object):
+    """
+    Exponentially weighted mean of each symbol, same as pd.DataFrame.ewm(alpha=alpha, adjust=True).mean().
+
+    """
+    def __init__(self, alpha):
+        self.factor = 1.0 - alpha
+        self.avg = None
+        self.old_wt = None
+
+    def update(self, cur):
+        if self.avg is None:
+            self.avg = cur.copy()
+            self.old_wt = np.ones_like(cur)
+            return self.avg.copy()
+
+        is_obs = ~np.isnan(cur)
+        started = ~np.isnan(self.avg)
+        self.old_wt[started] *= self.factor
+
+        both = started & is_obs
+        changed = both & (self.avg != cur)
+        self.avg[changed] = ((self.old_wt[changed] * self.avg[changed] + cur[changed])
+                             / (self.old_wt[changed] + 1.0))
+        self.old_wt[both] += 1.0
+
+        first = ~started & is_obs
+        self.avg[first] = cur[first]
+        return self.avg.copy()
+
+
+class StreamingEvaluator(object):
+    """
+    Evaluate registered formulas incrementally on a fixed list of symbols.
+
+    Attributes
+    ----------
+    symbols : list of str
+    dag : FormulaDAG
+    formulas : OrderedDict
+        {name: root Node}
+    n_updates : int
+
+    Examples
+    --------
+    >>> se = StreamingEvaluator(['600030.SH', '000002.SZ'])
+    >>> se.add_formula('alpha1', 'Rank(Ts_Mean(close / open, 5))')
+    >>> se.warm_up({'close': df_close, 'open': df_open})
+    >>> res = se.update(20171020, {'close': sr_close, 'open': sr_open})
+
+    """
+    def __init__(self, symbols, dag=None):
+        self.symbols = list(symbols)
+        self.dag = FormulaDAG() if dag is None else dag
+        self.formulas = OrderedDict()
+        self.n_updates = 0
+
+        self._order = []
+        self._windows = dict()  # {node key: [deque of rows for each child]}
+        self._ewms = dict()  # {node key: _EwmState}
+
+    def add_formula(self, name, formula, func_name_style='upper'):
+        """
+        Register a formula. Must be called before the first update.
+
+        Parameters
+        ----------
+        name : str
+        formula : str
+        func_name_style : {'upper', 'lower'}
+
+        """
+        if self.n_updates:
+            raise ValueError("Formulas must be added before the first update.")
+        root = self.dag.compile(formula, func_name_style=func_name_style)
+
+        order = self.dag.topological_order([root])
+        for node in order:
+            if node.kind != Node.CALL or node.key in self._windows or node.key in self._ewms:
+                continue
+            if node.name in ('ewma', 'sma'):
+                self._ewms[node.key] = _EwmState(self._ewm_alpha(node))
+            elif node.name in self.dag.WINDOW_FUNCTIONS:
+                size = self.dag._node_lookback(node, [0] * len(node.children))
+                if size is None:
+                    raise ValueError("window of {} must be a constant".format(node.key))
+                self._windows[node.key] = [deque(maxlen=size + 1) for _ in node.children]
+            elif node.name not in self.dag.SAME_DATE_FUNCTIONS:
+                raise NotImplementedError("{} can not be evaluated incrementally".format(node.name))
+
+        self.formulas[name] = root
+        self._order = self.dag.topological_order(list(self.formulas.values()))
+
+    @staticmethod
+    def _ewm_alpha(node):
+        args = node.children[1:]
+        if any(c.kind != Node.CONST for c in args):
+            raise ValueError("parameters of {} must be constants".format(node.key))
+        if node.name == 'ewma':
+            halflife = args[0].value
+            return 1.0 - math.exp(math.log(0.5) / halflife)
+        n, m = args[0].value, args[1].value
+        com = n * 1.0 / m - 1
+        return 1.0 / (1.0 + com)
+
+    def _to_row(self, value, date):
+        """Cross-section of a variable as DataFrame of one row."""
+        if isinstance(value, pd.DataFrame):
+            value = value.iloc[-1]
+        if isinstance(value, pd.Series):
+            value = value.reindex(self.symbols).values
+        arr = np.asarray(value, dtype=float)
+        if arr.ndim == 0:
+            arr = np.repeat(arr, len(self.symbols))
+        return pd.DataFrame(arr.reshape(1, -1), index=[date], columns=self.symbols)
+
+    def _step_window(self, node, args, date):
+        """Append arguments to windows, then evaluate the function on windows and keep the last row."""
+        windows = self._windows[node.key]
+        args_window = []
+        for child, arg, window in zip(node.children, args, windows):
+            if isinstance(arg, pd.DataFrame):
+                window.append(arg.values[0])
+                args_window.append(pd.DataFrame(np.vstack(window), columns=self.symbols))
+            else:
+                args_window.append(arg)
+        res = self.dag._compute(node, args_window, None)
+        res = res.iloc[[-1]]
+        res.index = [date]
+        return res
+
+    def _step_ewm(self, node, args, date):
+        cur = args[0].values[0]
+        return pd.DataFrame(self._ewms[node.key].update(cur).reshape(1, -1), index=[date], columns=self.symbols)
+
+    def update(self, date, values, df_group=None):
+        """
+        Feed data of a new date and evaluate all formulas on it.
+
+        Parameters
+        ----------
+        date : int
+        values : dict
+            {variable name: pd.Series indexed by symbol (or scalar, or array in the order of symbols)}
+        df_group : pd.Series, optional
+            Group of each symbol on this date, used by GroupApply.
+
+        Returns
+        -------
+        dict
+            {formula name: pd.Series indexed by symbol}
+
+        """
+        parser = self.dag.parser
+        parser.ann_dts = None
+        parser.trade_dts = None
+        parser.df_group = None
+        if df_group is not None:
+            if isinstance(df_group, pd.DataFrame):
+                df_group = df_group.iloc[-1]
+            parser.df_group = pd.DataFrame([df_group.reindex(self.symbols).values],
+                                           index=[date], columns=self.symbols)
+
+        results = dict()
+        for node in self._order:
+            args = [results[c.key] for c in node.children]
+            if node.kind == Node.VAR:
+                if node.name not in values:
+                    raise Exception('undefined variable: ' + node.name)
+                res = self._to_row(values[node.name], date)
+            elif node.key in self._windows:
+                res = self._step_window(node, args, date)
+            elif node.key in self._ewms:
+                res = self._step_ewm(node, args, date)
+            else:
+                res = self.dag._compute(node, args, None)
+            results[node.key] = res
+        self.n_updates += 1
+
+        output = dict()
+        for name, root in self.formulas.items():
+            res = results[root.key]
+            if isinstance(res, pd.DataFrame):
+                res = res.iloc[0]
+            output[name] = res
+        return output
+
+    def warm_up(self, data, df_group=None):
+        """
+        Feed history date by date, so that states are ready for live updates.
+
+        Parameters
+        ----------
+        data : dict
+            {variable name: pd.DataFrame}, index is date, column is symbol.
+        df_group : pd.DataFrame, optional
+            Same labels as data.
+
+        Returns
+        -------
+        dict
+            {formula name: pd.DataFrame} results on all dates of history.
+
+        """
+        dates = sorted(set().union(*[df.index for df in data.values()]))
+        data = {k: v.reindex(index=dates, columns=self.symbols) for k, v in data.items()}
+        if df_group is not None:
+            df_group = df_group.reindex(index=dates, columns=self.symbols)
+
+        rows = {name: [] for name in self.formulas}
+        for i, date in enumerate(dates):
+            values = {k: v.values[i] for k, v in data.items()}
+            group = None if df_group is None else df_group.iloc[i]
+            res = self.update(date, values, df_group=group)
+            for name, sr in res.items():
+                rows[name].append(sr)
+        return {name: pd.DataFrame(rows[name], index=dates) for name in self.formulas}
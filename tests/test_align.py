@@ -1,6 +1,8 @@
 # encoding: utf-8
+import numpy as np
 import pandas as pd
 from quantos.data.dataservice import RemoteDataService
+from quantos.data.align import align, get_neareast
 
 from quantos.data.py_expression_eval import Parser
 
@@ -56,10 +58,68 @@ def test_align():
     assert abs(df_res.loc[20170427, sec] - 42360000000) < 1
 
 
+def _make_quarterly(n_quarters=12, n_symbols=5, seed=369):
+    rs = np.random.RandomState(seed)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    report_dates = [20150331, 20150630, 20150930, 20151231] * 3
+    report_dates = [d + 10000 * (i // 4) for i, d in enumerate(report_dates)]
+    ann = np.array(report_dates)[:, None] + rs.randint(20, 120, (n_quarters, n_symbols))
+    ann = ann.astype(float)
+    ann[3, 1] = 20170101  # restated late
+    ann[0, 2] = np.nan
+    df_ann = pd.DataFrame(ann, index=report_dates[:n_quarters], columns=columns)
+    df_value = pd.DataFrame(rs.rand(n_quarters, n_symbols), index=df_ann.index, columns=columns)
+    return df_ann, df_value
+
+
+def test_align_vectorized():
+    df_ann, df_value = _make_quarterly()
+    date_arr = np.arange(20150101, 20180101, 7)
+    res = align(df_value, df_ann, date_arr)
+
+    ann = df_ann.fillna(99999999).astype(int).values
+    for i, date in enumerate(date_arr):
+        expected = get_neareast(ann, df_value.values, np.array([date]))
+        assert np.allclose(res.values[i], expected, equal_nan=True)
+
+
+def test_align_once():
+    import quantos.data.py_expression_eval as py_expression_eval
+    from quantos.data.formula_dag import FormulaDAG
+    
+    df_ann, df_value = _make_quarterly()
+    date_arr = np.arange(20150101, 20180101, 7)
+    df_close = pd.DataFrame(index=date_arr, columns=df_value.columns, data=np.random.rand(len(date_arr), 5))
+    values = {'revenue': df_value, 'profit': df_value * 0.1, 'close': df_close}
+    formula = 'revenue / close + Delta(profit, 1) / close - Rank(revenue) + (revenue - profit) * close'
+    
+    n_calls = [0]
+    
+    def counted_align(*args):
+        n_calls[0] += 1
+        return align(*args)
+    
+    py_expression_eval.align = counted_align
+    try:
+        dag = FormulaDAG()
+        res = dag.evaluate([dag.compile(formula)], values, ann_dts=df_ann, trade_dts=date_arr)[0]
+        # revenue, profit and Delta(profit, 1), each expanded once
+        assert n_calls[0] == 3
+    finally:
+        py_expression_eval.align = align
+    
+    parser = Parser()
+    parser.parse(formula)
+    expected = parser.evaluate(values, ann_dts=df_ann, trade_dts=date_arr)
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+
 if __name__ == "__main__":
     import time
     t_start = time.time()
     
+    test_align_vectorized()
+    test_align_once()
     test_align()
     
     t3 = time.time() - t_start
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri
+
+from quantos.data import cross_section
+from quantos.data.py_expression_eval import Parser
+
+
+def _make_data(n_dates=30, n_symbols=20, seed=369):
+    rs = np.random.RandomState(seed)
+    index = np.arange(20170101, 20170101 + n_dates)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    df = pd.DataFrame(rs.rand(n_dates, n_symbols), index=index, columns=columns)
+    df.iloc[:, 3] = df.iloc[:, 4]  # ties
+    df[rs.rand(n_dates, n_symbols) < 0.1] = np.nan
+
+    group = pd.DataFrame(rs.choice(['a', 'b', 'c', 'd'], size=df.shape), index=index, columns=columns)
+    group.iloc[5:, 7] = None  # symbol without group
+    return df, group
+
+
+def _loop(func, df, group):
+    """Reference: apply func to each group on each date."""
+    res = pd.DataFrame(np.nan, index=df.index, columns=df.columns)
+    for date in df.index:
+        row, row_group = df.loc[date], group.loc[date]
+        for val in row_group.dropna().unique():
+            members = row[row_group == val].dropna()
+            if len(members):
+                res.loc[date, members.index] = func(members)
+    return res
+
+
+def _cutoff(x, z_score):
+    median = x.median()
+    diff = x - median
+    bound = z_score * diff.abs().median()
+    return x.where(diff.abs() <= bound, median + bound * np.sign(diff))
+
+
+def _assert_same(res, expected):
+    assert res.shape == expected.shape
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+
+def test_group_operators():
+    df, group = _make_data()
+    _assert_same(cross_section.group_rank(df, group), _loop(lambda x: x.rank(), df, group))
+    _assert_same(cross_section.group_mean(df, group), _loop(lambda x: x.mean(), df, group))
+    _assert_same(cross_section.group_std(df, group), _loop(lambda x: x.std(), df, group))
+    _assert_same(cross_section.group_neutralize(df, group), _loop(lambda x: x - x.mean(), df, group))
+    _assert_same(cross_section.group_standardize(df, group),
+                 _loop(lambda x: (x - x.mean()) / x.std(), df, group))
+    _assert_same(cross_section.group_cutoff(df, group, 1.5), _loop(lambda x: _cutoff(x, 1.5), df, group))
+
+    # fixed classification, and no classification
+    fixed = group.iloc[0]
+    _assert_same(cross_section.group_rank(df, fixed),
+                 _loop(lambda x: x.rank(), df, pd.DataFrame([fixed] * len(df), index=df.index)))
+    _assert_same(cross_section.group_rank(df), df.rank(axis=1))
+
+
+def test_group_apply():
+    np.random.seed(369)
+    n = 20
+    dic = {c: np.random.rand(n) for c in 'abcdefghijklmnopqrstuvwxyz'[:n]}
+    df_value = pd.DataFrame(index=range(n), data=dic)
+    r = np.random.randint(0, 5, n * df_value.shape[0]).reshape(df_value.shape[0], n)
+    cols = df_value.columns.values.copy()
+    np.random.shuffle(cols)
+    df_group = pd.DataFrame(index=df_value.index, columns=cols, data=r)
+
+    parser = Parser()
+    parser.parse('GroupApply(Standardize, GroupApply(Cutoff, close, 2.8))')
+    res = parser.evaluate({'close': df_value}, df_group=df_group)
+    assert abs(res.iloc[3, 6] - (-1.53432)) < 1e-5
+    assert abs(res.iloc[19, 18] - (-1.17779)) < 1e-5
+
+    parser.parse('GroupRank(close, grp) - GroupApply(Rank, close)')
+    res = parser.evaluate({'close': df_value, 'grp': df_group}, df_group=df_group)
+    assert np.allclose(res.values, 0.0)
+
+
+def test_neutralize():
+    df, group = _make_data()
+    rs = np.random.RandomState(0)
+    size = pd.DataFrame(rs.rand(*df.shape), index=df.index, columns=df.columns)
+    size.iloc[2, 5] = np.nan
+    value = df + 2 * size
+
+    res = cross_section.neutralize(value, [size], group)
+    _assert_same(cross_section.neutralize(df, [], group), cross_section.group_neutralize(df, group))
+
+    # reference: least squares of each date on group dummies and size
+    for i in [0, 2, 17]:
+        row = pd.DataFrame({'y': value.iloc[i], 'size': size.iloc[i], 'g': group.iloc[i]}).dropna()
+        dummies = pd.get_dummies(row['g']).values.astype(float)
+        x = np.hstack([dummies, row[['size']].values])
+        beta = np.linalg.lstsq(x, row['y'].values)[0]
+        expected = row['y'].values - x.dot(beta)
+        assert np.allclose(res.iloc[i][row.index].values, expected)
+        assert res.iloc[i].drop(row.index).isnull().all()
+
+    # no groups: market mean and size are removed
+    parser = Parser()
+    parser.parse('Neutralize(value, size)')
+    res = parser.evaluate({'value': value, 'size': size})
+    assert np.allclose(res.mean(axis=1), 0.0)
+    assert np.allclose((res * size).sum(axis=1) - res.sum(axis=1) * size.where(res.notnull()).mean(axis=1), 0.0)
+
+
+def test_preprocessing():
+    df, group = _make_data()
+    rs = np.random.RandomState(1)
+    mask = pd.DataFrame(rs.rand(*df.shape) < 0.8, index=df.index, columns=df.columns)
+    df_masked = df.where(mask)
+    no_group = pd.DataFrame('a', index=df.index, columns=df.columns)
+
+    def rank_gauss(x):
+        return pd.Series(ndtri((x.rank() - 0.5) / x.count()), index=x.index)
+
+    def quantile_clip(x):
+        return x.clip(x.quantile(0.1), x.quantile(0.8))
+
+    cases = [(cross_section.zscore, lambda x: (x - x.mean()) / x.std()),
+             (lambda x, g, **kw: cross_section.winsorize_mad(x, g, 2.0, **kw), lambda x: _cutoff(x, 2.0)),
+             (lambda x, g, **kw: cross_section.quantile_clip(x, g, 0.1, 0.8, **kw), quantile_clip),
+             (cross_section.rank_gauss, rank_gauss)]
+    for func, reference in cases:
+        _assert_same(func(df, group), _loop(reference, df, group))
+        _assert_same(func(df, None), _loop(reference, df, no_group))
+        # elements outside universe are excluded
+        _assert_same(func(df, group, mask=mask), _loop(reference, df_masked, group))
+        _assert_same(func(df, None, mask=mask), _loop(reference, df_masked, no_group))
+
+    # missing values of some symbols do not spoil the cross-section
+    parser = Parser()
+    parser.parse('Cutoff(close, 2)')
+    res = parser.evaluate({'close': df})
+    _assert_same(res, _loop(lambda x: _cutoff(x, 2.0), df, no_group))
+    assert res.notnull().values.sum() == df.notnull().values.sum()
+
+    parser.parse('Standardize(close, member) + RankGauss(close, member) - QuantileClip(close, 0, 1, member)')
+    res = parser.evaluate({'close': df, 'member': mask.astype(float)})
+    _assert_same(res, _loop(lambda x: (x - x.mean()) / x.std() + rank_gauss(x) - x, df_masked, no_group))
+
+
+if __name__ == "__main__":
+    test_group_operators()
+    test_group_apply()
+    test_neutralize()
+    test_preprocessing()
@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+import threading
+import time
+
+from quantos.backtest.event import eventEngine
+from quantos.backtest.event.eventEngine import Event, EventEngine, LiveEventEngine
+from quantos.backtest.event.eventType import EVENT, EVENT_ORDERSTATUS_IND, EVENT_TIMER
+
+
+def _make_event(type_, data):
+    event = Event(type_)
+    event.data = data
+    return event
+
+
+def test_event_engine_sync():
+    calls = []
+    engine = EventEngine(sync=True)
+
+    def on_quote(event):
+        calls.append(('quote', event.data))
+        if event.data == 2:
+            # events put by handlers are processed before put returns
+            engine.put(_make_event(EVENT.TRADE_IND, 'trade'))
+
+    engine.register(EVENT.MD_QUOTE, on_quote)
+    engine.register(EVENT.TRADE_IND, lambda event: calls.append(('trade', event.data)))
+    engine.registerGeneralHandler(lambda event: calls.append(('general', event.type_)))
+
+    for i in range(3):
+        engine.put(_make_event(EVENT.MD_QUOTE, i))
+        assert not engine.process_once()
+    engine.put(_make_event(EVENT.MARKET_CLOSE, None))
+    assert calls == [('quote', 0), ('general', EVENT.MD_QUOTE),
+                     ('quote', 1), ('general', EVENT.MD_QUOTE),
+                     ('quote', 2), ('trade', 'trade'), ('general', EVENT.TRADE_IND), ('general', EVENT.MD_QUOTE),
+                     ('general', EVENT.MARKET_CLOSE)]
+
+    # handlers registered and unregistered are used by the next event
+    del calls[:]
+    engine.unregister(EVENT.MD_QUOTE, on_quote)
+    engine.put(_make_event(EVENT.MD_QUOTE, 3))
+    assert calls == [('general', EVENT.MD_QUOTE)]
+
+
+def test_event_engine_thread():
+    calls = []
+    engine = EventEngine()
+    engine.register(EVENT.MD_QUOTE, lambda event: calls.append(event.data))
+    engine.start(timer=False)
+    try:
+        for i in range(100):
+            engine.put(_make_event(EVENT.MD_QUOTE, i))
+        t0 = time.time()
+        while len(calls) < 100 and time.time() - t0 < 5:
+            time.sleep(0.01)
+    finally:
+        engine.stop()
+    assert calls == list(range(100))
+
+
+def test_benchmark():
+    res = eventEngine.benchmark(n_events=20000)
+    print(", ".join("{}: {:.0f} events/s".format(mode, res[mode]) for mode in ['sync', 'process_once', 'thread']))
+    assert all(res[mode] > 0 for mode in ['sync', 'process_once', 'thread'])
+
+
+class _Quote(object):
+    def __init__(self, symbol, close):
+        self.symbol = symbol
+        self.close = close
+
+
+def _wait(cond, timeout=5):
+    t0 = time.time()
+    while not cond() and time.time() - t0 < timeout:
+        time.sleep(0.001)
+
+
+def test_live_event_engine():
+    calls = []
+    entered, gate = threading.Event(), threading.Event()
+
+    def on_quotes(events):
+        entered.set()
+        gate.wait()
+        calls.append([(e.data.symbol, e.data.close) for e in events])
+
+    engine = LiveEventEngine()
+    engine.register(EVENT.MD_QUOTE, on_quotes, batch=True)
+    engine.register(EVENT_ORDERSTATUS_IND, lambda event: calls.append(event.data))
+    engine.start(timer=False)
+    try:
+        engine.put(_make_event(EVENT.MD_QUOTE, _Quote('000001.SZ', 0.0)))
+        entered.wait(5)
+        # a burst of quotes while the handler is busy: only the latest quote of each symbol is kept
+        for i in range(50):
+            engine.put(_make_event(EVENT.MD_QUOTE, _Quote('{:06d}.SZ'.format(i % 10), float(i))))
+        engine.put(_make_event(EVENT_ORDERSTATUS_IND, 'order status'))
+        gate.set()
+        _wait(lambda: len(calls) == 3)
+        metrics = engine.metrics()
+    finally:
+        engine.stop()
+
+    # order status before quotes put earlier
+    assert calls == [[('000001.SZ', 0.0)], 'order status',
+                     [('{:06d}.SZ'.format(i), float(i + 40)) for i in range(10)]]
+    assert metrics[2]['processed'] == 11 and metrics[2]['coalesced'] == 40 and metrics[2]['depth'] == 0
+    assert metrics[2]['max_depth'] == 10
+    assert metrics[0]['processed'] == 1 and metrics[0]['latency_max'] >= 0.0
+
+
+def test_live_event_engine_burst():
+    # order status waits for at most one batch of quotes
+    quotes, handled = [], []
+    entered, gate = threading.Event(), threading.Event()
+
+    def on_quote(event):
+        entered.set()
+        gate.wait()
+        quotes.append(event.data.symbol)
+
+    engine = LiveEventEngine(max_batch=10)
+    engine.register(EVENT.MD_QUOTE, on_quote)
+    engine.register(EVENT_ORDERSTATUS_IND, lambda event: handled.append(len(quotes)))
+    engine.start(timer=False)
+    try:
+        for i in range(2000):
+            engine.put(_make_event(EVENT.MD_QUOTE, _Quote('{:06d}.SZ'.format(i), 10.0)))
+        entered.wait(5)
+        t_put = time.time()
+        engine.put(_make_event(EVENT_ORDERSTATUS_IND, 'order status'))
+        gate.set()
+        _wait(lambda: handled)
+        t_handled = time.time()
+        _wait(lambda: len(quotes) == 2000)
+    finally:
+        engine.stop()
+    print("order status latency {:.1f} ms, behind {} of 2000 quotes".format((t_handled - t_put) * 1e3, handled[0]))
+    assert handled[0] <= 10 and len(quotes) == 2000
+
+
+def test_live_event_engine_timer():
+    ticks = []
+    n_threads = threading.active_count()
+    engine = LiveEventEngine()
+    engine.register(EVENT_TIMER, lambda event: ticks.append(time.time()))
+    engine.start()
+    try:
+        _wait(lambda: ticks)
+    finally:
+        engine.stop()
+    assert len(ticks) == 1
+    # the timer thread ends at once
+    _wait(lambda: threading.active_count() == n_threads, timeout=0.5)
+    assert threading.active_count() == n_threads
+
+
+if __name__ == "__main__":
+    test_event_engine_sync()
+    test_event_engine_thread()
+    test_benchmark()
+    test_live_event_engine()
+    test_live_event_engine_burst()
+    test_live_event_engine_timer()
@@ -0,0 +1,175 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.py_expression_eval import Parser
+from quantos.data.formula_dag import FormulaDAG, Node
+
+
+def _make_data(n_dates=60, n_symbols=8, seed=369):
+    np.random.seed(seed)
+    index = np.arange(20170101, 20170101 + n_dates)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+
+    def make():
+        return pd.DataFrame(index=index, columns=columns, data=np.random.rand(n_dates, n_symbols) + 1.0)
+    return {'close': make(), 'open': make(), 'vwap': make(), 'volume': make()}
+
+
+def test_compile_shares_nodes():
+    dag = FormulaDAG()
+    r1 = dag.compile('Rank(Delta(vwap, 7)) + close')
+    r2 = dag.compile('close + Rank(Delta(vwap,7))')
+    r3 = dag.compile('rank(delta(vwap, 7)) * 2', func_name_style='lower')
+    r4 = dag.compile('Corr(close, open, 5) - Correlation(close, open, 5)')
+    assert r1 is r2
+    assert r1.children[1] in r3.children
+    assert r4.children[0] is r4.children[1]
+    assert set(dag.variables([r1, r3])) == {'close', 'vwap'}
+
+
+def test_evaluate_same_as_parser():
+    data = _make_data()
+    formulas = ['Rank(Delta(vwap, 7)) + close',
+                '-Ts_Mean(close / open, 5) * Delay(vwap, 2)',
+                'If(close > open, Ts_Max(volume, 3), Ts_Min(volume, 3))',
+                'Max(close, open) - Abs(Delta(vwap, 7))',
+                'GroupApply(Rank, close)']
+    df_group = pd.DataFrame(index=data['close'].index, columns=data['close'].columns,
+                            data=np.tile(np.arange(8) % 3, (60, 1)))
+
+    dag = FormulaDAG()
+    roots = [dag.compile(f) for f in formulas]
+    results = dag.evaluate(roots, data, df_group=df_group)
+
+    for formula, res in zip(formulas, results):
+        parser = Parser()
+        parser.parse(formula)
+        expected = parser.evaluate(data, df_group=df_group)
+        assert np.allclose(res.values, expected.values, equal_nan=True)
+
+
+def test_evaluate_each_node_once():
+    data = _make_data()
+    n_calls = {'vwap': 0}
+
+    def get_var(name):
+        if name == 'vwap':
+            n_calls['vwap'] += 1
+        return data[name]
+
+    dag = FormulaDAG()
+    roots = [dag.compile('Rank(Delta(vwap, 7)) + close'),
+             dag.compile('Rank(Delta(vwap, 7)) * open'),
+             dag.compile('Delta(vwap, 7) / Delay(close, 1)')]
+    n_nodes = len([n for n in dag.topological_order(roots) if n.kind not in (Node.CONST, Node.FUNC)])
+
+    dag.evaluate(roots, get_var)
+    assert dag.n_computed == n_nodes
+    assert n_calls['vwap'] == 1
+
+    # second batch reuses cached results
+    dag.evaluate(roots + [dag.compile('Rank(Delta(vwap, 7)) - 1')], get_var)
+    assert dag.n_computed == n_nodes + 1
+    assert n_calls['vwap'] == 1
+
+
+def test_cache_bounded():
+    data = _make_data()
+    size = data['close'].memory_usage(index=True).sum()
+
+    dag = FormulaDAG(max_cache_bytes=int(size * 3.5))
+    roots = [dag.compile('Delta(close, {:d})'.format(i)) for i in range(1, 10)]
+    res = dag.evaluate(roots, data)
+    assert dag.cache.nbytes <= size * 3.5
+    assert len(dag.cache) == 3
+    for i, df in enumerate(res):
+        assert np.allclose(df.values, data['close'].diff(i + 1).values, equal_nan=True)
+
+    # results depending on a variable are dropped
+    dag.invalidate('close')
+    assert len(dag.cache) == 0
+
+
+def test_lookback():
+    dag = FormulaDAG()
+    assert dag.lookback([dag.compile('close + open')]) == 0
+    assert dag.lookback([dag.compile('Delay(close, 3)')]) == 3
+    assert dag.lookback([dag.compile('Ts_Mean(Delta(close, 5), 10)')]) == 14
+    assert dag.lookback([dag.compile('Corr(Rank(close), Ts_Max(open, 4), 6) - Delta(vwap, 7)')]) == 8
+    assert dag.lookback([dag.compile('Ewma(close, 2)')]) == 40
+    assert dag.lookback([dag.compile('Step(close, 3)')]) is None
+    assert dag.lookback([dag.compile('Delay(close, 1)'), dag.compile('Ts_Min(close, 8)')]) == 7
+
+
+def test_evaluate_window():
+    data = _make_data(n_dates=200)
+    dag = FormulaDAG()
+    roots = [dag.compile('Rank(Decay_linear(Delta(vwap, 3), 5)) * Ts_Mean(close / open, 4)'),
+             dag.compile('Decay_exp(close, 0.9, 6) + If(close > open, Delay(volume, 2), 1)'),
+             dag.compile('Ewma(close, 3) + Sma(open, 6, 2)')]
+    full = dag.evaluate(roots, data)
+
+    # results of last rows only need lookback rows before them
+    n_last = 5
+    n_rows = n_last + dag.lookback(roots)
+    data_cut = {k: v.iloc[-n_rows:] for k, v in data.items()}
+    part = dag.evaluate(roots, data_cut, use_cache=False)
+    for df_full, df_part in zip(full, part):
+        assert np.allclose(df_part.values[-n_last:], df_full.values[-n_last:], atol=1e-5)
+
+
+def test_evaluate_parallel():
+    data = _make_data(n_symbols=9)
+    formulas = ['Rank(Ts_Mean(close / open, 5)) + Delta(vwap, 2)',
+                'GroupApply(Standardize, Corr(close, volume, 6)) * Ewma(open, 3)',
+                'Decay_linear(close, 4) - Delay(open, 1)']
+    df_group = pd.DataFrame(index=data['close'].index, columns=data['close'].columns,
+                            data=np.tile(np.arange(9) % 3, (60, 1)))
+
+    dag = FormulaDAG()
+    roots = [dag.compile(f) for f in formulas]
+    subtrees = dag.time_series_subtrees(roots)
+    assert set(subtrees) == {dag.compile(f) for f in ['Ts_Mean(close / open, 5)', 'Delta(vwap, 2)',
+                                                      'Corr(close, volume, 6)', 'Ewma(open, 3)', formulas[2]]}
+
+    expected = dag.evaluate(roots, data, df_group=df_group, use_cache=False)
+    res = dag.evaluate(roots, data, df_group=df_group, n_jobs=3)
+    for df, df_expected in zip(res, expected):
+        assert list(df.columns) == list(df_expected.columns)
+        assert np.allclose(df.values, df_expected.values, equal_nan=True)
+
+
+def test_evaluate_grid():
+    data = _make_data()
+    data['close'].iloc[10:12, 2] = np.nan
+    dag = FormulaDAG()
+    template = 'Ts_Mean(close / open, {n}) - StdDev(close / open, {n}) * {k} + Sum(volume, {n})'
+    names, params, roots = dag.compile_grid(template, {'n': [3, 5, 10], 'k': [1, 2]})
+    assert names == ['k', 'n'] and len(params) == len(roots) == 6
+    assert params[0] == (1, 3) and roots[0] is dag.compile('Ts_Mean(close/open, 3) - StdDev(close/open, 3) * 1 '
+                                                           '+ Sum(volume, 3)')
+
+    # close / open is computed once, every window function once
+    results = dag.evaluate(roots, data)
+    assert dag.n_computed == len([n for n in dag.topological_order(roots) if n.kind != Node.CONST])
+    for values, res in zip(params, results):
+        parser = Parser()
+        parser.parse(template.format(**dict(zip(names, values))))
+        expected = parser.evaluate(data)
+        assert np.allclose(res.values, expected.values, equal_nan=True)
+
+    names, params, formulas = FormulaDAG.expand_grid('Delay(close, {n})', [{'n': 1}, {'n': 4}])
+    assert names == ['n'] and params == [(1,), (4,)] and formulas == ['Delay(close, 1)', 'Delay(close, 4)']
+
+
+if __name__ == "__main__":
+    test_compile_shares_nodes()
+    test_evaluate_same_as_parser()
+    test_evaluate_each_node_once()
+    test_cache_bounded()
+    test_lookback()
+    test_evaluate_window()
+    test_evaluate_parallel()
+    test_evaluate_grid()
@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.py_expression_eval import Parser
+from quantos.data.formula_dag import FormulaDAG
+from quantos.data.fusion import FusedKernel
+
+
+def _make_data(n_dates=50, n_symbols=6, seed=369):
+    rs = np.random.RandomState(seed)
+    index = np.arange(20170101, 20170101 + n_dates)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+
+    def make():
+        df = pd.DataFrame(index=index, columns=columns, data=rs.rand(n_dates, n_symbols) - 0.3)
+        df[rs.rand(n_dates, n_symbols) < 0.05] = np.nan
+        return df
+    return {'close': make(), 'open': make(), 'high': make(), 'low': make()}
+
+
+def test_kernel():
+    dag = FormulaDAG()
+    root = dag.compile('((close - low) - (high - close)) / (high - low)')
+    kernel = FusedKernel(root, lambda n: n.kind == 'var')
+    assert len(kernel.nodes) == 5
+    assert {n.name for n in kernel.leaves} == {'close', 'low', 'high'}
+
+    data = _make_data()
+    res = kernel([data[n.name] for n in kernel.leaves])
+    expected = ((data['close'] - data['low']) - (data['high'] - data['close'])) / (data['high'] - data['low'])
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+    # labels differ: not fused
+    assert kernel([data[n.name].iloc[1:] if n.name == 'low' else data[n.name] for n in kernel.leaves]) is None
+
+
+def test_same_as_parser():
+    data = _make_data()
+    formulas = ['((close - low) - (high - close)) / (high - low)',
+                '-Abs(close * 2 - open) + Sqrt(high ^ 2) % 0.3',
+                'If((close > open) && (high >= 0.5 || low < 0.1), Max(close, open) - 1, Min(close, open) / 2)',
+                'SignedPower(close - open, 0.5) + Sign(low) * Log(high + 1) + (close == open) + (close != low)',
+                'Rank(close / open - 1) * (Delta(high, 2) + Tail(low, 0.1, 0.3, 0.2) - Pow(open, 2))',
+                'Round(close * 10) + Floor(open * 3) - Ceil(high) + exp(low) + Sin(close) + Cos(open) + Tan(high)']
+
+    dag = FormulaDAG()
+    roots = [dag.compile(f) for f in formulas]
+    res = dag.evaluate(roots, data)
+    assert dag.n_computed == len([n for n in dag.topological_order(roots) if n.kind not in ('const', 'func')])
+
+    for formula, df in zip(formulas, res):
+        parser = Parser()
+        parser.parse(formula)
+        expected = parser.evaluate(data)
+        assert np.allclose(df.values, expected.values, equal_nan=True)
+
+
+if __name__ == "__main__":
+    test_kernel()
+    test_same_as_parser()
@@ -0,0 +1,405 @@
+# encoding: utf-8
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest import common
+from quantos.backtest.backtest import AlphaBacktestInstance
+from quantos.backtest.gateway import (PortfolioManager, ArrayPortfolioManager, OrderStatusInd, StockSimulatorDaily,
+                                      DailyStockSimGateway, OrderBook)
+from quantos.data.basic.marketdata import Bar, BarBatch
+from quantos.data.basic.order import Order, FixedPriceTypeOrder, VwapOrder
+from quantos.data.basic.trade import Trade
+
+
+class _Strategy(object):
+    trade_date = 20170704
+
+
+def _make_orders(n_symbols=50, n_orders=300, seed=369):
+    rs = np.random.RandomState(seed)
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    orders = []
+    for i in range(n_orders):
+        action = common.ORDER_ACTION.BUY if rs.rand() < 0.6 else common.ORDER_ACTION.SELL
+        order = Order.new_order(symbols[rs.randint(n_symbols)], action, 10.0, int(rs.randint(1, 20)),
+                                _Strategy.trade_date, 0)
+        order.entrust_no = str(i)
+        orders.append(order)
+    prices = dict(zip(symbols, rs.rand(n_symbols) * 10 + 5))
+    return symbols, orders, prices
+
+
+def _fill(order, size):
+    trade = Trade()
+    trade.init_from_order(order)
+    trade.send_fill_info(price=order.entrust_price, size=size, date=order.entrust_date, time=0, no=order.entrust_no)
+    return trade
+
+
+def test_array_portfolio_manager():
+    symbols, orders, prices = _make_orders()
+    pm, apm = PortfolioManager(_Strategy()), ArrayPortfolioManager(_Strategy())
+
+    # fill some orders fully, some partially then cancel the rest
+    for i, order in enumerate(orders):
+        for manager in [pm, apm]:
+            manager.add_order(order)
+            if i % 3 != 2:
+                manager.on_trade_ind(_fill(order, order.entrust_size))
+            else:
+                manager.on_trade_ind(_fill(order, 1))
+                ind = OrderStatusInd()
+                ind.init_from_order(order)
+                ind.order_status = common.ORDER_STATUS.CANCELLED
+                ind.fill_size = 1
+                manager.on_order_status(ind)
+
+    assert apm.holding_securities == pm.holding_securities
+    for sec in symbols:
+        position = apm.get_position(sec)
+        if sec in pm.positions:
+            assert position.curr_size == pm.get_position(sec).curr_size
+            stat, expected = apm.get_tradestat(sec), pm.tradestat[sec]
+            assert stat.buy_filled_size == expected.buy_filled_size
+            assert stat.sell_filled_size == expected.sell_filled_size
+            assert stat.buy_want_size == expected.buy_want_size == 0
+            assert stat.sell_want_size == expected.sell_want_size == 0
+        else:
+            assert position is None
+    assert all(o.order_status == common.ORDER_STATUS.FILLED for key, o in apm.orders.items() if int(key[0]) % 3 != 2)
+
+    suspensions = symbols[:5]
+    assert np.isclose(apm.market_value(0, prices, suspensions), pm.market_value(0, prices, suspensions))
+    price_vector = apm.price_vector(prices)
+    assert np.isclose(apm.market_value(0, price_vector), pm.market_value(0, prices))
+    weights = apm.weights(price_vector)
+    assert np.isclose(np.abs(weights).sum(), 1.0)
+
+    # re-balance to goal positions in one batch of fills
+    goal_sizes = apm.goal_sizes(np.ones(len(apm.symbols)) / len(apm.symbols), 1e6, price_vector)
+    ids, diff = apm.diff_to_goal(goal_sizes)
+    apm.apply_fills(ids, np.abs(diff), diff > 0)
+    assert np.allclose(apm.curr_size, goal_sizes)
+    assert np.abs(apm.market_value(0, price_vector) - 1e6) < len(apm.symbols) * 100 * 15
+
+    apm.on_new_day(20170705, 20170704)
+    assert np.array_equal(apm.init_size, apm.curr_size)
+    assert apm.get_position(symbols[0]).today_size == 0
+
+
+def test_array_portfolio_manager_cover():
+    apm = ArrayPortfolioManager(_Strategy())
+    orders = []
+    for i, action in enumerate([common.ORDER_ACTION.SHORT, common.ORDER_ACTION.COVER, common.ORDER_ACTION.COVER]):
+        order = Order.new_order('600000.SH', action, 10.0, 300, _Strategy.trade_date, 0)
+        order.entrust_no = str(i)
+        apm.add_order(order)
+        orders.append(order)
+    assert apm.get_position('600000.SH').want_size == 600 and apm.get_position('600000.SH').frozen_size == 300
+
+    # cover orders are buys: fills and cancels release wanted sizes
+    apm.on_trade_ind(_fill(orders[0], 300))
+    apm.on_trade_ind(_fill(orders[1], 300))
+    ind = OrderStatusInd()
+    ind.init_from_order(orders[2])
+    ind.order_status = common.ORDER_STATUS.CANCELLED
+    apm.on_order_status(ind)
+    position = apm.get_position('600000.SH')
+    assert position.want_size == 0 and position.frozen_size == 0 and position.curr_size == 0
+
+
+def _make_prices(symbols, seed=0):
+    rs = np.random.RandomState(seed)
+    close = np.round(rs.rand(len(symbols)) * 10 + 5, 2)
+    df = pd.DataFrame({'close': close, 'vwap': close + 0.01, 'open': close - 0.05,
+                       'high': close + 0.1, 'low': close - 0.1}, index=pd.Index(symbols, name='symbol'))
+    return df
+
+
+def test_stock_simulator_daily():
+    symbols, orders, _ = _make_orders(n_symbols=20, n_orders=60)
+    prices = _make_prices(symbols)
+    orders[1] = VwapOrder.new_order(orders[1].symbol, orders[1].entrust_action, 0.0, 7, 20170704, 0)
+    orders[2] = FixedPriceTypeOrder.new_order(orders[2].symbol, orders[2].entrust_action, 0.0, 9, 20170704, 0)
+    orders[2].price_target = 'open'
+    orders[1].entrust_no, orders[2].entrust_no = '1', '2'
+
+    sim = StockSimulatorDaily()
+    sim.on_new_day(20170704)
+    for order in orders:
+        assert sim.add_order(order) == ""
+    assert sim.add_order(orders[0]) != ""
+    status, err = sim.cancel_order('3')
+    assert err == "" and status.order_status == common.ORDER_STATUS.CANCELLED and status.entrust_no == '3'
+    assert sim.cancel_order('3')[1] != ""
+
+    # dict of DataFrame of one row and DataFrame of all symbols give the same trades
+    price_dic = {sec: prices.loc[[sec]] for sec in symbols}
+    trades = sim.match(price_dic, 20170704, 150000)
+    assert sim.match_finished
+    assert len(trades) == len(orders) - 1
+    assert len(set(t.fill_no for t in trades)) == len(trades)
+    by_no = {t.entrust_no: t for t in trades}
+    for order in orders:
+        if order.entrust_no == '3':
+            continue
+        field = {'1': 'vwap', '2': 'open'}.get(order.entrust_no, 'close')
+        trade = by_no[order.entrust_no]
+        assert trade.fill_price == prices.loc[order.symbol, field]
+        assert trade.fill_size == order.entrust_size and trade.symbol == order.symbol
+        assert order.order_status == common.ORDER_STATUS.FILLED and np.isclose(order.fill_price, trade.fill_price)
+
+    # suspensions, missing prices and price limits keep orders pending
+    sim = StockSimulatorDaily()
+    sim.on_new_day(20170705)
+    buy, sell, cover = common.ORDER_ACTION.BUY, common.ORDER_ACTION.SELL, common.ORDER_ACTION.COVER
+    # cover orders are buys: blocked at limit-up, not at limit-down
+    cases = [(symbols[0], buy), (symbols[1], buy), (symbols[2], sell), (symbols[3], sell), (symbols[4], buy),
+             ('999999.SH', buy), (symbols[1], cover), (symbols[3], cover)]
+    for i, (sec, action) in enumerate(cases):
+        order = Order.new_order(sec, action, 0.0, 100, 20170705, 0)
+        order.entrust_no = 'n{}'.format(i)
+        sim.add_order(order)
+    prices['preclose'] = np.round(prices['close'] / 1.05, 2)
+    prices.loc[symbols[1], ['low', 'close', 'vwap']] = np.round(prices.loc[symbols[1], 'preclose'] * 1.1, 2)
+    prices.loc[symbols[3], ['high', 'close', 'vwap']] = np.round(prices.loc[symbols[3], 'preclose'] * 0.9, 2)
+    fills = sim.match_batch(prices, 20170705, 150000, suspensions=[symbols[4]])
+    assert list(fills.entrust_no) == ['n0', 'n2', 'n7']
+    assert np.all(fills.fill_no // 10000 == 20170705)
+    assert len(fills.to_frame()) == 3
+    assert not sim.match_finished
+
+    # next day the limits are gone
+    fills = sim.match_batch(prices.drop('preclose', axis=1), 20170706, 150000)
+    assert sorted(fills.entrust_no) == ['n1', 'n3', 'n4', 'n6']
+    assert sim.cancel_order('n5')[1] == "" and sim.match_finished
+
+
+def test_stock_simulator_daily_speed():
+    n = 3000
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n)]
+    prices = _make_prices(symbols)
+    sim = StockSimulatorDaily()
+    sim.on_new_day(20170704)
+    for i, sec in enumerate(symbols):
+        order = Order.new_order(sec, common.ORDER_ACTION.BUY, 0.0, 100, 20170704, 0)
+        order.entrust_no = str(i)
+        sim.add_order(order)
+    t0 = time.time()
+    fills = sim.match_batch(prices, 20170704, 150000)
+    print("match {:d} orders in {:.1f} ms".format(n, (time.time() - t0) * 1e3))
+    assert len(fills) == n and np.allclose(fills.fill_price, prices['close'].values)
+
+
+class _DayStrategy(object):
+    """Strategy with an ArrayPortfolioManager, as used by AlphaBacktestInstance.on_new_day."""
+    def __init__(self):
+        self.trade_date = 0
+        self.pm = ArrayPortfolioManager(self)
+
+    def on_new_day(self, trade_date):
+        last_date, self.trade_date = self.trade_date, trade_date
+        self.pm.on_new_day(trade_date, last_date)
+
+    def on_order_status(self, ind):
+        self.pm.on_order_status(ind)
+
+
+class _Context(object):
+    pass
+
+
+def test_stock_simulator_daily_expire():
+    symbols = ['000001.SZ', '600000.SH']
+    prices = _make_prices(symbols)
+    bt = AlphaBacktestInstance()
+    bt.ctx = _Context()
+    bt.ctx.gateway = gateway = DailyStockSimGateway()
+    bt.strategy = strategy = _DayStrategy()
+    pm = strategy.pm
+
+    def place(entrust_no, size, date):
+        order = Order.new_order(symbols[0], common.ORDER_ACTION.BUY, 0.0, size, date, 0)
+        order.entrust_no = entrust_no
+        pm.add_order(order)
+        return gateway.place_order(order)
+
+    # an order with nothing to fill is rejected
+    bt.on_new_day(20170704)
+    assert place('z', 0, 20170704) != "" and gateway.match_finished
+
+    # a buy order blocked at limit-up stays pending on its day
+    assert place('a', 100, 20170704) == ""
+    blocked = prices.copy()
+    blocked['preclose'] = np.round(blocked['close'] / 1.1, 2)
+    blocked['low'] = blocked['close']
+    assert len(gateway.match_batch(blocked, 20170704)) == 0
+    assert not gateway.match_finished and pm.get_position(symbols[0]).want_size == 100
+
+    # and is cancelled next day, releasing its wanted size
+    bt.on_new_day(20170705)
+    assert gateway.match_finished
+    assert pm.orders[('a', 20170704)].order_status == common.ORDER_STATUS.CANCELLED
+    assert gateway.simulator.cancel_order('a')[1] != ""
+    assert place('b', 200, 20170705) == ""
+    for trade in gateway.match(prices, 20170705):
+        pm.on_trade_ind(trade)
+    position = pm.get_position(symbols[0])
+    assert gateway.match_finished and position.curr_size == 200 and position.want_size == 0
+
+
+def _make_resting_orders(n_symbols, n_orders, seed=0):
+    rs = np.random.RandomState(seed)
+    symbols = ['{:06d}.SH'.format(i) for i in range(n_symbols)]
+    orders = []
+    for i in range(n_orders):
+        action = common.ORDER_ACTION.BUY if rs.rand() < 0.5 else common.ORDER_ACTION.SELL
+        order = Order.new_order(symbols[rs.randint(n_symbols)], action, np.round(rs.uniform(9.0, 11.0), 2),
+                                int(rs.randint(1, 10)) * 100, 20170704, 93000)
+        order.order_type = common.ORDER_TYPE.LIMIT if rs.rand() < 0.7 else common.ORDER_TYPE.STOP
+        orders.append(order)
+    return symbols, orders
+
+
+def _make_bars(symbols, n_bars, seed=0):
+    rs = np.random.RandomState(seed)
+    bars = []
+    for t in range(n_bars):
+        for sec in symbols:
+            bar = Bar()
+            mid = 10.0 + 0.3 * rs.randn()
+            bar.symbol, bar.time = sec, 93100 + t * 100
+            bar.low, bar.high = np.round(mid - 0.1, 2), np.round(mid + 0.1, 2)
+            bar.volume = 1000
+            bars.append(bar)
+    return bars
+
+
+def _scan_trades(orders, bar):
+    """Reference: scan all orders, fill triggered ones fully."""
+    res = []
+    for order in orders:
+        if order.symbol != bar.symbol or order.is_finished:
+            continue
+        buy = order.entrust_action == common.ORDER_ACTION.BUY
+        if order.order_type == common.ORDER_TYPE.LIMIT:
+            triggered = order.entrust_price >= bar.low if buy else order.entrust_price <= bar.high
+        else:
+            triggered = order.entrust_price <= bar.high if buy else order.entrust_price >= bar.low
+        if triggered:
+            order.fill_size = order.entrust_size
+            order.order_status = common.ORDER_STATUS.FILLED
+            res.append(order.entrust_no)
+    return res
+
+
+def _limit_buy(price, size):
+    order = Order.new_order('600000.SH', common.ORDER_ACTION.BUY, price, size, 20170704, 93000)
+    order.order_type = common.ORDER_TYPE.LIMIT
+    return order
+
+
+def test_order_book():
+    symbols, orders = _make_resting_orders(20, 400)
+    bars = _make_bars(symbols, 5)
+
+    book = OrderBook()
+    for order in orders:
+        book.add_order(order)
+    to_cancel = [o.entrust_no for o in orders[::7]]
+    for entrust_no in to_cancel:
+        ind = book.cancel_order(entrust_no)
+        assert ind.order_status == common.ORDER_STATUS.CANCELLED and ind.entrust_no == entrust_no
+    assert book.cancel_order(to_cancel[0]) is None
+
+    resting = [o for i, o in enumerate(orders) if i % 7]
+    for bar in bars:
+        expected = _scan_trades(resting, bar)
+        result = book.make_trade_bar(bar)
+        assert sorted(trade.entrust_no for trade, _ in result) == sorted(expected)
+        for trade, ind in result:
+            assert ind.order_status == common.ORDER_STATUS.FILLED and trade.fill_size == ind.entrust_size
+            assert trade.fill_time == bar.time and trade.fill_price == ind.entrust_price
+    n_resting = len([o for o in resting if not o.is_finished])
+    assert len(book.orders) == n_resting
+    assert len(book.cancel_all()) == n_resting and not book.orders
+
+    # partial fills: at most half of bar volume on each side, best price first
+    book = OrderBook(volume_ratio=0.5)
+    for price, size in [(10.0, 300), (10.2, 300), (10.1, 200)]:
+        book.add_order(_limit_buy(price, size))
+    bar = Bar()
+    bar.symbol, bar.time, bar.low, bar.high, bar.volume = '600000.SH', 93100, 9.9, 10.3, 1000
+    result = book.make_trade_bar(bar)
+    assert [(t.fill_price, t.fill_size) for t, _ in result] == [(10.2, 300), (10.1, 200)]
+    bar.time = 93200
+    result = book.make_trade_bar(bar)
+    assert [(t.fill_price, t.fill_size) for t, _ in result] == [(10.0, 300)]
+    assert not book.orders
+
+    book.add_order(_limit_buy(10.0, 800))
+    trade, ind = book.make_trade_bar(bar)[0]
+    assert trade.fill_size == 500 and ind.fill_size == 500 and ind.order_status == common.ORDER_STATUS.ACCEPTED
+    ind = book.cancel_order(ind.entrust_no)
+    assert ind.fill_size == 500 and book.orders == {} and book.make_trade_bar(bar) == []
+
+    # limit orders take the volume of a side before stop orders
+    book = OrderBook(volume_ratio=0.5)
+    stop = Order.new_order('600000.SH', common.ORDER_ACTION.BUY, 10.0, 300, 20170704, 93000)
+    stop.order_type = common.ORDER_TYPE.STOP
+    book.add_order(stop)
+    book.add_order(_limit_buy(10.1, 400))
+    result = book.make_trade_bar(bar)
+    assert [(t.fill_price, t.fill_size) for t, _ in result] == [(10.1, 400), (10.0, 100)]
+
+
+def test_order_book_bar_batch():
+    symbols, _ = _make_resting_orders(20, 400)
+    bars = _make_bars(symbols, 5)
+    batch = BarBatch.create_from_df(pd.DataFrame([bar.__dict__ for bar in bars]))
+
+    res = []
+    for quotes in [bars, batch]:
+        book = OrderBook()
+        for order in _make_resting_orders(20, 400)[1]:
+            book.add_order(order)
+        res.append([(trade.entrust_no, trade.fill_price, trade.fill_size, trade.fill_time)
+                    for quote in quotes for trade, _ in book.make_trade_bar(quote)])
+    assert len(res[0]) > 0 and res[0] == res[1]
+
+
+def test_order_book_speed():
+    symbols, orders = _make_resting_orders(300, 5000, seed=1)
+    bars = _make_bars(symbols, 10)
+    # most orders rest away from the bars, as in a book accumulated over a day
+    for order in orders[100:]:
+        buy = order.entrust_action == common.ORDER_ACTION.BUY
+        below = buy == (order.order_type == common.ORDER_TYPE.LIMIT)
+        order.entrust_price += -2.0 if below else 2.0
+
+    book = OrderBook()
+    for order in orders:
+        book.add_order(order)
+    t0 = time.time()
+    n_trades = sum(len(book.make_trade_bar(bar)) for bar in bars)
+    t_book = time.time() - t0
+    t0 = time.time()
+    n_expected = sum(len(_scan_trades(orders, bar)) for bar in bars)
+    t_scan = time.time() - t0
+    print("{:d} bars on {:d} resting orders: order book {:.1f} ms, scan {:.1f} ms".format(
+        len(bars), len(orders), t_book * 1e3, t_scan * 1e3))
+    assert n_trades == n_expected
+
+
+if __name__ == "__main__":
+    test_array_portfolio_manager()
+    test_array_portfolio_manager_cover()
+    test_stock_simulator_daily()
+    test_stock_simulator_daily_speed()
+    test_stock_simulator_daily_expire()
+    test_order_book()
+    test_order_book_bar_batch()
+    test_order_book_speed()
@@ -0,0 +1,89 @@
+# encoding: utf-8
+
+import copy
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.basic.marketdata import Bar, BarBatch
+
+
+def _make_df_bars(n_symbols=300, n_times=240, seed=0):
+    rs = np.random.RandomState(seed)
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    times = [93100 + 100 * (i % 29) + 10000 * (i // 29) for i in range(n_times)]
+    close = np.round(10.0 + rs.randn(n_times * n_symbols), 2)
+    return pd.DataFrame({'symbol': symbols * n_times,
+                         'time': np.repeat(times, n_symbols),
+                         'trade_date': 20170704,
+                         'close': close,
+                         'high': close + 0.05,
+                         'low': close - 0.05,
+                         'volume': rs.randint(0, 10000, n_times * n_symbols)})
+
+
+def test_bar_batch():
+    df = _make_df_bars(n_symbols=5, n_times=4)
+    bars = Bar.create_from_df(df)
+    batch = BarBatch.create_from_df(df)
+    assert len(batch) == len(bars) == 20
+
+    for bar, view in zip(bars, batch):
+        for field in ['symbol', 'time', 'trade_date', 'close', 'high', 'low', 'volume', 'open', 'vwap', 'oi']:
+            assert getattr(view, field) == getattr(bar, field)
+        assert view.to_dict() == bar.__dict__
+    assert batch[-1].symbol == bars[-1].symbol
+    try:
+        batch[20]
+        assert False
+    except IndexError:
+        pass
+    try:
+        batch[0].bid
+        assert False
+    except AttributeError:
+        pass
+    # views are read-only and have no __dict__
+    try:
+        batch[0].close = 1.0
+        assert False
+    except AttributeError:
+        pass
+
+    # copies and pickles keep the values of the row only
+    view = batch[7]
+    for res in [copy.copy(view), copy.deepcopy(view), pickle.loads(pickle.dumps(view)),
+                pickle.loads(pickle.dumps(view, pickle.HIGHEST_PROTOCOL))]:
+        assert res.to_dict() == view.to_dict() and res.close == bars[7].close
+        assert len(res._columns['close']) == 1
+
+    # stable sort: symbols of the same time keep their order
+    shuffled = BarBatch.create_from_df(df.iloc[::-1])
+    res = shuffled.sort_by('time')
+    assert list(res.arrays['time']) == sorted(df['time'])
+    assert [q.symbol for q in res][:5] == list(df['symbol'].iloc[:5][::-1])
+
+
+def test_bar_batch_speed():
+    df = _make_df_bars(n_times=60)
+
+    t0 = time.time()
+    n = 0
+    for quote in Bar.create_from_df(df):
+        n += quote.volume > 0
+    t_bar = time.time() - t0
+
+    t0 = time.time()
+    n_batch = 0
+    for quote in BarBatch.create_from_df(df):
+        n_batch += quote.volume > 0
+    t_batch = time.time() - t0
+    print("{} bars: Bar.create_from_df {:.0f} ms, BarBatch {:.0f} ms".format(len(df), t_bar * 1e3, t_batch * 1e3))
+    assert n == n_batch
+
+
+if __name__ == "__main__":
+    test_bar_batch()
+    test_bar_batch_speed()
@@ -0,0 +1,64 @@
+# encoding: utf-8
+
+import time
+
+import pandas as pd
+
+from quantos.data.dataapi import DataApi
+from quantos.data.dataapi.mock_server import MockDataServer
+
+ADDR = "tcp://127.0.0.1:18911"
+
+
+def test_mock_server():
+    server = MockDataServer(ADDR, quote_rate=20.0, users={'test': '123'})
+    server.start()
+    api = DataApi(ADDR)
+    try:
+        r, msg = api.login("test", "wrong")
+        assert not r
+        r, msg = api.login("test", "123")
+        assert msg == '0,'
+
+        daily, msg = api.daily(symbol="600030.SH,000002.SZ", start_date=20170103, end_date=20170708,
+                               fields="open,high,low,close,volume,last,trade_date,settle")
+        assert msg == '0,'
+        assert daily.shape == (2 * 134, 8)
+
+        # same symbol and date always give same price
+        daily2, msg2 = api.daily(symbol="600030.SH", start_date=20170601, end_date=20170708, fields="")
+        assert daily2.shape == (27, 13)
+        close1 = daily.loc[daily['trade_date'] == 20170601, 'close'].values[0]
+        close2 = daily2.loc[daily2['trade_date'] == 20170601, 'close'].values[0]
+        assert abs(close1 - close2) < 1e-8
+
+        bar, msg = api.bar(symbol="600030.SH", trade_date=20170904, freq='1m', start_time=90000, end_time=150000)
+        assert msg == '0,'
+        assert bar.shape == (240, 15)
+
+        # recorded data overrides synthetic data
+        df_rec = pd.DataFrame({'symbol': ['600030.SH'], 'pb': [1.5135]})
+        server.add_recorded('jset.query', df_rec, view='lb.secDailyIndicator', symbol='600030.SH')
+        df, msg = api.query("lb.secDailyIndicator", fields="pb",
+                            filter="symbol=600030.SH&start_date=20170907&end_date=20170907")
+        assert msg == '0,'
+        assert abs(df.loc[0, 'pb'] - 1.5135) < 1e-8
+
+        quotes = []
+        api.set_callback(lambda type_, data: quotes.append(data) if type_ == 'quote' else None)
+        securities, msg = api.subscribe("600030.SH,000002.SZ")
+        assert msg == '0,'
+        assert set(securities) == {"600030.SH", "000002.SZ"}
+        time.sleep(1.0)
+        assert len(quotes) > 0
+        assert set(quotes[0].keys()) == set(MockDataServer.QUOTE_FIELDS)
+
+        assert server.stats['bytes_out'] > 0
+        assert server.stats['methods']['jsd.query'] == 2
+    finally:
+        api.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    test_mock_server()
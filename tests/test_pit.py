@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.align import align
+from quantos.data.dataview import DataView
+from quantos.data.pit import StatementVersions
+from quantos.data.formula_dag import FormulaDAG
+
+SYMBOLS = ['000001.SZ', '600000.SH', '600030.SH']
+REPORT_DATES = [20160331, 20160630, 20160930, 20161231, 20170331]
+ANN_DATES = [20160425, 20160820, 20161025, 20170320, 20170420]
+
+
+def _make_versions():
+    rows = []
+    for i, symbol in enumerate(SYMBOLS):
+        for j, (report_date, ann_date) in enumerate(zip(REPORT_DATES, ANN_DATES)):
+            rows.append((symbol, report_date, ann_date + i, 100.0 * (i + 1) + j))
+    df = pd.DataFrame(rows, columns=['symbol', 'report_date', 'ann_date', 'oper_rev'])
+    restatements = pd.DataFrame([('600000.SH', 20160930, 20161201, 150.0),  # restate the latest report
+                                 ('600000.SH', 20160630, 20170601, 160.0),  # restate an older report
+                                 ('600030.SH', 20161231, 20170405, 350.0)],
+                                columns=['symbol', 'report_date', 'ann_date', 'oper_rev'])
+    return df, restatements
+
+
+def _make_dataview(versions):
+    """DataView with daily close and quarterly oper_rev (original versions), without data server."""
+    dates = np.array([d for d in range(20160401, 20170801) if 101 <= d % 10000 <= 1231 and 1 <= d % 100 <= 28])
+    dates = dates[::3]
+    rs = np.random.RandomState(0)
+    close = pd.DataFrame(rs.rand(len(dates), len(SYMBOLS)) + 1.0, index=dates, columns=SYMBOLS)
+
+    dv = DataView()
+    dv.symbol = SYMBOLS
+    dv.start_date, dv.end_date = dates[0], dates[-1]
+    dv.extended_start_date_d, dv.extended_start_date_q = dates[0], 20160101
+    dv.fields = ['close', 'oper_rev']
+
+    dv.statements = StatementVersions(versions)
+    first = dv.statements.first_versions().set_index(['report_date', 'symbol'])
+    dv.data_q = first[['ann_date', 'oper_rev']].astype(float).unstack('symbol').swaplevel(axis=1).sort_index(axis=1)
+    dv.data_q.columns.names = ['symbol', 'field']
+    dv.data_d = pd.concat({'close': close}, axis=1).swaplevel(axis=1).sort_index(axis=1)
+    dv.data_d.columns.names = ['symbol', 'field']
+    return dv
+
+
+def _point_in_time(dv, formula):
+    """Reference: evaluate formula on each date with statements as known on that date."""
+    dates = dv.dates
+    close = dv.get_ts('close')
+    res = pd.DataFrame(np.nan, index=dates, columns=SYMBOLS)
+    for date in dates:
+        vintage = dv.statements.vintage(date)
+        df_ann = vintage['ann_date'].unstack('symbol')
+        oper_rev = vintage['oper_rev'].unstack('symbol')
+        dag = FormulaDAG()
+        df, = dag.evaluate([dag.compile(formula)], {'close': close, 'oper_rev': oper_rev},
+                           ann_dts=df_ann, trade_dts=dates)
+        res.loc[date] = df.loc[date, SYMBOLS]
+    return res
+
+
+def test_statement_versions():
+    df, restatements = _make_versions()
+    store = StatementVersions(df)
+    dates = np.union1d(np.arange(20160101, 20170801, 5),
+                       [20161126, 20161201, 20170321, 20170405, 20170425, 20170601])
+
+    # without restatements, point-in-time expansion is the same as align
+    df_value = df.set_index(['report_date', 'symbol'])['oper_rev'].unstack('symbol')
+    df_ann = df.set_index(['report_date', 'symbol'])['ann_date'].unstack('symbol')
+    expected = align(df_value, df_ann, dates)
+    assert np.allclose(store.expand('oper_rev', dates, SYMBOLS).values, expected.values, equal_nan=True)
+
+    new = store.add(pd.concat([restatements, df.iloc[:2]]))
+    assert len(new) == 3 and new['is_restatement'].all()
+    assert len(store) == len(df) + 3 and len(store.restatements()) == 3
+    assert len(store.first_versions()) == len(df)
+
+    res = store.expand('oper_rev', dates, SYMBOLS)
+    sr = res['600000.SH']
+    assert sr.loc[20161126] == 202.0 and sr.loc[20161201] == 150.0
+    assert sr.loc[20170321] == 203.0  # a newer report
+    assert sr.loc[20170601] == 204.0  # restatement of an older report is not the latest report
+    assert res['600030.SH'].loc[20170405] == 350.0 and res['600030.SH'].loc[20170425] == 304.0
+
+    vintage = store.vintage(20170101, symbols=['600000.SH'])
+    assert vintage.loc[('600000.SH', 20160930), 'oper_rev'] == 150.0
+    assert vintage.loc[('600000.SH', 20160930), 'ann_date'] == ANN_DATES[2] + 1
+    assert vintage.loc[('600000.SH', 20160630), 'oper_rev'] == 201.0
+    assert vintage.loc[('600000.SH', 20170331), 'oper_rev'] == 204.0  # first announced later
+
+
+def test_restate_formulas():
+    df, restatements = _make_versions()
+    dv = _make_dataview(pd.concat([df, restatements]))
+    formulas = ['oper_rev / close', 'Rank(Delta(oper_rev, 1))']
+
+    dv.add_formula('f1', formulas[0], is_quarterly=False)
+    dv.add_formula('f2', formulas[1], is_quarterly=False)
+    for name, formula in zip(['f1', 'f2'], formulas):
+        assert np.allclose(dv.get_ts(name).values, _point_in_time(dv, formula).values, equal_nan=True)
+    assert (dv.get_ts('oper_rev').loc[20161201: 20161231, '600000.SH'] == 150.0).all()
+
+    # a new restatement only changes results after its ann_date
+    before = dv.get_ts('f1')
+    new = dv.add_statement_versions(pd.DataFrame([('000001.SZ', 20170331, 20170510, 90.0)],
+                                                 columns=['symbol', 'report_date', 'ann_date', 'oper_rev']))
+    assert len(new) == 1
+    after = dv.get_ts('f1')
+    changed = (after != before) & after.notnull()
+    assert changed.values.any()
+    assert list(changed.columns[changed.any()]) == ['000001.SZ']
+    assert changed.index[changed.any(axis=1)].min() >= 20170510
+    for name, formula in zip(['f1', 'f2'], formulas):
+        assert np.allclose(dv.get_ts(name).values, _point_in_time(dv, formula).values, equal_nan=True)
+
+
+def test_restate_chained_formulas():
+    df, restatements = _make_versions()
+    dv = _make_dataview(pd.concat([df, restatements]))
+    dv.add_formula('f1', 'oper_rev / close', is_quarterly=False)
+    # formula fields only using other formula fields, the first one also cached by the DAG
+    dv.add_formula('f3', 'f1 * 2', is_quarterly=False)
+    dv.add_formula('f4', 'Ts_Mean(f3, 3) + Rank(f1)', is_quarterly=False)
+    dv.add_formula('f5', 'f1 * 2', is_quarterly=False)
+
+    # a restatement of an older report, before a restatement already known
+    new = dv.add_statement_versions(pd.DataFrame([('600000.SH', 20160930, 20170310, 170.0)],
+                                                 columns=['symbol', 'report_date', 'ann_date', 'oper_rev']))
+    assert len(new) == 1
+    f1 = _point_in_time(dv, 'oper_rev / close')
+    assert np.allclose(dv.get_ts('f1').values, f1.values, equal_nan=True)
+    assert dv.get_ts('f1').loc[20170310:, '600000.SH'].notnull().any()
+    for name in ['f3', 'f5']:
+        assert np.allclose(dv.get_ts(name).values, f1.values * 2, equal_nan=True)
+    # f4 uses stored values of f1 and f3 on each date
+    dag = FormulaDAG()
+    expected, = dag.evaluate([dag.compile('Ts_Mean(f1 * 2, 3) + Rank(f1)')], {'f1': f1}, trade_dts=dv.dates)
+    assert np.allclose(dv.get_ts('f4').values, expected.values, equal_nan=True)
+    assert np.allclose(dv.eval_formula('f1 * 2').values, f1.values * 2, equal_nan=True)
+
+
+if __name__ == "__main__":
+    test_statement_versions()
+    test_restate_formulas()
+    test_restate_chained_formulas()
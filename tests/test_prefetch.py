@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest.backtest import EventBacktestInstance
+from quantos.backtest.prefetch import Prefetcher
+
+
+class _Calendar(object):
+    def __init__(self, dates):
+        self.dates = np.array(dates)
+
+    def get_trade_date_range(self, begin, end):
+        return self.dates[(self.dates >= begin) & (self.dates <= end)]
+
+
+class _DataApi(object):
+    """Bars of 3 symbols and 4 minutes per day, unsorted, after a delay."""
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.threads = set()
+
+    def bar(self, symbol, start_time, end_time, trade_date, freq):
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread().name)
+        if trade_date == 20170106:
+            return None, "no data"
+        times = [93100, 93200, 93300, 93400]
+        df = pd.DataFrame([{'symbol': sec, 'time': t, 'trade_date': trade_date, 'close': 10.0 + i}
+                           for t in times[::-1] for i, sec in enumerate(symbol)])
+        return df, "0,"
+
+
+class _Gateway(object):
+    def __init__(self):
+        self.days = []
+
+    def on_new_day(self, trade_date):
+        self.days.append(trade_date)
+
+    def process_quote(self, quote):
+        return []
+
+
+class _Strategy(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.quotes = []
+
+    def on_new_day(self, trade_date):
+        pass
+
+    def on_quote(self, quote):
+        self.quotes.append((quote.trade_date, quote.time, quote.symbol))
+        time.sleep(self.delay)
+
+
+class _Context(object):
+    pass
+
+
+def _make_instance(prefetch_days, fetch_delay=0.0, process_delay=0.0):
+    bt = EventBacktestInstance()
+    bt.ctx = _Context()
+    bt.ctx.calendar = _Calendar([20170103, 20170104, 20170105, 20170106, 20170109, 20170110, 20170111])
+    bt.ctx.data_api = _DataApi(fetch_delay)
+    bt.ctx.gateway = _Gateway()
+    bt.ctx.universe = ['000001.SZ', '600000.SH', '000002.SZ']
+    bt.strategy = _Strategy(process_delay)
+    bt.start_date, bt.end_date = 20170103, 20170109
+    bt.prefetch_days = prefetch_days
+    return bt
+
+
+def test_prefetcher():
+    consumed = []
+    fetched = []
+
+    def func(item):
+        fetched.append(item)
+        return item * 2
+
+    with Prefetcher(func, range(20), n_ahead=3) as prefetcher:
+        for item, res in prefetcher:
+            time.sleep(0.005)
+            # bounded: at most n_ahead results waiting and one being fetched
+            assert len(fetched) - len(consumed) <= 5
+            consumed.append((item, res))
+    assert consumed == [(i, i * 2) for i in range(20)]
+
+    # errors are raised at the item that failed
+    def fail(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    consumed = []
+    try:
+        with Prefetcher(fail, range(10), n_ahead=2) as prefetcher:
+            for item, res in prefetcher:
+                consumed.append(item)
+        assert False
+    except ValueError:
+        pass
+    assert consumed == [0, 1, 2]
+
+    # stop early
+    prefetcher = Prefetcher(func, range(1000), n_ahead=2)
+    with prefetcher:
+        for item, res in prefetcher:
+            break
+    assert prefetcher._thread is None
+
+
+def test_event_backtest_prefetch():
+    bt = _make_instance(0)
+    bt.run()
+    assert bt.ctx.gateway.days == [20170104, 20170105, 20170106, 20170109, 20170110]
+    assert len(bt.strategy.quotes) == 4 * 3 * 4
+    # bars of each day are sorted by time
+    assert [q[:2] for q in bt.strategy.quotes[:4]] == [(20170104, 93100)] * 3 + [(20170104, 93200)]
+    assert bt.ctx.data_api.threads == {threading.current_thread().name}
+
+    bt2 = _make_instance(2)
+    bt2.run()
+    assert bt2.ctx.gateway.days == bt.ctx.gateway.days
+    assert bt2.strategy.quotes == bt.strategy.quotes
+    assert threading.current_thread().name not in bt2.ctx.data_api.threads
+
+
+def test_event_backtest_prefetch_speed():
+    # fetch and simulation take 20 ms each per day
+    kwargs = {'fetch_delay': 0.02, 'process_delay': 0.02 / 12}
+    bt_sync = _make_instance(0, **kwargs)
+    t0 = time.time()
+    bt_sync.run()
+    t_sync = time.time() - t0
+
+    bt = _make_instance(2, **kwargs)
+    t0 = time.time()
+    bt.run()
+    t_prefetch = time.time() - t0
+    print("sync {:.0f} ms, prefetch {:.0f} ms".format(t_sync * 1e3, t_prefetch * 1e3))
+    assert bt.strategy.quotes == bt_sync.strategy.quotes
+
+
+if __name__ == "__main__":
+    test_prefetcher()
+    test_event_backtest_prefetch()
+    test_event_backtest_prefetch_speed()
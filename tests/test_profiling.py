@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.py_expression_eval import Parser
+from quantos.data.formula_dag import FormulaDAG
+from quantos.data.profiling import FormulaProfiler
+
+
+def _make_data(n_dates=60, n_symbols=8, seed=369):
+    np.random.seed(seed)
+    index = np.arange(20170101, 20170101 + n_dates)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+
+    def make():
+        return pd.DataFrame(index=index, columns=columns, data=np.random.rand(n_dates, n_symbols) + 1.0)
+    return {'close': make(), 'open': make(), 'volume': make()}
+
+
+def test_profile_parser():
+    data = _make_data()
+    df_group = pd.DataFrame(index=data['close'].index, columns=data['close'].columns,
+                            data=np.tile(np.arange(8) % 3, (60, 1)))
+    formula = 'GroupApply(Standardize, Decay_linear(close / open, 10)) + Delay(volume, 2)'
+    parser = Parser()
+    parser.parse(formula)
+    expected = parser.evaluate(data, df_group=df_group)
+
+    profiler = FormulaProfiler()
+    res = parser.evaluate(data, df_group=df_group, profiler=profiler)
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+    df = profiler.to_frame()
+    assert sorted(df['name']) == sorted(['/', 'Decay_linear', 'GroupApply', 'Delay', '+'])
+    assert (df['formula'] == formula).all()
+    assert (df['shape'] == (60, 8)).all()
+    assert (df['nbytes'] == 60 * 8 * 8).all()
+    # first 9 rows of Decay_linear are NaN
+    assert np.isclose(df.loc[df['name'] == 'Decay_linear', 'nan_ratio'].iloc[0], 9 / 60.)
+
+    summary = profiler.summary()
+    assert summary['calls'].sum() == 5
+    assert np.isclose(summary['time_pct'].sum(), 100.0)
+
+    # call tree: + -> GroupApply -> Decay_linear -> /
+    stacks = [line.rsplit(' ', 1)[0] for line in profiler.folded_stacks()]
+    top = formula.replace(' ', '').replace(';', ',')
+    assert '{};+;GroupApply;Decay_linear;/'.format(top) in stacks
+    assert '{};+;Delay'.format(top) in stacks
+    assert len(stacks) == 5
+
+
+def test_profile_dag():
+    data = _make_data()
+    formulas = [('a', 'Rank(Ts_Mean(close / open, 5))'),
+                ('b', 'Ts_Mean(close / open, 5) * 2 - volume'),
+                ('c', '(close - open) / (close + open)')]
+    dag = FormulaDAG()
+    roots = [dag.compile(f) for _, f in formulas]
+    profiler = FormulaProfiler()
+    dag.evaluate(roots, data, profiler=profiler, names=[name for name, _ in formulas])
+
+    df = profiler.to_frame()
+    # shared Ts_Mean(close / open, 5) is computed and attributed once
+    assert (df['name'] == 'ts_mean').sum() == 1
+    assert df.loc[df['name'] == 'ts_mean', 'formula'].iloc[0] == 'a'
+    assert set(df.loc[df['kind'] == 'var', 'name']) == {'close', 'open', 'volume'}
+    assert (df['name'] == 'fused').sum() == 2
+    assert set(profiler.summary(by='formula').index) == {'a', 'b', 'c'}
+    assert len(profiler.folded_stacks()) == len(df)
+
+    # cached results are not recorded
+    profiler.clear()
+    dag.evaluate(roots, data, profiler=profiler)
+    assert profiler.to_frame().empty and profiler.summary().empty
+
+
+if __name__ == "__main__":
+    test_profile_parser()
+    test_profile_dag()
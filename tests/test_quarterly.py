@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data import quarterly
+from quantos.data.align import align
+from quantos.data.py_expression_eval import Parser
+
+
+def _make_cumulative():
+    """Cumulative values of 2 symbols, single quarter values are 1, 2, 3, ... in order."""
+    report_dates = [20150331, 20150630, 20150930, 20151231,
+                    20160331, 20160630, 20160930, 20161231, 20170331, 20170630]
+    single = np.arange(1.0, 11.0)
+    cum = single.copy()
+    for i in range(len(cum)):
+        if i % 4:
+            cum[i] += cum[i - 1]
+    df = pd.DataFrame({'a': cum, 'b': cum * 2}, index=report_dates)
+    return df, single
+
+
+def test_quarterly_operators():
+    df, single = _make_cumulative()
+    assert np.allclose(quarterly.single_quarter(df)['a'].values, single)
+
+    ttm = quarterly.ttm(df)['a']
+    assert np.isnan(ttm.iloc[:3]).all()
+    assert ttm.loc[20151231] == 1 + 2 + 3 + 4
+    assert ttm.loc[20160630] == 3 + 4 + 5 + 6
+    assert ttm.loc[20170630] == 7 + 8 + 9 + 10
+    assert np.allclose(quarterly.ttm(df)['b'], ttm * 2, equal_nan=True)
+
+    sq = quarterly.single_quarter(df)
+    assert np.allclose(quarterly.yoy(sq)['a'].values[4:], 4.0 / single[:-4])
+    assert np.allclose(quarterly.qoq(sq)['a'].values[1:], 1.0 / single[:-1])
+
+    # a missing report (20160331) must not shift other quarters
+    df_missing = df.drop(20160331)
+    df_missing.loc[20160930, 'b'] = np.nan
+    sq = quarterly.single_quarter(df_missing)
+    assert list(sq.index) == list(df_missing.index)
+    assert np.isnan(sq.loc[20160630, 'a']) and sq.loc[20160930, 'a'] == 7
+    assert np.isnan(sq.loc[20161231, 'b'])
+    ttm = quarterly.ttm(df_missing)['a']
+    assert ttm.loc[20160630] == 3 + 4 + 5 + 6  # does not need Q1 of 2016
+    assert np.isnan(ttm.loc[20170331])
+    assert np.isnan(quarterly.yoy(df_missing).loc[20170331, 'a'])
+
+    # growth from a loss is positive
+    loss = pd.DataFrame({'a': [-2.0, 0.0, 1.0, 4.0, -1.0]},
+                        index=[20150331, 20150630, 20150930, 20151231, 20160331])
+    assert np.allclose(quarterly.qoq(loss)['a'].values, [np.nan, 1.0, np.nan, 3.0, -1.25], equal_nan=True)
+    assert quarterly.yoy(loss).loc[20160331, 'a'] == 0.5
+
+    try:
+        quarterly.ttm(pd.DataFrame({'a': [1.0, 2.0]}, index=[20170103, 20170104]))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_quarterly_formula():
+    df, _ = _make_cumulative()
+    df_ann = pd.DataFrame(df.index.values + 30, index=df.index, columns=['a'])
+    df_ann['b'] = df_ann['a']
+    trade_dts = np.arange(20150101, 20170801, 10)
+    close = pd.DataFrame(1.0, index=trade_dts, columns=['a', 'b'])
+
+    parser = Parser()
+    parser.parse('YoY(TTM(revenue)) + close')
+    res = parser.evaluate({'revenue': df, 'close': close}, ann_dts=df_ann, trade_dts=trade_dts)
+    expected = align(quarterly.yoy(quarterly.ttm(df)), df_ann, trade_dts) + 1.0
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+
+if __name__ == "__main__":
+    test_quarterly_operators()
+    test_quarterly_formula()
@@ -0,0 +1,175 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from quantos.data import rolling
+from quantos.data.py_expression_eval import Parser
+
+
+def _make_data(n_dates=200, n_symbols=6, seed=369):
+    rs = np.random.RandomState(seed)
+    data = rs.randn(n_dates, n_symbols).cumsum(axis=0) + 50.0
+    data[rs.rand(n_dates, n_symbols) < 0.05] = np.nan
+    data[:30, 0] = np.nan  # listed late
+    data[50:80, 1] = 42.0  # suspended, constant price
+    data[100:110, 2] = 0.0
+    data[120:140, 3] *= -1
+    return pd.DataFrame(data, index=np.arange(20170101, 20170101 + n_dates))
+
+
+def _assert_same(res, expected, rtol=1e-7, atol=1e-9):
+    res, expected = np.asarray(res), np.asarray(expected)
+    assert res.shape == expected.shape
+    assert np.allclose(res, expected, rtol=rtol, atol=atol, equal_nan=True)
+
+
+def test_moments():
+    df = _make_data()
+    for n in [1, 2, 5, 20]:
+        r = df.rolling(n)
+        _assert_same(rolling.rolling_sum(df, n), r.sum())
+        _assert_same(rolling.rolling_mean(df, n), r.mean())
+        _assert_same(rolling.rolling_min(df, n), r.min())
+        _assert_same(rolling.rolling_max(df, n), r.max())
+        _assert_same(rolling.rolling_std(df, n), r.std(), atol=1e-6)
+        _assert_same(rolling.rolling_var(df, n), r.var(), atol=1e-6)
+        _assert_same(rolling.rolling_count_nans(df, n), n - df.rolling(n, min_periods=0).count())
+    for n in [5, 20]:
+        r = df.rolling(n)
+        skew, kurt = rolling.rolling_skew(df, n), rolling.rolling_kurt(df, n)
+        # constant windows (columns 1 and 2) are NaN as in pandas 0.20, newer pandas gives 0
+        valid = ~np.isnan(skew.values)
+        _assert_same(skew.values[valid], r.skew().values[valid], rtol=1e-5, atol=1e-6)
+        _assert_same(kurt.values[valid], r.kurt().values[valid], rtol=1e-5, atol=1e-5)
+        assert np.isnan(skew.iloc[70, 1]) and np.isnan(kurt.iloc[70, 1])
+        assert (np.isnan(skew.values) == np.isnan(r.skew().values))[:, [0, 3, 4, 5]].all()
+
+    # constant window has zero deviation
+    assert rolling.rolling_std(df, 10).iloc[70, 1] == 0.0
+
+    # window longer than data
+    assert np.isnan(rolling.rolling_mean(df, 500).values).all()
+
+
+def test_bivariate():
+    df = _make_data()
+    df2 = _make_data(seed=963)
+    df2 = df2.iloc[:, :5]
+    n = 10
+    x, y = df.align(df2)
+    _assert_same(rolling.rolling_cov(df, df2, n), x.rolling(n).cov(y), atol=1e-6)
+
+    corr = rolling.rolling_corr(df, df2, n)
+    expected = x.rolling(n).corr(y)
+    valid = ~np.isnan(corr.values)
+    _assert_same(corr.values[valid], expected.values[valid], atol=1e-6)
+    assert np.isnan(corr.iloc[70, 1])
+    assert np.isnan(corr.iloc[:, 5]).all()
+
+
+def test_apply_kernels():
+    df = _make_data()
+    n = 7
+
+    def decay_linear_array(x):
+        step = np.arange(1, len(x) + 1)
+        return np.dot(x, step) / np.sum(step)
+
+    def decay_exp_array(x, f):
+        fs = np.power(f, np.arange(len(x))[::-1])
+        return np.dot(x, fs) / np.sum(fs)
+
+    _assert_same(rolling.rolling_product(df, n), df.rolling(n).apply(np.prod), rtol=1e-9)
+    _assert_same(rolling.decay_linear(df, n), df.rolling(n).apply(decay_linear_array))
+    for f in [0.5, 0.9, 1.0, 1.2]:
+        _assert_same(rolling.decay_exp(df, n, f), df.rolling(n).apply(decay_exp_array, args=(f,)))
+
+    # other input types
+    arr = df.values
+    assert np.allclose(rolling.decay_linear(arr, n), rolling.decay_linear(df, n).values, equal_nan=True)
+    sr = rolling.rolling_product(df[2], n)
+    assert isinstance(sr, pd.Series) and sr.iloc[105] == 0.0
+
+
+def test_rank_and_regression():
+    df = _make_data()
+    df2 = _make_data(seed=963)
+    n = 8
+
+    def ts_rank_array(x):
+        return pd.Series(x).rank().iloc[-1]
+
+    _assert_same(rolling.rolling_rank(df, n), df.rolling(n).apply(ts_rank_array))
+    assert rolling.rolling_rank(df, n).iloc[70, 1] == (n + 1) / 2.0  # constant window, all ties
+    _assert_same(rolling.rolling_argmax(df, n), df.rolling(n).apply(np.argmax) + 1)
+    _assert_same(rolling.rolling_argmin(df, n), df.rolling(n).apply(np.argmin) + 1)
+
+    beta = rolling.rolling_beta(df, df2, n)
+    _assert_same(beta, df.rolling(n).cov(df2) / df2.rolling(n).var(), atol=1e-6)
+    residual = rolling.rolling_residual(df, df2, n)
+    alpha = df.rolling(n).mean() - beta * df2.rolling(n).mean()
+    _assert_same(residual, df - alpha - beta * df2, atol=1e-6)
+
+    # regression versus a single series, e.g. benchmark
+    parser = Parser()
+    parser.parse('Ts_Residual(close, bench, 8)')
+    res = parser.evaluate({'close': df, 'bench': df2[[0]]})
+    expected = rolling.rolling_residual(df[3], df2[0], n)
+    assert np.allclose(res[3].values, expected.values, equal_nan=True)
+
+
+def test_cumulative_windows():
+    df = _make_data()
+    cw = rolling.CumulativeWindows(df)
+    for n in [1, 3, 20]:
+        _assert_same(cw.rolling_sum(n), rolling.rolling_sum(df, n))
+        _assert_same(cw.rolling_mean(n), rolling.rolling_mean(df, n))
+        _assert_same(cw.rolling_std(n), rolling.rolling_std(df, n))
+        _assert_same(cw.rolling_var(n, ddof=0), rolling.rolling_var(df, n, 0))
+        _assert_same(cw.rolling_count_nans(n), rolling.rolling_count_nans(df, n))
+        _assert_same(cw.rolling_product(n), rolling.rolling_product(df, n))
+    assert cw.rolling_std(10).iloc[70, 1] == 0.0
+    assert isinstance(rolling.CumulativeWindows(df[0]).rolling_mean(5), pd.Series)
+
+
+def _windows(x, n):
+    """Reference: ref a function to each full window of n rows of a 1D array, NaN if any value is missing."""
+    def ref(func, y=None):
+        res = np.full(len(x), np.nan)
+        for t in range(n - 1, len(x)):
+            wx = x[t - n + 1:t + 1]
+            wy = None if y is None else y[t - n + 1:t + 1]
+            if not np.isnan(wx).any() and (wy is None or not np.isnan(wy).any()):
+                res[t] = func(wx) if y is None else func(wx, wy)
+        return res
+    return ref
+
+
+def test_outlier():
+    # rounding errors of an outlier do not spread to later windows
+    x = np.array([1e10] + list(range(1, 10)) + [np.nan] + list(range(20, 10, -1)), dtype=float)
+    y = np.sin(np.arange(len(x))) + 3.0
+    for n in [3, 4]:
+        ref = _windows(x, n)
+        _assert_same(rolling.rolling_std(x, n), ref(lambda w: np.std(w, ddof=1)))
+        _assert_same(rolling.rolling_var(x, n, 0), ref(np.var))
+        _assert_same(rolling.CumulativeWindows(x).rolling_std(n), ref(lambda w: np.std(w, ddof=1)))
+        _assert_same(rolling.rolling_skew(x, n), ref(lambda w: stats.skew(w, bias=False)))
+        _assert_same(rolling.rolling_corr(x, y, n), ref(lambda a, b: np.corrcoef(a, b)[0, 1], y))
+        _assert_same(rolling.rolling_cov(x, y, n), ref(lambda a, b: np.cov(a, b)[0, 1], y))
+        _assert_same(rolling.rolling_beta(x, y, n), ref(lambda a, b: np.polyfit(b, a, 1)[0], y), rtol=1e-6)
+        _assert_same(rolling.rolling_residual(x, y, n),
+                     ref(lambda a, b: a[-1] - np.polyval(np.polyfit(b, a, 1), b[-1]), y), atol=1e-6)
+    _assert_same(rolling.rolling_kurt(x, 4), _windows(x, 4)(lambda w: stats.kurtosis(w, bias=False)), atol=1e-7)
+    assert rolling.rolling_std(x, 3)[3] == 1.0
+
+
+if __name__ == "__main__":
+    test_moments()
+    test_bivariate()
+    test_apply_kernels()
+    test_rank_and_regression()
+    test_cumulative_windows()
+    test_outlier()
@@ -12,6 +12,9 @@ def test_seq_gen():
     sg.get_next(text)
     for i in range(3, 999):
         assert sg.get_next(text) == i
+    
+    assert sg.get_next_n(text, 10) == 999
+    assert sg.get_next(text) == 1009
 
 
 if __name__ == "__main__":
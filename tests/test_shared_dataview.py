@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest import sweep
+from quantos.data import shared
+from test_sweep import _make_dataview
+
+
+def _is_mapped(arr):
+    while arr is not None:
+        if isinstance(arr, np.memmap):
+            return True
+        arr = arr.base if isinstance(arr, np.ndarray) else None
+    return False
+
+
+def _read_close(folder):
+    dv = shared.attach(folder)
+    df = dv.get_ts('close')
+    return float(np.nansum(df.values)), df.shape
+
+
+def test_publish_attach():
+    dv = _make_dataview(n_dates=50, n_symbols=10)
+    dv._data_benchmark = pd.DataFrame({'close': np.arange(50.0)}, index=dv.dates)
+    shared_dv = shared.publish(dv)
+    try:
+        dv2 = shared_dv.attach()
+        assert dv2.symbol == dv.symbol and dv2.fields == dv.fields
+        assert dv2.start_date == dv.start_date and np.array_equal(dv2.dates, dv.dates)
+        assert dv2.data_d.columns.equals(dv.data_d.columns) and dv2.data_d.columns.is_monotonic_increasing
+        assert dv2.data_d.equals(dv.data_d)
+        assert dv2.data_q is None
+        assert np.array_equal(dv2.data_benchmark.values, dv._data_benchmark.values)
+        for field in ['close', 'vwap', 'alpha1', 'trade_status']:
+            assert dv2.get_ts(field).equals(dv.get_ts(field))
+
+        # numeric data is mapped from the published files, read-only
+        blocks = [b.values for b in dv2.data_d._data.blocks if b.dtype.kind == 'f']
+        assert len(blocks) == 1 and _is_mapped(blocks[0])
+        assert not blocks[0].flags.writeable
+        assert dv2.data_d.shape == dv.data_d.shape
+
+        # new fields of an attached DataView are added to its own copy
+        dv2.add_formula('close2', 'close * 2', is_quarterly=False)
+        assert np.allclose(dv2.get_ts('close2').values, dv.get_ts('close').values * 2)
+        assert 'close2' not in shared.attach(shared_dv.folder).fields
+
+        # other processes attach the same data
+        pool = multiprocessing.Pool(2)
+        try:
+            res = pool.map(_read_close, [shared_dv.folder] * 2)
+        finally:
+            pool.close()
+            pool.join()
+        expected = float(np.nansum(dv.get_ts('close').values))
+        assert all(np.isclose(total, expected) and shape == (50, 10) for total, shape in res)
+    finally:
+        shared_dv.unlink()
+    assert not os.path.exists(shared_dv.folder)
+    try:
+        shared.attach(shared_dv.folder)
+        assert False
+    except IOError:
+        pass
+
+
+def test_lifecycle():
+    dv = _make_dataview(n_dates=20, n_symbols=5)
+    with shared.publish(dv) as shared_dv:
+        dv2 = shared_dv.attach()
+        # handles sent to other processes do not own the data
+        copy = pickle.loads(pickle.dumps(shared_dv))
+        assert copy.folder == shared_dv.folder and not copy.owner
+        copy.unlink()
+        assert os.path.exists(shared_dv.folder)
+        block = [b.values for b in dv2.data_d._data.blocks if b.dtype.kind == 'f'][0]
+        try:
+            block[0, 0] = 0.0
+            assert False
+        except ValueError:
+            pass
+        folder = shared_dv.folder
+    assert not os.path.exists(folder)
+    # data of processes that attached before unlink is still valid
+    assert np.allclose(dv2.get_ts('close').values, dv.get_ts('close').values)
+
+    # folder already used
+    folder = tempfile.mkdtemp()
+    try:
+        shared.publish(dv, folder)
+        assert False
+    except OSError:
+        pass
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_sweep_shared_dataview():
+    dv = _make_dataview()
+    folder = tempfile.mkdtemp()
+    try:
+        with shared.publish(dv) as shared_dv:
+            grid = {'signal': ['alpha1', None], 'period': ['week', 'month']}
+            df = sweep.ParameterSweep(shared_dv, folder).run(grid, n_jobs=2)
+        params = {'signal': 'alpha1', 'period': 'week'}
+        res = sweep.run_alpha(dv, params)
+        assert len(df) == 4
+        assert np.isclose(df.loc[sweep.task_key(params), 'total_return'], res['metrics']['total_return'])
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_benchmark():
+    res = shared.benchmark(n_dates=1000, n_symbols=2000, n_fields=5)
+    print(res)
+    assert res['size_mb'] > 0 and res['attach'] > 0
+
+
+if __name__ == "__main__":
+    test_publish_attach()
+    test_lifecycle()
+    test_sweep_shared_dataview()
+    test_benchmark()
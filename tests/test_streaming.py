@@ -0,0 +1,50 @@
+# encoding: utf-8
+
+import numpy as np
+import pandas as pd
+
+from quantos.data.formula_dag import FormulaDAG
+from quantos.data.streaming import StreamingEvaluator
+
+
+def _make_data(n_dates=80, n_symbols=8, seed=369):
+    rs = np.random.RandomState(seed)
+    index = np.arange(20170101, 20170101 + n_dates)
+    columns = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+
+    def make():
+        df = pd.DataFrame(index=index, columns=columns, data=rs.rand(n_dates, n_symbols) + 1.0)
+        df[rs.rand(n_dates, n_symbols) < 0.05] = np.nan
+        return df
+    data = {'close': make(), 'open': make(), 'volume': make()}
+    df_group = pd.DataFrame(index=index, columns=columns, data=rs.randint(0, 3, (n_dates, n_symbols)))
+    return data, df_group
+
+
+def test_same_as_batch():
+    data, df_group = _make_data()
+    formulas = [('f1', 'Rank(Ts_Mean(close / open, 5)) - Delta(volume, 3)'),
+                ('f2', 'Ewma(close, 4) + Sma(open, 6, 2) * Delay(close, 2)'),
+                ('f3', 'Corr(close, volume, 10) + Decay_linear(open, 4) + CountNans(close, 6)'),
+                ('f4', 'GroupApply(Standardize, Ts_Max(close, 3)) + If(close > open, 1, -1)'),
+                ('f5', 'Decay_exp(Return(close, 1), 0.8, 5) * StdDev(volume, 7)')]
+
+    se = StreamingEvaluator(data['close'].columns)
+    for name, formula in formulas:
+        se.add_formula(name, formula)
+    res_stream = se.warm_up(data, df_group=df_group)
+
+    dag = FormulaDAG()
+    res_batch = dag.evaluate([dag.compile(f) for _, f in formulas], data, df_group=df_group)
+    for (name, _), expected in zip(formulas, res_batch):
+        assert np.allclose(res_stream[name].values, expected.values, equal_nan=True)
+
+    # live update of a new date
+    values = {k: v.iloc[-1] * 1.01 for k, v in data.items()}
+    res = se.update(20170401, values, df_group=df_group.iloc[-1])
+    assert set(res.keys()) == {'f1', 'f2', 'f3', 'f4', 'f5'}
+    assert list(res['f1'].index) == list(data['close'].columns)
+
+
+if __name__ == "__main__":
+    test_same_as_batch()
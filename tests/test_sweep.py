@@ -0,0 +1,89 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest import sweep
+from quantos.data.dataview import DataView
+
+
+def _make_dataview(n_dates=120, n_symbols=20, seed=0):
+    """DataView of close, vwap, trade_status and signal fields, without data server."""
+    rs = np.random.RandomState(seed)
+    dates = np.array([int(d.strftime('%Y%m%d')) for d in pd.bdate_range('20170103', periods=n_dates)])
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+    close = pd.DataFrame(np.round(10.0 * np.exp(np.cumsum(rs.randn(n_dates, n_symbols) * 0.02, axis=0)), 2),
+                         index=dates, columns=symbols)
+    vwap = np.round(close * (1 + rs.randn(n_dates, n_symbols) * 0.002), 2)
+    trade_status = pd.DataFrame(u'交易'.encode('utf-8'), index=dates, columns=symbols)
+    trade_status[rs.rand(n_dates, n_symbols) < 0.03] = u'停牌'.encode('utf-8')
+
+    dv = DataView()
+    dv.symbol = symbols
+    dv.start_date, dv.end_date = dates[0], dates[-1]
+    dv.fields = ['close', 'vwap', 'trade_status']
+    dv.data_d = pd.concat({'close': close, 'vwap': vwap, 'trade_status': trade_status}, axis=1)
+    dv.data_d = dv.data_d.swaplevel(axis=1).sort_index(axis=1)
+    dv.data_d.columns.names = ['symbol', 'field']
+    dv.append_df(pd.DataFrame(rs.randn(n_dates, n_symbols), index=dates, columns=symbols), 'alpha1')
+    return dv
+
+
+_calls = []
+
+
+def _count_calls(dv, params):
+    _calls.append(params)
+    return sweep.run_alpha(dv, params)
+
+
+def test_signal_weights():
+    signal = pd.DataFrame([[1.0, -2.0, np.nan], [np.nan, np.nan, np.nan], [3.0, 3.0, 0.0]])
+    w = sweep.signal_weights(signal)
+    assert np.allclose(w.values, [[5. / 7, 2. / 7, 0.0], [0.0, 0.0, 0.0], [0.5, 0.5, 0.0]])
+    w = sweep.signal_weights(signal, 'equal_weight')
+    assert np.allclose(w.values, [[0.5, 0.5, 0.0], [0.0, 0.0, 0.0], [1. / 3, 1. / 3, 1. / 3]])
+
+
+def test_parameter_sweep():
+    dv = _make_dataview()
+    folder = tempfile.mkdtemp()
+    try:
+        grid = {'signal': ['alpha1', None], 'period': ['week', 'month'], 'position_ratio': [0.5, 1.0]}
+        ps = sweep.ParameterSweep(dv, folder)
+        df = ps.run(grid, n_jobs=3)
+        assert len(df) == 8
+        assert set(df.columns) >= {'signal', 'period', 'position_ratio', 'sharpe', 'max_drawdown', 'turnover'}
+
+        # results of workers are the same as running in this process
+        params = {'signal': 'alpha1', 'period': 'week', 'position_ratio': 0.5}
+        key = sweep.task_key(params)
+        res = sweep.run_alpha(dv, params)
+        assert np.isclose(df.loc[key, 'total_return'], res['metrics']['total_return'])
+        daily = ps.load(key)
+        assert np.allclose(daily['total_value'].values, res['daily']['total_value'].values)
+        trades = ps.load(key, 'trades')
+        assert len(trades) == len(res['trades']) and np.allclose(trades['size'], res['trades']['size'])
+        assert df.loc[key, 'n_rebalance'] == (res['daily']['turnover'] > 0).sum()
+
+        # resume: only tasks not done are run
+        os.remove(os.path.join(folder, key + '.json'))
+        ps = sweep.ParameterSweep(dv, folder, func=_count_calls)
+        df2 = ps.run(grid)
+        assert _calls == [params]
+        assert np.allclose(df2.loc[df.index, 'total_return'].values, df['total_return'].values)
+
+        # tasks of other grids are kept in the same folder
+        ps.run([{'signal': 'alpha1', 'pc_method': 'equal_weight'}])
+        assert len(ps.results()) == 9
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    test_signal_weights()
+    test_parameter_sweep()
@@ -0,0 +1,221 @@
+# encoding: utf-8
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from quantos.backtest import vectorized
+from quantos.backtest.alphastrategy import AlphaStrategy
+from quantos.backtest.backtest import AlphaBacktestInstance_dv
+from quantos.backtest.gateway import DailyStockSimGateway
+from quantos.data.dataview import DataView
+from quantos.util import dtutil
+
+
+class _Context(object):
+    dataview = None
+
+
+class _Calendar(object):
+    """Calendar of given trade dates, as quantos.data.calendar.Calendar without data server."""
+    def __init__(self, dates):
+        self.dates = np.asarray(dates)
+
+    def is_trade_date(self, date):
+        return date in self.dates
+
+    def get_next_trade_date(self, date):
+        return self.dates[self.dates > date][0]
+
+    def get_last_trade_date(self, date):
+        return self.dates[self.dates < date][-1]
+
+
+class _SignalStrategy(AlphaStrategy):
+    """Weights are the signal of the last trade date. Records positions and cash after fills of each date."""
+    def __init__(self):
+        AlphaStrategy.__init__(self, None, None, None)
+        self.records = {}
+
+    def init_from_config(self, props):
+        AlphaStrategy.init_from_config(self, props)
+        self.register_pc_method('signal', self.signal_weight)
+        self.active_pc_method = 'signal'
+
+    def signal_weight(self):
+        # as run_dataview, read the field with get_ts
+        signal = self.context.dataview.get_ts('signal', end_date=self.trade_date).iloc[-1]
+        return signal.reindex(self.context.universe).fillna(0.0).to_dict(), ""
+
+    def on_trade_ind(self, ind):
+        AlphaStrategy.on_trade_ind(self, ind)
+        self.records[ind.fill_date] = self.pm.get_sizes(self.context.universe), self.cash
+
+    def on_after_rebalance(self, total):
+        pass
+
+
+def _make_market(n_dates=120, n_symbols=30, seed=0):
+    rs = np.random.RandomState(seed)
+    dates = np.array([int(d.strftime('%Y%m%d')) for d in pd.bdate_range('20170103', periods=n_dates)])
+    symbols = ['{:06d}.SZ'.format(i) for i in range(n_symbols)]
+
+    close = 10.0 * np.exp(np.cumsum(rs.randn(n_dates, n_symbols) * 0.02, axis=0))
+    close = pd.DataFrame(np.round(close, 2), index=dates, columns=symbols)
+    vwap = np.round(close * (1 + rs.randn(n_dates, n_symbols) * 0.002), 2)
+    suspended = pd.DataFrame(rs.rand(n_dates, n_symbols) < 0.05, index=dates, columns=symbols)
+    close[suspended] = np.nan
+    vwap[suspended] = np.nan
+    adjust_factor = pd.DataFrame(1.0, index=dates, columns=symbols)
+    for j in range(0, n_symbols, 5):  # bonus shares
+        adjust_factor.iloc[rs.randint(n_dates):, j] *= 1.3
+    weights = pd.DataFrame(rs.rand(n_dates, n_symbols), index=dates, columns=symbols)
+    weights[weights < 0.3] = np.nan
+    return weights, close, vwap, adjust_factor, suspended
+
+
+def _run_loop(weights, close, vwap, adjust_factor, suspended, rebalance, init_balance, position_ratio,
+              commission_rate):
+    """Reference: day by day, symbol by symbol, as AlphaBacktestInstance_dv and AlphaStrategy."""
+    symbols = list(weights.columns)
+    positions = {sec: 0.0 for sec in symbols}
+    cash = init_balance
+    res_pos, res_value = [], []
+    last_close = {}
+    for i, date in enumerate(close.index):
+        # position_adjust
+        if i > 0:
+            for sec in symbols:
+                ratio = adjust_factor.loc[date, sec] / adjust_factor.iloc[i - 1][sec]
+                if positions[sec] != 0 and ratio > 1:
+                    positions[sec] *= ratio
+        if date in rebalance:
+            sus = [sec for sec in symbols if suspended.loc[date, sec]]
+            w = {sec: 0.0 if (sec in sus or np.isnan(weights.loc[date, sec])) else weights.loc[date, sec]
+                 for sec in symbols}
+            w_sum = np.sum(np.abs(list(w.values())))
+            if w_sum > 0:
+                w = {sec: v / w_sum for sec, v in w.items()}
+            market_value = sum(positions[sec] * close.loc[date, sec] for sec in symbols if sec not in sus)
+            cash_use = (cash + market_value) * position_ratio
+            for sec in symbols:
+                if sec in sus:
+                    continue
+                if abs(w[sec]) < 1e-8:
+                    goal = 0
+                else:
+                    raw = w[sec] * cash_use / close.loc[date, sec]
+                    goal = int(np.floor(raw / 100. + 0.5)) * 100
+                diff = goal - positions[sec]
+                if diff != 0:
+                    cash -= diff * vwap.loc[date, sec] + abs(diff) * vwap.loc[date, sec] * commission_rate
+                positions[sec] = goal
+        for sec in symbols:
+            if not np.isnan(close.loc[date, sec]):
+                last_close[sec] = close.loc[date, sec]
+        res_pos.append([positions[sec] for sec in symbols])
+        res_value.append(cash + sum(positions[sec] * last_close[sec] for sec in symbols if positions[sec] != 0))
+    return np.array(res_pos), np.array(res_value)
+
+
+def test_rebalance_dates():
+    dates = np.array([int(d.strftime('%Y%m%d')) for d in pd.bdate_range('20170103', '20170331')])
+    res = vectorized.rebalance_dates(dates, 20170103, 20170331, 'month', 0)
+    assert list(res) == [20170202, 20170302]
+    res = vectorized.rebalance_dates(dates, 20170103, 20170120, 'week', 2)
+    assert list(res) == [20170112, 20170119]
+    for date in res:
+        assert date in dates
+    # as AlphaBacktestInstance.go_next_date, the trade date after next business day
+    res = vectorized.rebalance_dates(dates, 20170103, 20170331, 'day', 0)
+    assert list(res) == list(dates[2::2])
+    assert dtutil.get_next_period_day(20170103, 'day', 0) == 20170104
+
+
+def test_run_weights():
+    weights, close, vwap, adjust_factor, suspended = _make_market()
+    rebalance = close.index.values[::5]
+    kwargs = dict(init_balance=1e7, position_ratio=0.7, commission_rate=1e-3)
+
+    t0 = time.time()
+    positions, daily = vectorized.run_weights(weights, close, fill_price=vwap, adjust_factor=adjust_factor,
+                                              suspended=suspended, rebalance=rebalance, **kwargs)
+    t_vec = time.time() - t0
+    t0 = time.time()
+    expected_pos, expected_value = _run_loop(weights, close, vwap, adjust_factor, suspended, set(rebalance),
+                                             **kwargs)
+    t_loop = time.time() - t0
+    print("vectorized {:.1f} ms, loop {:.1f} ms".format(t_vec * 1e3, t_loop * 1e3))
+
+    assert np.allclose(positions.values, expected_pos / 100)
+    assert np.allclose(daily['total_value'].values, expected_value)
+    assert np.allclose(daily['pnl'].sum(), daily['total_value'].iloc[-1] - 1e7)
+    assert (daily['turnover'].loc[rebalance] > 0).all()
+    assert (daily['turnover'].drop(rebalance) == 0).all()
+    assert np.allclose(daily['commission'], daily['turnover'] * 1e-3)
+
+    # whole lots right after each re-balance; suspended positions are frozen
+    tradable = ~suspended.loc[rebalance].values
+    lots = positions.loc[rebalance].values[tradable]
+    assert np.allclose(lots, np.round(lots))
+    for date in rebalance[1:]:
+        i = close.index.get_loc(date)
+        sus = suspended.loc[date].values & (adjust_factor.iloc[i] == adjust_factor.iloc[i - 1]).values
+        assert np.allclose(positions.loc[date].values[sus], positions.iloc[i - 1].values[sus])
+
+
+def test_run_alpha_vectorized():
+    weights, close, vwap, adjust_factor, suspended = _make_market(n_dates=60, n_symbols=10)
+    # portfolio_construction shifts weights by their minimum, keep a zero weight on each date
+    weights[np.arange(10) == np.arange(60).reshape(-1, 1) % 10] = 0.0
+    symbols = list(close.columns)
+    trade_status = pd.DataFrame(u'交易'.encode('utf-8'), index=close.index, columns=symbols)
+    trade_status[suspended] = u'停牌'.encode('utf-8')
+
+    dv = DataView()
+    dv.symbol = symbols
+    dv.start_date, dv.end_date = close.index[0], close.index[-1]
+    dv.fields = ['close', 'vwap', 'open', 'high', 'low', 'trade_status']
+    dv.data_d = pd.concat({'close': close, 'vwap': vwap, 'open': close, 'high': close, 'low': close,
+                           'trade_status': trade_status}, axis=1)
+    dv.data_d = dv.data_d.swaplevel(axis=1).sort_index(axis=1)
+    dv.data_d.columns.names = ['symbol', 'field']
+    dv.append_df(adjust_factor, 'adjust_factor')
+    dv.append_df(weights, 'signal')
+
+    props = {'period': 'week', 'days_delay': 0, 'init_balance': 1e6, 'position_ratio': 0.9}
+    bt = AlphaBacktestInstance_dv()
+    bt.ctx = _Context()
+    bt.ctx.dataview = dv
+    bt.ctx.universe = symbols
+    bt.ctx.calendar = _Calendar([int(d.strftime('%Y%m%d')) for d in pd.bdate_range('20170103', periods=90)])
+    bt.ctx.gateway = DailyStockSimGateway()
+    bt.start_date, bt.end_date = dv.start_date, dv.end_date
+    bt.props = props
+    bt.strategy = strategy = _SignalStrategy()
+    strategy.context = bt.ctx
+    strategy.init_from_config(props)
+
+    positions, daily = bt.run_alpha_vectorized('signal')
+    bt.run_alpha()
+
+    # the event loop: goals at close, orders in lots filled at vwap, positions adjusted before re-balance
+    rebalance = vectorized.rebalance_dates(close.index.values, bt.start_date, bt.end_date, 'week', 0)
+    assert len(rebalance) == 11
+    assert set(rebalance) <= set(strategy.records)
+    value_price = dv.get_ts('close').fillna(method='ffill')
+    for date in rebalance:
+        sizes, cash = strategy.records[date]
+        held = sizes != 0
+        total_value = cash + np.sum(sizes[held] * 100 * value_price.loc[date].values[held])
+        assert np.allclose(sizes, positions.loc[date].values)
+        assert np.isclose(cash, daily.loc[date, 'cash'])
+        assert np.isclose(total_value, daily.loc[date, 'total_value'])
+    assert np.allclose(strategy.pm.get_sizes(symbols), positions.loc[rebalance[-1]].values)
+
+
+if __name__ == "__main__":
+    test_rebalance_dates()
+    test_run_weights()
+    test_run_alpha_vectorized()